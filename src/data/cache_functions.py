@@ -0,0 +1,168 @@
+""" Functions to cache decoded data in memory and on disk so that
+files don't need to be read and processed more than once.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import numpy as np
+import os
+import threading
+
+# In memory caches, each is an ordered dictionary of key -> arrays
+#...ordered from least to most recently used
+_memory_caches = {}
+
+
+@contextmanager
+def atomic_write(filepath:str, mode:str='wb'):
+    """Context manager to write a file so that a crash never leaves a
+    partial file. Gives a handle to a temporary file next to filepath,
+    which is flushed to disk and moved to filepath once the block finishes.
+    If the block raises an error the temporary file is removed.
+    INPUT
+    filepath - where to save the file
+    mode - mode to open the temporary file with, 'w' for text, 'wb' for
+           binary or 'w+b' for writers that also read, like h5py
+    OUTPUT
+    handle - open file to write to
+    """
+
+    tmp_filepath = filepath + f'.{os.getpid()}.{threading.get_ident()}.tmp'
+
+    try:
+        with open(tmp_filepath, mode) as handle:
+            yield handle
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        os.replace(tmp_filepath, filepath)
+
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+def make_cache_key(*parts) -> str:
+    """Function to turn a set of values into a string key.
+    INPUT
+    parts - any values with a stable string representation
+    OUTPUT
+    key - hex digest of the values
+    """
+
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def arrays_nbytes(arrays:dict) -> int:
+    """Function to get how many bytes a dictionary of arrays uses.
+    INPUT
+    arrays - dictionary of numpy arrays
+    OUTPUT
+    nbytes - total size of the arrays
+    """
+
+    return int(sum(np.asarray(a).nbytes for a in arrays.values()))
+
+def memory_cache_get(name:str, key:str) -> dict:
+    """Function to get an item from an in memory cache.
+    INPUT
+    name - which cache to look in
+    key - key of the item
+    OUTPUT
+    arrays - cached dictionary of arrays, None if it isn't cached
+    """
+
+    cache = _memory_caches.get(name)
+    if cache is None or key not in cache['entries']:
+        return None
+
+    # Mark as most recently used
+    cache['entries'].move_to_end(key)
+
+    return cache['entries'][key]
+
+def memory_cache_put(name:str, key:str, arrays:dict, max_bytes:int):
+    """Function to add an item to an in memory cache, removing the least
+    recently used items until the cache is smaller than max_bytes.
+    INPUT
+    name - which cache to add to
+    key - key of the item
+    arrays - dictionary of arrays to store
+    max_bytes - largest size of the cache in bytes
+    OUTPUT
+    none
+    """
+
+    nbytes = arrays_nbytes(arrays)
+
+    # Don't bother if a single item is too big
+    if nbytes > max_bytes:
+        return
+
+    cache = _memory_caches.setdefault(name, {'entries' : OrderedDict(),
+                                             'nbytes' : 0})
+
+    if key in cache['entries']:
+        cache['nbytes'] -= arrays_nbytes(cache['entries'].pop(key))
+
+    cache['entries'][key] = arrays
+    cache['nbytes'] += nbytes
+
+    # Remove least recently used items
+    while cache['nbytes'] > max_bytes:
+        old_key, old_arrays = cache['entries'].popitem(last=False)
+        cache['nbytes'] -= arrays_nbytes(old_arrays)
+
+def memory_cache_clear(name:str=None):
+    """Function to empty in memory caches.
+    INPUT
+    name - which cache to clear, if None clear all of them
+    OUTPUT
+    none
+    """
+
+    if name is None:
+        _memory_caches.clear()
+    else:
+        _memory_caches.pop(name, None)
+
+def disk_cache_load(cache_dir:str, key:str) -> dict:
+    """Function to read a cached item from disk.
+    INPUT
+    cache_dir - directory where cached items are stored
+    key - key of the item
+    OUTPUT
+    arrays - cached dictionary of arrays, None if it isn't cached
+    """
+
+    filepath = os.path.join(cache_dir, key + '.npz')
+
+    if not os.path.exists(filepath):
+        return None
+
+    try:
+        with np.load(filepath, allow_pickle=False) as npz_file:
+            return {k : npz_file[k] for k in npz_file.files}
+    except Exception:
+        # A broken file is just a cache miss
+        return None
+
+def disk_cache_save(cache_dir:str, key:str, arrays:dict):
+    """Function to write an item to the disk cache, see atomic_write.
+    INPUT
+    cache_dir - directory where cached items are stored
+    key - key of the item
+    arrays - dictionary of arrays to store, no object arrays
+    OUTPUT
+    none
+    """
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    with atomic_write(os.path.join(cache_dir, key + '.npz')) as handle:
+        np.savez(handle, **arrays)
@@ -6,16 +6,23 @@ science@rileytroyer.com
 
 ####################### Initialize Program #######################
 # Libraries
-from bs4 import BeautifulSoup
 from datetime import datetime
 import logging
 import numpy as np
-import multiprocessing
 import os
-import pickle
-import requests
-import wget
+from pathlib import Path
+import sys
 
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+# Functions to download files concurrently
+from src.data.download_functions import download_files, gather_limited
+from src.data.download_functions import get_url_paths, is_client_error
+
+# Function to read probe locations during quiet periods
+from src.data.magephem_functions import iter_quiet_time_locations
 
 
 # Initiate logging
@@ -28,143 +35,107 @@ logging.basicConfig(filename = f'logs/download-emfisis-data-{datetime.today().da
 ####################### End Initializing #######################
 
 
-####################### Local Functions #######################
-def get_url_paths(url:str, ext:str='', params:dict={}) -> list:
-    """ Function to extract file names from https directory
-    Gets files in url directory with ext extension
-    Does this by parsing the html text from the webpage.
-    INPUT
-    url- url of directory to get files from 
-    ext- extension of the files
-    OUTPUT
-    parent- list of all file pathnames within directory
-    """
-
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
-    else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a')
-            if node.get('href').endswith(ext)]
-    return parent
-####################### End of Local Functions #######################
-
-
 ####################### START OF PROGRAM #######################
 
 # Define directories to save the various data
 mag_save_dir = 'data/raw/mag-waveform/'
 psd_save_dir = 'data/raw/l4-mag/'
 
+# Most requests to have going at once
+max_concurrency = 16
+
 # Check if these exists
 if not os.path.exists(mag_save_dir):
     os.makedirs(mag_save_dir)
 if not os.path.exists(psd_save_dir):
     os.makedirs(psd_save_dir)
 
-# Read in the pickle file with times to download data for
-with open('data/interim/rbsp-quiet-time-location.pickle',
-          'rb') as handle:
-    passby_dict = pickle.load(handle) 
-
-for key in list(passby_dict.keys())[0:10]:
-
-    logging.info(f'Downloading data for: {key}.')
-    
-    for probe in passby_dict[key].keys():
-        
-        # Get unique days for event, might be more than one
-        dates = np.unique([d[0].date() for d in
-                           passby_dict[key][probe]['Time']])
-        
-        for date in dates:
-        
-            if date > datetime(2019, 7, 16).date():
-                continue
-                
-            # Web directory where l4 psd files are stored
-            l4_data_url = ('https://emfisis.physics.uiowa.edu/Flight/RBSP-'
-                            + probe[-1].upper() + '/L4/' 
-                            + str(date.year) + '/' + str(date.month).zfill(2)
-                            + '/' + str(date.day).zfill(2) + '/')
-            # Find all files in html directory
-            l4_files = get_url_paths(l4_data_url, '.cdf')
-                
-            # See if there is a sheath corrected file
-            e_corrected_filebase = ('rbsp-' + probe[-1].lower()
-                                    + '_wna-survey-sheath-corrected-e_emfisis-L4_'
-                                    + str(date.year) + str(date.month).zfill(2) 
-                                    + str(date.day).zfill(2))
-            # l4_psd_filebase = ('rbsp-' + probe[-1].lower()
-            #                     + '_wna-survey_emfisis-L4_'
-            #                     + str(date.year) + str(date.month).zfill(2) 
-            #                     + str(date.day).zfill(2))
-            
-            # If there isn't a sheath corrected file notify and create a 'no-data' file
-            try:
-                e_corrected_filepathname = [f for f in l4_files if 
-                                            e_corrected_filebase in f][-1]
-                e_corrected_filename = e_corrected_filepathname.split('/')[-1]
-            except Exception as e:
-                logging.warning(f'No e sheath corrected file for {date}.'
-                                f' Creating file and continuing with error {e}')
-                # If file doesn't exist for density create a proxy file
-                proxy_file  = open(psd_save_dir + f'nodata-{date}-{probe}', 'w')
-                proxy_file.close()
-                continue
-                
-            # And download it if the file doesn't already exists
-            if not os.path.exists(psd_save_dir + e_corrected_filename):
-                try:
-                    wget.download(e_corrected_filepathname, psd_save_dir, bar=None)
-                except Exception as e:
-                    logging.warning(f'Unable to download: {e_corrected_filepathname}'
-                                    f' with error: {e}.')
-                    continue
-                
-            # # Get the specific L4 PSD file we are looking for
-            # l4_psd_filepathname = [f for f in l4_files if l4_psd_filebase in f][-1]
-            # l4_psd_filename = l4_psd_filepathname.split('/')[-1]
-            
-            # # And download it if the file doesn't already exists
-            # if not os.path.exists(psd_save_dir + l4_psd_filename):
-            #     try:
-            #         wget.download(l4_psd_filepathname, psd_save_dir, bar=None)
-            #     except Exception as e:
-            #         logging.warning(f'Unable to download: {l4_psd_filepathname} with'
-            #                         f' error: {e}.')
-            #         continue
-            
-            # Web directory where magnetic field (for gyrofrequency) files are stored
-            # mag_file_url = ('https://emfisis.physics.uiowa.edu/Flight/RBSP-'
-            #                 + probe[-1].upper() + '/L3/' 
-            #                 + str(date.year) + '/' + str(date.month).zfill(2)
-            #                 + '/' + str(date.day).zfill(2) + '/')
-            mag_file_url = (f'https://cdaweb.gsfc.nasa.gov/pub/data/rbsp/{probe}/'
-                            f'l3/emfisis/magnetometer/4sec/gei/{date.year}/')
-
-            mag_filebase = ('rbsp-' + probe[-1].lower() +
-                            '_magnetometer_4sec-gei_emfisis-l3_'
+# Get every unique probe and date, events often share days
+#...only the times are read from the quiet time location file
+probe_dates = set()
+events = set()
+for event, probe, location_dict in iter_quiet_time_locations(columns=['time']):
+    events.add(event)
+    # Get unique days for event, might be more than one
+    for date in np.unique(location_dict['time'].astype('datetime64[D]')).astype(datetime):
+        if date > datetime(2019, 7, 16).date():
+            continue
+        probe_dates.add((probe, date))
+probe_dates = sorted(probe_dates)
+
+logging.info(f'Downloading data for {len(probe_dates)} probe days'
+             f' from {len(events)} events.')
+
+# Web directories where l4 psd files and magnetic field (for gyrofrequency)
+#...files are stored
+l4_data_urls = [('https://emfisis.physics.uiowa.edu/Flight/RBSP-'
+                 + probe[-1].upper() + '/L4/' 
+                 + str(date.year) + '/' + str(date.month).zfill(2)
+                 + '/' + str(date.day).zfill(2) + '/') for probe, date in probe_dates]
+mag_file_urls = [(f'https://cdaweb.gsfc.nasa.gov/pub/data/rbsp/{probe}/'
+                  f'l3/emfisis/magnetometer/4sec/gei/{date.year}/') for probe, date in probe_dates]
+
+# Find all files in html directories
+l4_listings = gather_limited(get_url_paths, [(url, '.cdf') for url in l4_data_urls],
+                             max_concurrency=max_concurrency)
+mag_listings = gather_limited(get_url_paths, [(url, '.cdf') for url in mag_file_urls],
+                              max_concurrency=max_concurrency)
+
+# Work out which files need to be downloaded
+jobs = []
+for (probe, date), l4_data_url, l4_files, mag_files in zip(probe_dates, l4_data_urls,
+                                                          l4_listings, mag_listings):
+
+    # See if there is a sheath corrected file
+    e_corrected_filebase = ('rbsp-' + probe[-1].lower()
+                            + '_wna-survey-sheath-corrected-e_emfisis-L4_'
                             + str(date.year) + str(date.month).zfill(2) 
                             + str(date.day).zfill(2))
-            
-            # Find all files in html directory
-            mag_files = get_url_paths(mag_file_url, '.cdf')
-
-            # Get the specific file we are looking for
-            mag_filepathname = [f for f in mag_files if mag_filebase in f][0]
-            mag_filename = mag_filepathname.split('/')[-1]
-
-            # And download it
-            # but only if the file doesn't already exists
-            if not os.path.exists(mag_save_dir + mag_filename):
-                try:
-                    wget.download(mag_filepathname, mag_save_dir, bar=None)
-                except Exception as e:
-                    logging.warning(f'Unable to download: {mag_filepathname} with'
-                                    f' error: {e}.')
-                    continue
-
-logging.info('All finished.')
\ No newline at end of file
+
+    # Directory couldn't be reached, try again next run
+    if isinstance(l4_files, Exception) and not is_client_error(l4_files):
+        logging.warning(f'Unable to list: {l4_data_url} with error: {l4_files}.')
+        continue
+
+    # If there isn't a sheath corrected file notify and create a 'no-data' file
+    try:
+        if isinstance(l4_files, Exception):
+            raise l4_files
+        e_corrected_filepathname = [f for f in l4_files if 
+                                    e_corrected_filebase in f][-1]
+        e_corrected_filename = e_corrected_filepathname.split('/')[-1]
+    except Exception as e:
+        logging.warning(f'No e sheath corrected file for {date}.'
+                        f' Creating file and continuing with error {e}')
+        # If file doesn't exist for density create a proxy file
+        proxy_file  = open(psd_save_dir + f'nodata-{date}-{probe}', 'w')
+        proxy_file.close()
+        continue
+
+    jobs.append((e_corrected_filepathname, psd_save_dir + e_corrected_filename))
+
+    mag_filebase = ('rbsp-' + probe[-1].lower() +
+                    '_magnetometer_4sec-gei_emfisis-l3_'
+                    + str(date.year) + str(date.month).zfill(2) 
+                    + str(date.day).zfill(2))
+
+    # Get the specific file we are looking for
+    try:
+        if isinstance(mag_files, Exception):
+            raise mag_files
+        mag_filepathname = [f for f in mag_files if mag_filebase in f][0]
+        mag_filename = mag_filepathname.split('/')[-1]
+    except Exception as e:
+        logging.warning(f'No magnetometer file for {date} and {probe}'
+                        f' with error: {e}.')
+        continue
+
+    jobs.append((mag_filepathname, mag_save_dir + mag_filename))
+
+# And download them, files that already exist are skipped
+failed = download_files(jobs, max_concurrency=max_concurrency)
+
+for url, e in failed.items():
+    logging.warning(f'Unable to download: {url} with error: {e}.')
+
+logging.info(f'All finished. {len(failed)} downloads failed.')
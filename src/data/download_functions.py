@@ -0,0 +1,292 @@
+""" Functions to download many data files concurrently. Requests are run
+from an asyncio event loop with a limit on how many run at once, each host
+gets its own pooled keep-alive session, partial downloads are resumed and
+failed requests are retried with exponential backoff. Directory listings
+are cached in memory and on disk.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import asyncio
+import hashlib
+import html
+import json
+import logging
+import os
+import re
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Function to write files without leaving partial ones
+from src.data.cache_functions import atomic_write
+
+# One session per host, shared by all threads
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Directory listings already fetched, url -> (time fetched, links)
+_listings = {}
+_listing_locks = {}
+
+# Where listings are saved between runs and how long they are good for
+listing_cache_dir = 'data/interim/url-listing-cache/'
+listing_ttl = 24*60*60
+
+# Links in an html directory listing
+_href_pattern = re.compile(rb'<a\s[^>]*?href\s*=\s*["\']([^"\']*)["\']', re.IGNORECASE)
+
+
+def get_host_session(url:str, pool_size:int=16) -> requests.Session:
+    """Function to get the session for the host of a url. Sessions keep
+    connections alive so many requests to the same host reuse them.
+    INPUT
+    url - any url on the host
+    pool_size - how many connections to keep open to the host
+    OUTPUT
+    session - requests session for the host
+    """
+
+    host = urlsplit(url).netloc
+
+    with _sessions_lock:
+        if host not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+
+    return _sessions[host]
+
+def _listing_lock(key:str) -> threading.Lock:
+    """Lock so only one thread fetches a listing, others wait for it."""
+    with _sessions_lock:
+        return _listing_locks.setdefault(key, threading.Lock())
+
+def get_url_links(url:str, params:dict={}, ttl:float=None,
+                  cache_dir:str=None, timeout:float=60) -> list:
+    """Function to get all links in an html directory listing. Listings are
+    cached in memory and on disk, so each directory is only fetched once
+    every ttl seconds no matter how many times it is asked for.
+    INPUT
+    url - url of directory
+    params - query parameters for request
+    ttl - seconds a cached listing is good for, default listing_ttl
+    cache_dir - where to save listings, default listing_cache_dir,
+                empty string to only cache in memory
+    timeout - seconds to wait for the server
+    OUTPUT
+    links - href of every link in directory
+    """
+
+    if ttl is None:
+        ttl = listing_ttl
+    if cache_dir is None:
+        cache_dir = listing_cache_dir
+
+    key = hashlib.sha1(repr((url, sorted(params.items()))).encode('utf-8')).hexdigest()
+    cache_filepath = os.path.join(cache_dir, key + '.json') if cache_dir else None
+
+    with _listing_lock(key):
+
+        # Check memory
+        if key in _listings and time.time() - _listings[key][0] < ttl:
+            return _listings[key][1]
+
+        # Then check disk
+        if cache_filepath is not None and os.path.exists(cache_filepath):
+            try:
+                with open(cache_filepath, 'r') as handle:
+                    cached = json.load(handle)
+                if time.time() - cached['time'] < ttl:
+                    _listings[key] = (cached['time'], cached['links'])
+                    return cached['links']
+            except Exception:
+                pass
+
+        # Otherwise get the listing
+        response = get_host_session(url).get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+
+        links = [html.unescape(m.decode(response.encoding or 'utf-8'))
+                 for m in _href_pattern.findall(response.content)]
+
+        fetch_time = time.time()
+        _listings[key] = (fetch_time, links)
+
+        if cache_filepath is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                with atomic_write(cache_filepath, 'w') as handle:
+                    json.dump({'url' : url, 'time' : fetch_time, 'links' : links}, handle)
+            except OSError:
+                pass
+
+    return links
+
+def get_url_paths(url:str, ext:str='', params:dict={}) -> list:
+    """ Function to extract file names from https directory
+    Gets files in url directory with ext extension
+    Does this by parsing the html text from the webpage. The listing
+    is cached, see get_url_links.
+    INPUT
+    url- url of directory to get files from 
+    ext- extension of the files
+    params- query parameters for request
+    OUTPUT
+    parent- list of all file pathnames within directory
+    """
+
+    return [url + link for link in get_url_links(url, params=params)
+            if link.endswith(ext)]
+
+def download_file(url:str, filepath:str, chunk_bytes:int=1024**2,
+                  timeout:float=60) -> str:
+    """Function to download a single file. Data is written to filepath + .part
+    and only moved to filepath once complete. If a .part file already exists
+    the download is resumed from where it stopped.
+    INPUT
+    url - url of file to download
+    filepath - where to save the file
+    chunk_bytes - how much to read at a time
+    timeout - seconds to wait for the server
+    OUTPUT
+    filepath - where the file was saved. Raises error if download fails.
+    """
+
+    session = get_host_session(url)
+    part_filepath = filepath + '.part'
+
+    # Ask for the rest of the file if some has already been downloaded
+    headers = {}
+    if os.path.exists(part_filepath):
+        headers['Range'] = f'bytes={os.path.getsize(part_filepath)}-'
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+
+        # Range is past the end of the file, the partial file is either
+        #...already complete or the file on the server changed
+        if response.status_code == 416:
+            remote_size = re.fullmatch(r'bytes \*/(\d+)',
+                                       response.headers.get('Content-Range', ''))
+
+            if (remote_size is not None
+                and int(remote_size.group(1)) == os.path.getsize(part_filepath)):
+                os.replace(part_filepath, filepath)
+                return filepath
+
+            os.remove(part_filepath)
+            return download_file(url, filepath, chunk_bytes, timeout)
+
+        response.raise_for_status()
+
+        # Server ignored the range request, start over
+        mode = 'ab' if response.status_code == 206 else 'wb'
+
+        with open(part_filepath, mode) as handle:
+            for chunk in response.iter_content(chunk_size=chunk_bytes):
+                handle.write(chunk)
+
+    os.replace(part_filepath, filepath)
+
+    return filepath
+
+def is_client_error(error:Exception) -> bool:
+    """Function to check if an error is an http client error (4xx) other
+    than a timeout or rate limit, which means a retry won't help.
+    INPUT
+    error - exception raised by a request
+    OUTPUT
+    True if it is a client error
+    """
+
+    if not isinstance(error, requests.HTTPError) or error.response is None:
+        return False
+
+    status = error.response.status_code
+
+    return 400 <= status < 500 and status not in (408, 429)
+
+async def _run_with_retries(semaphore:asyncio.Semaphore, func, args:tuple,
+                            retries:int, backoff:float):
+    """Run a blocking function in a thread, retrying with exponential backoff.
+    The semaphore is released while waiting to retry."""
+
+    for attempt in range(retries + 1):
+
+        try:
+            async with semaphore:
+                return await asyncio.to_thread(func, *args)
+
+        except Exception as e:
+            # Client errors like a missing file won't go away by retrying
+            if attempt == retries or is_client_error(e):
+                raise
+
+            delay = backoff * 2**attempt
+            logging.warning(f'{func.__name__}{args[:1]} failed with error: {e}.'
+                            f' Retrying in {delay} s.')
+            await asyncio.sleep(delay)
+
+async def gather_limited_async(func, args_list:list, max_concurrency:int=8,
+                               retries:int=5, backoff:float=1.0) -> list:
+    """Function to run a blocking function for many arguments with at most
+    max_concurrency running at once.
+    INPUT
+    func - function to run
+    args_list - list of argument tuples, one per call
+    max_concurrency - most calls to run at once
+    retries - how many times to retry a call that raised an error
+    backoff - seconds to wait before first retry, doubles each retry
+    OUTPUT
+    results - result of each call in the same order as args_list,
+              the exception if the call failed every time
+    """
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    tasks = [_run_with_retries(semaphore, func, args, retries, backoff)
+             for args in args_list]
+
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+def gather_limited(func, args_list:list, max_concurrency:int=8,
+                   retries:int=5, backoff:float=1.0) -> list:
+    """Blocking version of gather_limited_async, see it for details."""
+
+    return asyncio.run(gather_limited_async(func, args_list, max_concurrency,
+                                            retries, backoff))
+
+def download_files(jobs:list, max_concurrency:int=8,
+                   retries:int=5, backoff:float=1.0) -> dict:
+    """Function to download many files concurrently. Files that already
+    exist are skipped and duplicate jobs are only downloaded once.
+    INPUT
+    jobs - list of (url, filepath) tuples
+    max_concurrency - most downloads to run at once
+    retries - how many times to retry a failed download
+    backoff - seconds to wait before first retry, doubles each retry
+    OUTPUT
+    failed - dictionary of url -> exception for downloads that failed
+    """
+
+    # Remove duplicates and files already downloaded
+    jobs = [job for job in dict.fromkeys(jobs) if not os.path.exists(job[1])]
+
+    if len(jobs) == 0:
+        return {}
+
+    # Make sure there are enough connections for all workers
+    for url, filepath in jobs:
+        get_host_session(url, pool_size=max_concurrency)
+
+    results = gather_limited(download_file, jobs, max_concurrency=max_concurrency,
+                             retries=retries, backoff=backoff)
+
+    return {url : result for (url, filepath), result in zip(jobs, results)
+            if isinstance(result, Exception)}
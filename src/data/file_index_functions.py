@@ -0,0 +1,172 @@
+""" Functions to keep a persistent index of the downloaded data files so
+a file can be found by probe, product and date without scanning directories.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from datetime import datetime
+import os
+import pickle
+import re
+
+# Function to write files without leaving partial ones
+from src.data.cache_functions import atomic_write
+
+# File name patterns for each data product. Groups are probe letter,
+#...date and version.
+file_patterns = {'l4-sheath-corrected-e' : re.compile(r'^rbsp-([ab])_wna-survey-sheath-corrected-e'
+                                                       r'_emfisis-l4_(\d{8})_v([\d.]+)\.cdf$',
+                                                       re.IGNORECASE),
+                 'l3-mag-4sec-gei' : re.compile(r'^rbsp-([ab])_magnetometer_4sec-gei'
+                                                r'_emfisis-l3_(\d{8})_v([\d.]+)\.cdf$',
+                                                re.IGNORECASE),
+                 'magephem-t89q' : re.compile(r'^rbsp([ab])_def_magephem_t89q'
+                                              r'_(\d{8})_v([\d.]+)\.h5$',
+                                              re.IGNORECASE),
+                 'nodata' : re.compile(r'^nodata-(\d{4})-(\d{2})-(\d{2})-rbsp([ab])$')}
+
+# Indexes already loaded by this process
+_file_indexes = {}
+
+
+def parse_data_filename(filename:str) -> 'tuple, tuple':
+    """Function to get the probe, product and date of a data file from its name.
+    INPUT
+    filename - name of file, no directory
+    OUTPUT
+    key - (probe, product, date) or None if file isn't a known product
+    version - version of file as a tuple of ints, used to pick the newest
+    """
+
+    for product, pattern in file_patterns.items():
+
+        match = pattern.match(filename)
+        if match is None:
+            continue
+
+        if product == 'nodata':
+            year, month, day, probe = match.groups()
+            date = datetime(int(year), int(month), int(day)).date()
+            return ('rbsp' + probe.lower(), product, date), ()
+
+        probe, date, version = match.groups()
+        date = datetime.strptime(date, '%Y%m%d').date()
+        version = tuple(int(v) for v in version.split('.') if v != '')
+
+        return ('rbsp' + probe.lower(), product, date), version
+
+    return None, None
+
+def _index_filepath(directory:str) -> str:
+    """Index is stored next to the directory, not in it, so writing it
+    doesn't change the directory modification time."""
+    return os.path.normpath(directory) + '.file-index.pickle'
+
+def refresh_file_index(directory:str) -> dict:
+    """Function to load the index of a directory and update it if the
+    directory has changed since it was last indexed. Only files that are
+    new since the last update are parsed.
+    INPUT
+    directory - directory with data files
+    OUTPUT
+    file_index - dictionary with dir_mtime, names (all indexed filenames)
+                 and files ((probe, product, date) -> list of (version, filename))
+    """
+
+    dir_mtime = os.stat(directory).st_mtime
+
+    # Use already loaded index if nothing has changed
+    file_index = _file_indexes.get(directory)
+    if file_index is not None and file_index['dir_mtime'] == dir_mtime:
+        return file_index
+
+    # Otherwise try the one saved on disk
+    index_filepath = _index_filepath(directory)
+    if file_index is None and os.path.exists(index_filepath):
+        try:
+            with open(index_filepath, 'rb') as handle:
+                file_index = pickle.load(handle)
+        except Exception:
+            file_index = None
+
+    if file_index is None:
+        file_index = {'dir_mtime' : None, 'names' : set(), 'files' : {}}
+
+    if file_index['dir_mtime'] != dir_mtime:
+
+        names = set(os.listdir(directory))
+
+        # Remove files that no longer exist
+        removed = file_index['names'] - names
+        if removed:
+            for key in list(file_index['files']):
+                versions = [v for v in file_index['files'][key] if v[1] not in removed]
+                if versions:
+                    file_index['files'][key] = versions
+                else:
+                    del file_index['files'][key]
+
+        # Add files that are new
+        for filename in names - file_index['names']:
+            key, version = parse_data_filename(filename)
+            if key is None:
+                continue
+            versions = file_index['files'].setdefault(key, [])
+            versions.append((version, filename))
+            versions.sort()
+
+        file_index['names'] = names
+        file_index['dir_mtime'] = dir_mtime
+
+        # Save so the next run doesn't need to parse everything again
+        try:
+            with atomic_write(index_filepath) as handle:
+                pickle.dump(file_index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            # Index still works, it just isn't saved
+            pass
+
+    _file_indexes[directory] = file_index
+
+    return file_index
+
+def lookup_file(directory:str, probe:str, product:str, date) -> str:
+    """Function to find a data file for a probe, product and date.
+    INPUT
+    directory - directory with data files
+    probe - rbspa or rbspb
+    product - one of the keys in file_patterns
+    date - date of file, datetime or date
+    OUTPUT
+    filepath - full path to the newest version of the file, None if there isn't one
+    """
+
+    if isinstance(date, datetime):
+        date = date.date()
+
+    file_index = refresh_file_index(directory)
+
+    versions = file_index['files'].get((probe.lower(), product, date))
+    if not versions:
+        return None
+
+    return os.path.join(directory, versions[-1][1])
+
+def lookup_all_files(directory:str, probe:str, product:str) -> list:
+    """Function to find every data file for a probe and product.
+    INPUT
+    directory - directory with data files
+    probe - rbspa or rbspb
+    product - one of the keys in file_patterns
+    OUTPUT
+    filepaths - full path to the newest version of each file, sorted by date
+    """
+
+    file_index = refresh_file_index(directory)
+
+    keys = sorted(k for k in file_index['files']
+                  if k[0] == probe.lower() and k[1] == product)
+
+    return [os.path.join(directory, file_index['files'][k][-1][1]) for k in keys]
@@ -0,0 +1,194 @@
+""" Functions to store data as columns in h5 files. Each column is a
+single resizable, chunked and compressed dataset, and an index table records
+where the rows for each event and probe start and how many there are.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import h5py
+import numpy as np
+
+# Rows per chunk for the column datasets
+chunk_rows = 65536
+
+
+def append_to_dataset(group:h5py.Group, name:str, data:np.ndarray):
+    """Function to append data along the first axis of a dataset,
+    creating it as a resizable, chunked and compressed dataset if needed.
+    INPUT
+    group - h5 group the dataset is in
+    name - name of dataset
+    data - array to add, all but the first dimension must match the dataset
+    OUTPUT
+    Writes to h5 file.
+    """
+
+    data = np.asarray(data)
+
+    if name not in group:
+        group.create_dataset(name, shape=(0,) + data.shape[1:],
+                             maxshape=(None,) + data.shape[1:],
+                             chunks=(chunk_rows,) + data.shape[1:],
+                             dtype=data.dtype, compression='gzip',
+                             compression_opts=4, shuffle=True)
+
+    dataset = group[name]
+    start = dataset.shape[0]
+    dataset.resize(start + data.shape[0], axis=0)
+    dataset[start:] = data
+
+def append_columns_to_h5(h5_file:h5py.File, columns:dict,
+                         event:str, probe:str, path:str='/'):
+    """Function to append the rows for an event and probe to the column
+    datasets and add an entry to the index table.
+    INPUT
+    h5_file - the h5 file to write data to
+    columns - dictionary of arrays, all with the same first dimension
+    event - isotime of event
+    probe - which probe the data is for
+    path - group within h5 file to store columns in, usually '/'
+    OUTPUT
+    Writes to h5 file. Raises ValueError if the columns don't match the
+    ones already in the file.
+    """
+
+    lengths = {len(np.asarray(c)) for c in columns.values()}
+    if len(lengths) > 1:
+        raise ValueError(f'Columns have different lengths: {lengths}')
+    count = lengths.pop() if lengths else 0
+
+    group = h5_file.require_group(path)
+    group.attrs['layout'] = 'columnar'
+
+    # Where these rows start
+    index = group.require_group('index')
+    if 'offset' in index and index['offset'].shape[0] > 0:
+        offset = int(index['offset'][-1] + index['count'][-1])
+    else:
+        offset = 0
+
+    # Make sure the same columns are written for every entry, a new
+    #...column can't be added once there are rows
+    stored = {name for name, item in group.items() if isinstance(item, h5py.Dataset)}
+    if stored and stored != set(columns):
+        raise ValueError(f'Columns {sorted(set(columns) ^ stored)} are only in'
+                         f' one of the file and the new rows.')
+    for name in columns:
+        if name not in group and offset > 0:
+            raise ValueError(f'Column {name} is new, but there are already {offset} rows.')
+
+    # Make sure columns are all the same length before adding
+    for name, data in columns.items():
+        if name in group and group[name].shape[0] != offset:
+            raise ValueError(f'Column {name} has {group[name].shape[0]} rows,'
+                             f' expected {offset}.')
+
+    for name, data in columns.items():
+        append_to_dataset(group, name, data)
+
+    append_to_dataset(index, 'event', np.array([event]).astype('S32'))
+    append_to_dataset(index, 'probe', np.array([probe]).astype('S8'))
+    append_to_dataset(index, 'offset', np.array([offset], dtype=np.int64))
+    append_to_dataset(index, 'count', np.array([count], dtype=np.int64))
+
+def read_index_from_h5(h5_file:h5py.File, path:str='/') -> dict:
+    """Function to read the event index table.
+    INPUT
+    h5_file - the h5 file to read from
+    path - group within h5 file with the columns
+    OUTPUT
+    index_dict - dictionary with event, probe, offset and count arrays
+    """
+
+    index = h5_file[path]['index']
+
+    return {'event' : index['event'][:].astype(str),
+            'probe' : index['probe'][:].astype(str),
+            'offset' : index['offset'][:],
+            'count' : index['count'][:]}
+
+def read_columns_from_h5(h5_file:h5py.File, names:list=None,
+                         event:str=None, probe:str=None,
+                         path:str='/') -> dict:
+    """Function to read columns, either whole or just the rows for
+    a single event and/or probe.
+    INPUT
+    h5_file - the h5 file to read from
+    names - which columns to read, if None read all of them
+    event - only read rows for this event
+    probe - only read rows for this probe
+    path - group within h5 file with the columns
+    OUTPUT
+    column_dict - dictionary of arrays
+    """
+
+    group = h5_file[path]
+
+    if names is None:
+        names = [k for k in group.keys() if isinstance(group[k], h5py.Dataset)]
+
+    # Whole columns are read in one call
+    if event is None and probe is None:
+        return {name : group[name][:] for name in names}
+
+    # Otherwise find the rows from the index
+    index_dict = read_index_from_h5(h5_file, path)
+    selector = np.ones(len(index_dict['event']), dtype=bool)
+    if event is not None:
+        selector &= index_dict['event'] == event
+    if probe is not None:
+        selector &= index_dict['probe'] == probe
+
+    slices = [slice(o, o + c) for o, c in zip(index_dict['offset'][selector],
+                                              index_dict['count'][selector])]
+
+    column_dict = {}
+    for name in names:
+        parts = [group[name][s] for s in slices]
+        if parts:
+            column_dict[name] = np.concatenate(parts)
+        else:
+            column_dict[name] = group[name][0:0]
+
+    return column_dict
+
+def truncate_columns_in_h5(h5_file:h5py.File, n_entries:int, path:str='/'):
+    """Function to remove everything after the first n_entries of the
+    index table, along with their rows in the column datasets. Used to
+    roll back a partly written event and probe.
+    INPUT
+    h5_file - the h5 file to change
+    n_entries - how many index entries to keep
+    path - group within h5 file with the columns
+    OUTPUT
+    Changes h5 file. Raises ValueError if there are fewer than n_entries.
+    """
+
+    if path not in h5_file or 'index' not in h5_file[path]:
+        return
+
+    group = h5_file[path]
+    index = group['index']
+
+    # File is missing entries, e.g. the manifest is from another file
+    n_stored = index['offset'].shape[0] if 'offset' in index else 0
+    if n_entries > n_stored:
+        raise ValueError(f'Expected at least {n_entries} index entries, but the'
+                         f' file only has {n_stored}. The manifest does not'
+                         f' match the file.')
+
+    # Rows used by the entries that are kept
+    if n_entries > 0:
+        n_rows = int(index['offset'][n_entries - 1] + index['count'][n_entries - 1])
+    else:
+        n_rows = 0
+
+    for name in index.keys():
+        if index[name].shape[0] > n_entries:
+            index[name].resize(n_entries, axis=0)
+
+    for name, dataset in group.items():
+        if isinstance(dataset, h5py.Dataset) and dataset.shape[0] > n_rows:
+            dataset.resize(n_rows, axis=0)
@@ -0,0 +1,367 @@
+""" Functions to read the Van Allen Probes magnetic ephemeris (MagEphem)
+files and match probe locations to time periods.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from datetime import datetime
+import h5py
+import numpy as np
+import os
+
+# Function to find files from the file index
+from src.data.file_index_functions import lookup_all_files
+
+# Functions to write columns to h5 files
+from src.data.h5_functions import append_columns_to_h5, append_to_dataset
+from src.data.h5_functions import chunk_rows, read_index_from_h5
+
+# Columns read from each MagEphem file
+magephem_columns = ['time', 'l', 'mlt', 'mlat', 'footpoint', 'rgeo']
+
+# Where the store with the whole mission for each probe is kept
+magephem_store_filepath = 'data/interim/rbsp-magephem-store.h5'
+
+# Where the probe locations during each quiet period are kept
+quiet_time_location_filepath = 'data/interim/rbsp-quiet-time-location.h5'
+
+
+def isotime_to_datetime64(isotime:np.ndarray) -> np.ndarray:
+    """Function to convert MagEphem IsoTime strings to datetimes. This
+    is done on the raw bytes of the whole array at once. Some seconds
+    are 60 (leap seconds), these are changed to 59.
+    INPUT
+    isotime - array of byte strings, e.g. b'2012-09-01T00:00:00Z'
+    OUTPUT
+    time - array of datetime64[ns]
+    """
+
+    isotime = np.asarray(isotime).astype(bytes)
+    time = np.empty(isotime.shape, dtype='datetime64[ns]')
+
+    if isotime.size == 0:
+        return time
+
+    # Strings are null padded to the same width, so group by real length
+    lengths = np.char.str_len(isotime)
+
+    for length in np.unique(lengths):
+
+        group = lengths == length
+        if length == 0:
+            time[group] = np.datetime64('NaT')
+            continue
+
+        # One row of characters per time
+        chars = np.ascontiguousarray(isotime[group]).view(np.uint8)
+        chars = chars.reshape(-1, isotime.dtype.itemsize)[:, :length].copy()
+
+        # Remove the Z at the end, numpy assumes UTC anyway
+        ends_z = chars[:, -1] == ord('Z')
+        width = length - 1 if np.all(ends_z) else length
+        if width != length:
+            chars = chars[:, :width]
+        elif np.any(ends_z):
+            chars[ends_z, -1] = ord(' ')
+
+        # Seconds are always at the same place, YYYY-MM-DDThh:mm:ss,
+        #...before any fraction or Z
+        if width >= 19:
+            leap = (chars[:, 17] == ord('6')) & (chars[:, 18] == ord('0'))
+            chars[leap, 17] = ord('5')
+            chars[leap, 18] = ord('9')
+
+        strings = np.ascontiguousarray(chars).view(f'S{chars.shape[1]}')[:, 0]
+        if width == length and np.any(ends_z):
+            strings = np.char.strip(strings)
+        time[group] = strings.astype('datetime64[ns]')
+
+    return time
+
+def read_magephem_file(filepath:str) -> dict:
+    """Function to read the location columns from a single MagEphem file.
+    INPUT
+    filepath - path to h5 file
+    OUTPUT
+    magephem_dict - dictionary with time, l, mlt, mlat, footpoint and rgeo
+    """
+
+    with h5py.File(filepath, 'r') as file:
+
+        magephem_dict = {'time' : isotime_to_datetime64(file['IsoTime'][:]),
+                         'l' : file['L'][:, -1],
+                         'mlt' : file['CDMAG_MLT'][:],
+                         'mlat' : file['CDMAG_MLAT'][:],
+                         'footpoint' : file['Pfn_geod_LatLon'][:],
+                         'rgeo' : file['Rgeo'][:]}
+
+    return magephem_dict
+
+def load_probe_ephemeris(directory:str, probe:str) -> dict:
+    """Function to read all MagEphem files for a probe into single
+    arrays sorted by time.
+    INPUT
+    directory - directory with MagEphem files
+    probe - rbspa or rbspb
+    OUTPUT
+    ephemeris_dict - dictionary with time, l, mlt, mlat, footpoint and rgeo
+    """
+
+    filepaths = lookup_all_files(directory, probe, 'magephem-t89q')
+
+    return _read_magephem_files(filepaths)
+
+def _read_magephem_files(filepaths:list) -> dict:
+    """Read and join MagEphem files, sorted by time."""
+
+    file_dicts = [read_magephem_file(f) for f in filepaths]
+
+    if len(file_dicts) == 0:
+        return {'time' : np.array([], dtype='datetime64[ns]'),
+                'l' : np.array([]), 'mlt' : np.array([]),
+                'mlat' : np.array([]), 'footpoint' : np.zeros((0, 2)),
+                'rgeo' : np.zeros((0, 3))}
+
+    # Join all the days together
+    ephemeris_dict = {c : np.concatenate([d[c] for d in file_dicts])
+                      for c in magephem_columns}
+
+    # Make sure everything is in time order
+    order = np.argsort(ephemeris_dict['time'], kind='stable')
+    if np.any(np.diff(order) != 1):
+        ephemeris_dict = {c : v[order] for c, v in ephemeris_dict.items()}
+
+    return ephemeris_dict
+
+def match_periods_to_ephemeris(time:np.ndarray, selected:np.ndarray,
+                               starts:np.ndarray, ends:np.ndarray) -> list:
+    """Function to find the ephemeris samples within each of many time
+    periods. Done for all periods at once with binary searches.
+    INPUT
+    time - sorted datetime64 times of ephemeris
+    selected - boolean array of samples that can be used, e.g. location filter
+    starts - datetime64 start of each period, samples must be after this
+    ends - datetime64 end of each period, samples must be before this
+    OUTPUT
+    period_indices - list with an array of sample indices for each period
+    """
+
+    time = np.asarray(time, dtype='datetime64[ns]')
+    starts = np.asarray(starts, dtype='datetime64[ns]')
+    ends = np.asarray(ends, dtype='datetime64[ns]')
+
+    # Sample index range strictly inside each period
+    first_i = np.searchsorted(time, starts, side='right')
+    last_i = np.searchsorted(time, ends, side='left')
+
+    # Same range but only counting selected samples
+    selected_i = np.flatnonzero(selected)
+    low = np.searchsorted(selected_i, first_i, side='left')
+    high = np.searchsorted(selected_i, np.maximum(last_i, first_i), side='left')
+
+    return [selected_i[lo:hi] for lo, hi in zip(low, high)]
+
+def _store_sources(filepaths:list) -> 'np.ndarray, np.ndarray':
+    """Names and modification times of the files in a store."""
+    names = np.array([os.path.basename(f) for f in filepaths], dtype='S64')
+    mtimes = np.array([os.stat(f).st_mtime for f in filepaths], dtype=float)
+    return names, mtimes
+
+def update_magephem_store(directory:str, store_filepath:str=magephem_store_filepath,
+                          probes:list=['rbspa', 'rbspb']) -> dict:
+    """Function to build or update the ephemeris store, an h5 file with
+    one group per probe holding the whole mission as time sorted, chunked
+    and compressed columns. If the only change is new files later in time
+    these are appended, otherwise the probe is rebuilt from all the files.
+    INPUT
+    directory - directory with MagEphem files
+    store_filepath - where to write the store
+    probes - which probes to store
+    OUTPUT
+    status - dictionary of probe -> 'current', 'appended' or 'rebuilt'
+    """
+
+    if not os.path.exists(os.path.dirname(store_filepath) or '.'):
+        os.makedirs(os.path.dirname(store_filepath))
+
+    status = {}
+
+    with h5py.File(store_filepath, 'a') as store:
+
+        for probe in probes:
+
+            filepaths = lookup_all_files(directory, probe, 'magephem-t89q')
+            names, mtimes = _store_sources(filepaths)
+
+            group = store.get(probe)
+
+            # What is already in the store, if it was finished writing
+            if (group is not None and 'sources' in group
+                and group['time'].shape[0] == group.attrs.get('rows', -1)):
+                stored_names = group['sources']['name'][:]
+                stored_mtimes = group['sources']['mtime'][:]
+            else:
+                stored_names = None
+
+            n_stored = 0 if stored_names is None else len(stored_names)
+
+            # Nothing has changed
+            if (stored_names is not None and len(names) == n_stored
+                and np.array_equal(names, stored_names)
+                and np.array_equal(mtimes, stored_mtimes)):
+                status[probe] = 'current'
+                continue
+
+            # Only new files were added, try to add them to the end
+            if (stored_names is not None and 0 < n_stored < len(names)
+                and np.array_equal(names[:n_stored], stored_names)
+                and np.array_equal(mtimes[:n_stored], stored_mtimes)):
+
+                new_dict = _read_magephem_files(filepaths[n_stored:])
+                new_time = new_dict['time'].view(np.int64)
+
+                if len(new_time) > 0 and new_time[0] > group['time'][-1]:
+                    _append_to_store(group, new_dict, names[n_stored:],
+                                     mtimes[n_stored:])
+                    status[probe] = 'appended'
+                    continue
+
+            # Otherwise rebuild from all files
+            if probe in store:
+                del store[probe]
+            group = store.create_group(probe)
+            group.attrs['rows'] = 0
+
+            _append_to_store(group, _read_magephem_files(filepaths), names, mtimes)
+            status[probe] = 'rebuilt'
+
+    return status
+
+def _append_to_store(group:h5py.Group, ephemeris_dict:dict,
+                     names:np.ndarray, mtimes:np.ndarray):
+    """Append time sorted ephemeris to a probe group. The row count is
+    written last, so a partly written store is rebuilt on the next update."""
+
+    n_old = int(group.attrs['rows'])
+    time = ephemeris_dict['time'].astype('datetime64[ns]').view(np.int64)
+    n_new = n_old + len(time)
+
+    append_to_dataset(group, 'time', time)
+    for column in magephem_columns[1:]:
+        append_to_dataset(group, column, ephemeris_dict[column])
+
+    # Time at the start of each chunk, used to find rows without reading
+    #...the whole time column
+    first_chunk = -(-n_old // chunk_rows)
+    chunk_starts = np.arange(first_chunk * chunk_rows, n_new, chunk_rows)
+    append_to_dataset(group, 'chunk_time', time[chunk_starts - n_old])
+
+    sources = group.require_group('sources')
+    append_to_dataset(sources, 'name', names)
+    append_to_dataset(sources, 'mtime', mtimes)
+
+    group.attrs['rows'] = n_new
+
+def read_magephem_store(probe:str, start:np.datetime64=None, end:np.datetime64=None,
+                        store_filepath:str=magephem_store_filepath,
+                        columns:list=magephem_columns) -> dict:
+    """Function to read ephemeris from the store for a time range. Only
+    the chunks that cover the range are read and decompressed.
+    INPUT
+    probe - rbspa or rbspb
+    start - read times at or after this, if None from start of mission
+    end - read times at or before this, if None to end of mission
+    store_filepath - where the store is
+    columns - which columns to read
+    OUTPUT
+    ephemeris_dict - dictionary of arrays, time is datetime64[ns]
+    """
+
+    with h5py.File(store_filepath, 'r') as store:
+
+        group = store[probe]
+        n_rows = int(group.attrs['rows'])
+
+        # Rows within the chunks that cover the range
+        chunk_time = group['chunk_time'][:] if n_rows > 0 else np.array([], dtype=np.int64)
+        row_low, row_high = 0, n_rows
+        if start is not None:
+            start = np.datetime64(start, 'ns').astype(np.int64)
+            chunk_i = max(np.searchsorted(chunk_time, start, side='right') - 1, 0)
+            row_low = chunk_i * chunk_rows
+        if end is not None:
+            end = np.datetime64(end, 'ns').astype(np.int64)
+            chunk_i = np.searchsorted(chunk_time, end, side='right')
+            row_high = min(chunk_i * chunk_rows, n_rows)
+        row_high = max(row_high, row_low)
+
+        # Then the exact rows from the times
+        time = group['time'][row_low:row_high]
+        low = 0 if start is None else np.searchsorted(time, start, side='left')
+        high = len(time) if end is None else np.searchsorted(time, end, side='right')
+
+        ephemeris_dict = {}
+        for column in columns:
+            if column == 'time':
+                ephemeris_dict[column] = time[low:high].view('datetime64[ns]')
+            else:
+                ephemeris_dict[column] = group[column][row_low + low:row_low + high]
+
+    return ephemeris_dict
+
+def write_quiet_time_location(h5_file:h5py.File, event:datetime, probe:str,
+                              location_dict:dict):
+    """Function to add the probe locations during a quiet period to the
+    quiet time location file. Rows are appended to column datasets and
+    indexed by event and probe, see h5_functions.
+    INPUT
+    h5_file - the h5 file to write to
+    event - start of quiet period
+    probe - rbspa or rbspb
+    location_dict - dictionary with the magephem_columns for the period
+    OUTPUT
+    Writes to h5 file. Otherwise raises error.
+    """
+
+    columns = dict(location_dict)
+
+    # h5 doesn't have a datetime type, so store as ns since 1970
+    columns['time'] = np.asarray(columns['time'], dtype='datetime64[ns]').view(np.int64)
+
+    append_columns_to_h5(h5_file, columns, event.isoformat(), probe)
+
+def iter_quiet_time_locations(filepath:str=quiet_time_location_filepath,
+                              columns:list=magephem_columns,
+                              probe:str=None):
+    """Function to read the quiet time location file one event and probe
+    at a time, so only the columns that are needed are ever in memory.
+    INPUT
+    filepath - quiet time location file
+    columns - which columns to read
+    probe - only read this probe, if None read both
+    OUTPUT
+    yields event, probe and a dictionary of the columns, time is datetime64[ns]
+    """
+
+    # Big chunk cache so neighbouring events don't decompress the same chunk again
+    with h5py.File(filepath, 'r', rdcc_nbytes=64*1024**2) as h5_file:
+
+        index_dict = read_index_from_h5(h5_file)
+
+        for event, event_probe, offset, count in zip(index_dict['event'],
+                                                     index_dict['probe'],
+                                                     index_dict['offset'],
+                                                     index_dict['count']):
+
+            if probe is not None and event_probe != probe:
+                continue
+
+            rows = slice(offset, offset + count)
+            location_dict = {c : h5_file[c][rows] for c in columns}
+
+            if 'time' in location_dict:
+                location_dict['time'] = location_dict['time'].view('datetime64[ns]')
+
+            yield datetime.fromisoformat(event), event_probe, location_dict
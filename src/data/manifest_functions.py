@@ -0,0 +1,112 @@
+""" Functions to keep a run manifest, a small json file that records which
+units of work a long run has finished so it can be restarted where it stopped.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from datetime import datetime, timezone
+import hashlib
+import json
+import logging
+import os
+
+# Function to write files without leaving partial ones
+from src.data.cache_functions import atomic_write
+
+
+def config_hash(config:dict) -> str:
+    """Function to get a hash of the settings that change the output of a run.
+    INPUT
+    config - dictionary of settings, values must be json serializable
+    OUTPUT
+    hash - hex digest of the settings
+    """
+
+    config_text = json.dumps(config, sort_keys=True, default=str)
+
+    return hashlib.sha1(config_text.encode('utf-8')).hexdigest()
+
+def new_run_manifest(config:dict, output:str) -> dict:
+    """Function to create an empty manifest for a run.
+    INPUT
+    config - dictionary of settings that change the output
+    output - where the run writes its output
+    OUTPUT
+    manifest - dictionary with config, config_hash, output, index_rows,
+               completed and failed
+    """
+
+    return {'config' : config,
+            'config_hash' : config_hash(config),
+            'output' : output,
+            'started' : datetime.now(timezone.utc).isoformat(),
+            'updated' : None,
+            'finished' : False,
+            'index_rows' : 0,
+            'completed' : {},
+            'failed' : {}}
+
+def load_run_manifest(manifest_filepath:str, config:dict, output:str) -> dict:
+    """Function to load the manifest of a previous run so it can be resumed.
+    INPUT
+    manifest_filepath - where the manifest is saved
+    config - dictionary of settings for this run
+    output - where this run writes its output
+    OUTPUT
+    manifest - manifest of previous run, None if there isn't one or it was
+               for different settings or output. The reason is logged.
+    """
+
+    if not os.path.exists(manifest_filepath):
+        logging.info(f'No manifest at {manifest_filepath}.')
+        return None
+
+    try:
+        with open(manifest_filepath, 'r') as handle:
+            manifest = json.load(handle)
+    except Exception as e:
+        logging.warning(f'Unable to read manifest {manifest_filepath}.'
+                        f' Returned error {e}.')
+        return None
+
+    if manifest.get('output') != output:
+        logging.warning(f'Manifest {manifest_filepath} is for {manifest.get("output")},'
+                        f' not {output}.')
+        return None
+
+    if manifest.get('config_hash') != config_hash(config):
+        old_config = manifest.get('config', {})
+        changed = sorted(key for key in set(config) | set(old_config)
+                         if config_hash({key : config.get(key)})
+                         != config_hash({key : old_config.get(key)}))
+        logging.warning(f'Manifest {manifest_filepath} was made with different'
+                        f' settings: {changed}.')
+        return None
+
+    return manifest
+
+def save_run_manifest(manifest_filepath:str, manifest:dict):
+    """Function to save a manifest, see atomic_write.
+    INPUT
+    manifest_filepath - where to save the manifest
+    manifest - manifest to save
+    OUTPUT
+    none
+    """
+
+    manifest['updated'] = datetime.now(timezone.utc).isoformat()
+
+    with atomic_write(manifest_filepath, 'w') as handle:
+        json.dump(manifest, handle, indent=1)
+
+def unit_key(*parts) -> str:
+    """Function to turn the parts identifying a unit of work into a key.
+    INPUT
+    parts - values identifying the unit, e.g. event and probe
+    OUTPUT
+    key - string key
+    """
+
+    return '/'.join(str(p) for p in parts)
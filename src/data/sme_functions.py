@@ -4,10 +4,79 @@
 science@rileytroyer.com
 """
 
-from datetime import datetime
+import itertools
 import numpy as np
+import os
 from scipy.ndimage import uniform_filter1d
 
+from src.data.cache_functions import disk_cache_load, disk_cache_save
+
+def components_to_datetime64(year:np.ndarray, month:np.ndarray, day:np.ndarray,
+                             hour:np.ndarray, minute:np.ndarray,
+                             second:np.ndarray) -> np.ndarray:
+    """Function to build datetime64 timestamps from arrays of date
+    components without creating any python datetimes.
+    INPUT
+    year, month, day, hour, minute, second - integer arrays
+    OUTPUT
+    dates - datetime64[s] array
+    """
+
+    months = (year - 1970)*12 + (month - 1)
+    dates = (months.astype('datetime64[M]').astype('datetime64[D]')
+             + (day - 1).astype('timedelta64[D]'))
+
+    seconds = hour*3600 + minute*60 + second
+
+    return dates.astype('datetime64[s]') + seconds.astype('timedelta64[s]')
+
+def sme_read_raw(filepath:str, skiprows:int=105,
+                 use_cache:bool=True) -> 'np.ndarray, np.ndarray':
+    """Function to read in downloaded SME data without smoothing.
+    Numeric columns are parsed straight into integer arrays and a
+    binary copy is saved next to the raw file (filepath + .npz) so
+    reading the file again is almost instant.
+    INPUT
+    filepath - filepath where the sme datafile is stored.
+    skiprows - number of header lines in the file
+    use_cache - whether to read and write the binary copy
+    OUTPUT
+    sme - sme data.
+    sme_dates - datetime64[s] timestamp of each sme value
+    """
+
+    cache_dir, cache_key = os.path.split(filepath)
+    file_stat = os.stat(filepath)
+
+    # Use binary copy if it was made from this version of the file
+    if use_cache:
+        cache_dict = disk_cache_load(cache_dir, cache_key)
+        if (cache_dict is not None
+            and cache_dict['source_mtime'] == file_stat.st_mtime
+            and cache_dict['source_size'] == file_stat.st_size):
+            return cache_dict['sme'], cache_dict['sme_dates']
+
+    # Read in date and sme columns as integers
+    sme_data = np.loadtxt(filepath, dtype=np.int64, skiprows=skiprows,
+                          usecols=range(7), ndmin=2)
+
+    # Parse out datetimes
+    sme_dates = components_to_datetime64(*sme_data[:, 0:6].T)
+
+    # Get the SME data
+    sme = sme_data[:, 6]
+
+    if use_cache:
+        try:
+            disk_cache_save(cache_dir, cache_key,
+                            {'sme' : sme, 'sme_dates' : sme_dates,
+                             'source_mtime' : np.float64(file_stat.st_mtime),
+                             'source_size' : np.int64(file_stat.st_size)})
+        except OSError:
+            pass
+
+    return sme, sme_dates
+
 def sme_read_process(filepath:str, smooth_size:int=6) -> 'np.ndarray, np.ndarray':
     """Function to read in downloaded SME data and smooth it
     using a basic rolling average scipy uniform_filter1D.
@@ -16,22 +85,267 @@ def sme_read_process(filepath:str, smooth_size:int=6) -> 'np.ndarray, np.ndarray
     smooth_size - how big should the smoothing window be
     OUTPUT
     sme - smoothed sme data.
-    sme_dates - timestamp of each sme value
+    sme_dates - datetime64[s] timestamp of each sme value
     """
     
     # Read in a file
-    sme_data = np.loadtxt(filepath, dtype='str', skiprows=105)
-    
-    # Parse out datetimes
-    sme_dates = np.array([datetime(int(d[0]), int(d[1]), int(d[2]),
-                             int(d[3]), int(d[4]), int(d[5]))
-                         for d in sme_data])
-
-    # Get the SME data
-    sme = sme_data[:, 6].astype(int)
+    sme, sme_dates = sme_read_raw(filepath)
 
     # Smooth SME
-    sme = uniform_filter1d(sme, size=6)
+    sme = uniform_filter1d(sme, size=smooth_size)
     #sme = savgol_filter(sme, 7, 4)
     
-    return sme, sme_dates
\ No newline at end of file
+    return sme, sme_dates
+
+def _sme_raw_chunks(filepath:str, chunk_size:int,
+                    skiprows:int=105) -> 'np.ndarray, np.ndarray':
+    """Generator of unsmoothed SME chunks from a single file. Uses the
+    binary copy if there is an up to date one, otherwise parses the text
+    file chunk_size lines at a time."""
+
+    cache_dir, cache_key = os.path.split(filepath)
+    file_stat = os.stat(filepath)
+
+    cache_dict = disk_cache_load(cache_dir, cache_key)
+    if (cache_dict is not None
+        and cache_dict['source_mtime'] == file_stat.st_mtime
+        and cache_dict['source_size'] == file_stat.st_size):
+
+        for i in range(0, len(cache_dict['sme']), chunk_size):
+            yield (cache_dict['sme'][i:i+chunk_size],
+                   cache_dict['sme_dates'][i:i+chunk_size])
+        return
+
+    with open(filepath, 'r') as handle:
+
+        # Skip the header
+        for _ in itertools.islice(handle, skiprows):
+            pass
+
+        while True:
+            lines = list(itertools.islice(handle, chunk_size))
+            if len(lines) == 0:
+                return
+
+            sme_data = np.loadtxt(lines, dtype=np.int64, usecols=range(7), ndmin=2)
+
+            yield sme_data[:, 6], components_to_datetime64(*sme_data[:, 0:6].T)
+
+def sme_read_stream(filepaths:list, smooth_size:int=6,
+                    chunk_size:int=100000) -> 'np.ndarray, np.ndarray':
+    """Generator to read many SME files as one continuous smoothed series
+    in chunks. Only a few samples are carried between chunks for the
+    smoothing window, so memory doesn't grow with the number of files, and
+    smoothing across file boundaries uses the real neighbouring values.
+    INPUT
+    filepaths - sme datafiles in time order, with no gaps between files
+    smooth_size - how big should the smoothing window be
+    chunk_size - how many samples to read at a time
+    OUTPUT
+    yields sme - smoothed sme data for chunk.
+           sme_dates - datetime64[s] timestamp of each sme value
+    """
+
+    # Samples needed before and after a point for smoothing
+    left = smooth_size//2
+    right = smooth_size - 1 - left
+
+    # Raw samples kept from the last chunk, those from pending_start
+    #...on haven't been returned yet
+    sme_buffer = np.zeros(0, dtype=np.int64)
+    dates_buffer = np.zeros(0, dtype='datetime64[s]')
+    pending_start = 0
+
+    for filepath in filepaths:
+        for sme, sme_dates in _sme_raw_chunks(filepath, chunk_size):
+
+            sme_buffer = np.concatenate((sme_buffer, sme))
+            dates_buffer = np.concatenate((dates_buffer, sme_dates))
+
+            # Only points with a full window on the right are final
+            emit_end = max(pending_start, len(sme_buffer) - right)
+
+            if emit_end > pending_start:
+                sme_smooth = uniform_filter1d(sme_buffer, size=smooth_size)
+                yield (sme_smooth[pending_start:emit_end],
+                       dates_buffer[pending_start:emit_end])
+
+            # Keep enough samples for the left side of the window
+            keep_start = max(emit_end - left, 0)
+            sme_buffer = sme_buffer[keep_start:]
+            dates_buffer = dates_buffer[keep_start:]
+            pending_start = emit_end - keep_start
+
+    # Last few points are smoothed at the true end of the data
+    if len(sme_buffer) > pending_start:
+        sme_smooth = uniform_filter1d(sme_buffer, size=smooth_size)
+        yield sme_smooth[pending_start:], dates_buffer[pending_start:]
+
+def sme_find_quiet_times(sme, sme_dates, quiet_threshold=150,
+                         high_threshold=250, min_length=10):
+    """Function to find quiet times with no injection as seen in the
+    SME data. This is defined as when SME is less than threshold.
+    Everything is done with array operations on runs of quiet samples.
+    INPUT
+    sme
+        type: array of ints
+        about: sme values
+    sme_dates
+        type: array of datetimes or datetime64
+        about: datetimes associated with each sme value
+    quiet_threshold=150:
+        type: int
+        about: below this is considered quiet time
+    high_threshold=250:
+        type: int
+        about: above this is considered most likely injection
+    min_length=10:
+        type: int
+        about: quiet periods with fewer samples than this are ignored
+    OUTPUT
+    quiet_times
+        type: list of lists
+        about: quiet start, quiet end, injection start, injection length
+               and quiet period length (s) of each quiet time period
+
+    """
+
+    sme = np.asarray(sme)
+    sme_dates = np.asarray(sme_dates)
+    n = len(sme)
+
+    # Find runs where sme is below threshold
+    low = np.concatenate(([False], sme < quiet_threshold, [False]))
+    edges = np.flatnonzero(low[1:] != low[:-1])
+    run_starts = edges[0::2]
+    run_ends = edges[1::2] - 1
+
+    # Remove if period is less than specified length
+    long_runs = (run_ends - run_starts + 1) >= min_length
+    run_starts = run_starts[long_runs]
+    run_ends = run_ends[long_runs]
+
+    if len(run_starts) == 0:
+        return []
+
+    # Number of high samples before each index
+    high = sme >= high_threshold
+    high_count = np.concatenate(([0], np.cumsum(high)))
+
+    # Remove if no higher SME since the end of the last period.
+    # Samples between an earlier rejected period and the last accepted
+    # period are all below high_threshold, so only the samples since
+    # the end of the previous long period need to be checked.
+    window_starts = np.concatenate(([0], run_ends[:-1]))
+    accepted = high_count[run_ends] - high_count[window_starts] > 0
+
+    run_starts = run_starts[accepted]
+    run_ends = run_ends[accepted]
+
+    if len(run_starts) == 0:
+        return []
+
+    # Search window for each injection is from end of last accepted period
+    prev_ends = np.concatenate(([0], run_ends[:-1]))
+
+    # Windows are back to back, so label every sample with its window
+    window_len = run_ends - prev_ends
+    labels = np.repeat(np.arange(len(run_ends)), window_len)
+    sample_i = np.arange(prev_ends[0], run_ends[-1])
+
+    # First index of the peak value in each window
+    window_max = np.maximum.reduceat(sme[prev_ends[0]:run_ends[-1]],
+                                     prev_ends - prev_ends[0])
+    is_peak = sme[sample_i] == window_max[labels]
+    peak_i = sample_i[is_peak]
+    peak_labels = labels[is_peak]
+    first_peak = np.concatenate(([True], peak_labels[1:] != peak_labels[:-1]))
+    peak_index = peak_i[first_peak]
+
+    # Injection start is the last sample below high threshold before the peak
+    last_non_active = np.maximum.accumulate(np.where(high, -1, np.arange(n)))
+    injection_start_index = last_non_active[np.maximum(peak_index - 1, 0)]
+    no_start = (peak_index == prev_ends) | (injection_start_index < prev_ends)
+    injection_start_index = np.where(no_start, 2*prev_ends, injection_start_index)
+
+    # Lengths in seconds
+    dates_us = sme_dates.astype('datetime64[us]').astype(np.int64)
+    injection_len = (dates_us[run_starts] - dates_us[injection_start_index])/1e6
+    quiet_period_len = (dates_us[run_ends] - dates_us[run_starts])/1e6
+
+    # Get first and last index and pull datetime from this
+    quiet_times = [list(row) for row in zip(sme_dates[run_starts],
+                                            sme_dates[run_ends],
+                                            sme_dates[injection_start_index],
+                                            injection_len.tolist(),
+                                            quiet_period_len.tolist())]
+    
+    return quiet_times
+
+def sme_find_quiet_times_stream(sme_chunks, quiet_threshold=150,
+                                high_threshold=250, min_length=10):
+    """Generator to find quiet times from a stream of SME chunks, so quiet
+    periods and injections that cross chunk or file boundaries are found.
+    Gives the same periods as sme_find_quiet_times on the whole series.
+    Only samples since the end of the last long quiet period are kept.
+    INPUT
+    sme_chunks
+        type: iterable of (sme, sme_dates)
+        about: consecutive chunks of sme values and their datetimes
+    quiet_threshold, high_threshold, min_length
+        about: same as sme_find_quiet_times
+    OUTPUT
+    yields quiet_time
+        type: list
+        about: quiet start, quiet end, injection start, injection length
+               and quiet period length (s), as soon as it is final
+    """
+
+    sme_buffer = None
+    dates_buffer = None
+
+    for sme, sme_dates in sme_chunks:
+
+        if sme_buffer is None:
+            sme_buffer, dates_buffer = np.asarray(sme), np.asarray(sme_dates)
+        else:
+            sme_buffer = np.concatenate((sme_buffer, sme))
+            dates_buffer = np.concatenate((dates_buffer, sme_dates))
+
+        if len(sme_buffer) == 0:
+            continue
+
+        # A quiet run at the end of the buffer might keep going in the next chunk
+        low = sme_buffer < quiet_threshold
+        final_end = len(sme_buffer)
+        if low[-1]:
+            not_low = np.flatnonzero(~low)
+            final_end = not_low[-1] + 1 if len(not_low) > 0 else 0
+
+        # Find long quiet runs that are finished
+        final_low = np.concatenate(([False], low[:final_end], [False]))
+        edges = np.flatnonzero(final_low[1:] != final_low[:-1])
+        run_lengths = edges[1::2] - edges[0::2]
+        long_run_ends = edges[1::2][run_lengths >= min_length] - 1
+
+        if len(long_run_ends) == 0:
+            continue
+
+        for quiet_time in sme_find_quiet_times(sme_buffer[:final_end],
+                                               dates_buffer[:final_end],
+                                               quiet_threshold=quiet_threshold,
+                                               high_threshold=high_threshold,
+                                               min_length=min_length):
+            yield quiet_time
+
+        # Everything before the last long quiet period end is no longer needed
+        sme_buffer = sme_buffer[long_run_ends[-1]:]
+        dates_buffer = dates_buffer[long_run_ends[-1]:]
+
+    # Whatever is left is finished
+    if sme_buffer is not None and len(sme_buffer) > 0:
+        for quiet_time in sme_find_quiet_times(sme_buffer, dates_buffer,
+                                               quiet_threshold=quiet_threshold,
+                                               high_threshold=high_threshold,
+                                               min_length=min_length):
+            yield quiet_time
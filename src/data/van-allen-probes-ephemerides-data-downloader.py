@@ -6,16 +6,21 @@ science@rileytroyer.com
 
 ####################### Initialize Program #######################
 # Libraries
-from bs4 import BeautifulSoup
 from datetime import datetime
 import logging
 import numpy as np
 import multiprocessing
 import os
-import requests
+from pathlib import Path
+import sys
 import wget
 
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
 
+# Function to get links from directory listings
+from src.data.download_functions import get_url_paths
 
 # Initiate logging
 logging.basicConfig(filename = f'logs/van-allen-probes-ephemerides-download-{datetime.today().date()}.log',
@@ -28,37 +33,6 @@ logging.basicConfig(filename = f'logs/van-allen-probes-ephemerides-download-{dat
 
 
 ####################### Local Functions #######################
-def get_url_paths(url, ext='', params={}):
-    """ Function to extract file names from https directory
-    Gets files in url directory with ext extension
-    Does this by parsing the html text from the webpage. I did not
-    write this function. Requires libraries requests,
-    bs4.BeautifulSoup
-    DEPENDENCIES
-        bs4.BeautifulSoup, requests
-    INPUT
-    url
-        type: string
-        about: url of directory to get files from
-    ext
-        type: string
-        about: extension of the files
-    OUTPUT
-    parent
-        type: list
-        about: list of all file pathnames within directory
-    """
-
-    response = requests.get(url, params=params)
-    if response.ok:
-        response_text = response.text
-    else:
-        return response.raise_for_status()
-    soup = BeautifulSoup(response_text, 'html.parser')
-    parent = [url + node.get('href') for node in soup.find_all('a')
-            if node.get('href').endswith(ext)]
-    return parent
-
 def download_rbsp_files(year:int):
     """Function to download all the magnetic ephemeris data from 
     the Van Allen probes for a list of years and the specified
@@ -12,17 +12,69 @@ import os
 from scipy.ndimage.filters import uniform_filter1d
 from scipy.signal import savgol_filter
 
+from src.data.cache_functions import make_cache_key
+from src.data.cache_functions import memory_cache_get, memory_cache_put
+from src.data.cache_functions import disk_cache_load, disk_cache_save
+from src.data.file_index_functions import lookup_file
 
-def read_rbsp_sheath_corrected_psd(file_name:str) -> 'np.ndarray x 8, str':
+# Default number of records power is smoothed over
+default_smooth_size = 6
+
+
+class NoDataError(Exception):
+    """There isn't data for a day, either a no data file exists or a data
+    file hasn't been downloaded. Unlike errors reading a file, this only
+    changes when the files for the day change."""
+
+def _varget_records(cdf_file:cdflib.CDF, variable:str,
+                    start_rec:int, end_rec:int) -> np.ndarray:
+    """Read records start_rec up to end_rec of a variable, all if end_rec is None."""
+
+    if end_rec is None:
+        return cdf_file.varget(variable, startrec=start_rec)
+
+    # cdflib can't read zero records, and its end record is inclusive
+    if end_rec <= start_rec:
+        return cdf_file.varget(variable, startrec=0, endrec=0)[0:0]
+
+    return cdf_file.varget(variable, startrec=start_rec, endrec=end_rec - 1)
+
+def find_cdf_records(file_name:str, start_time:datetime,
+                     end_time:datetime) -> 'int, int, int':
+    """Function to find which records of a cdf file are within a time range.
+    Only the Epoch variable is read.
+    INPUT
+    file_name - name of file, needs to be a .cdf file
+    start_time - first time to include
+    end_time - last time to include
+    OUTPUT
+    start_rec - first record at or after start_time
+    end_rec - one past the last record at or before end_time
+    n_records - how many records are in the file
+    """
+
+    cdf_file = cdflib.CDF(file_name)
+
+    ut_time = cdflib.cdfepoch.to_datetime(cdf_file.varget('Epoch'))
+
+    start_rec = int(np.searchsorted(ut_time, np.datetime64(start_time), side='left'))
+    end_rec = int(np.searchsorted(ut_time, np.datetime64(end_time), side='right'))
+
+    return start_rec, max(end_rec, start_rec), len(ut_time)
+
+def read_rbsp_sheath_corrected_psd(file_name:str, start_rec:int=0,
+                                   end_rec:int=None) -> 'np.ndarray x 8, str':
     """Function to read in a Van Allen EMFISIS sheath corrected 
     datafile and convert the data to numpy arrays
     INPUT
     file_name - name of file, needs to be a .cdf file
+    start_rec - first record to read
+    end_rec - one past the last record to read, None reads to end of file
     OUTPUT
-    ut_time -  datetimes for each data point
+    ut_time -  datetime64 for each data point
     freq - requencies for each data point
-    b_power - total magnetic field power values for each data point
-    e_power - total sheath corrected electric field power values for each data point
+    b_power - total magnetic field power values for each data point, (time x freq)
+    e_power - total sheath corrected electric field power values for each data point, (time x freq)
     density - electron density measurements
     l, mlt, mlat - locations of instruments
     instrument - which instrument data is from
@@ -32,24 +84,24 @@ def read_rbsp_sheath_corrected_psd(file_name:str) -> 'np.ndarray x 8, str':
     
     # Get the time and frequency data
     freq = cdf_file.varget('WFR_frequencies')
-    time = cdf_file.varget('Epoch')
-    #...convert time to datetime format
-    ut_time = cdflib.cdfepoch.to_datetime(time).astype(datetime)
+    time = _varget_records(cdf_file, 'Epoch', start_rec, end_rec)
+    #...convert time to datetime64 format
+    ut_time = cdflib.cdfepoch.to_datetime(time).astype('datetime64[us]')
     
-    # Get the total power data
-    b_power = np.transpose(cdf_file.varget('bsum'))
-    e_power = np.transpose(cdf_file.varget('esum'))
+    # Get the total power data, kept as (time x freq)
+    b_power = _varget_records(cdf_file, 'bsum', start_rec, end_rec)
+    e_power = _varget_records(cdf_file, 'esum', start_rec, end_rec)
     
     # Electric field has noise at 1781hz and 3555hz
-    e_power[(freq==3555)|(freq==1781), :] = -1e31
+    e_power[:, (freq==3555)|(freq==1781)] = -1e31
     
     # Get density data
-    density = cdf_file.varget('density')
+    density = _varget_records(cdf_file, 'density', start_rec, end_rec)
     
     # Get L, MLT, and MLAT
-    l = cdf_file.varget('l')
-    mlt = cdf_file.varget('mlt')
-    mlat = cdf_file.varget('maglat')
+    l = _varget_records(cdf_file, 'l', start_rec, end_rec)
+    mlt = _varget_records(cdf_file, 'mlt', start_rec, end_rec)
+    mlat = _varget_records(cdf_file, 'maglat', start_rec, end_rec)
     
     # # Get additional information, like instrument
     # instrument = cdf_file.globalattsget()['Source_name']
@@ -57,94 +109,282 @@ def read_rbsp_sheath_corrected_psd(file_name:str) -> 'np.ndarray x 8, str':
     
     return ut_time, freq, b_power, e_power, density, l, mlt, mlat#, instrument
 
-def read_rbsp_emfisis_b_field(file_name:str) -> "np.ndarray, np.ndarray":
+def read_rbsp_emfisis_b_field(file_name:str, start_rec:int=0,
+                              end_rec:int=None) -> "np.ndarray, np.ndarray":
     """Function to read in a Van Allen L3 EMFISIS datafile and
     retrieve the magnetic b_field strength from it.
     INPUT
     file_name- name of file, needs to be a .cdf file
+    start_rec - first record to read
+    end_rec - one past the last record to read, None reads to end of file
     OUTPUT
-    ut_time - datetimes for each data point
+    ut_time - datetime64 for each data point
     b_field_mag - magnetic b_field magnitude for each data point
     """
     
     cdf_file = cdflib.CDF(file_name)
     
     # Get the time and magnetic b_field data
-    time = cdf_file.varget('Epoch')
-    #...convert time to datetime format
-    ut_time = cdflib.cdfepoch.to_datetime(time).astype(datetime)
+    time = _varget_records(cdf_file, 'Epoch', start_rec, end_rec)
+    #...convert time to datetime64 format
+    ut_time = cdflib.cdfepoch.to_datetime(time).astype('datetime64[us]')
 
     
     # Get the magnetic b_field magnitude
-    b_field_mag = cdf_file.varget('Magnitude')
+    b_field_mag = _varget_records(cdf_file, 'Magnitude', start_rec, end_rec)
     
     return ut_time, b_field_mag
 
+def rbsp_day_fingerprint(probe:str, date:datetime, psd_save_dir:str,
+                         mag_save_dir:str) -> 'str, float, str, float':
+    """Function to find the files for a day of EMFISIS data and when they
+    were last changed. Together these identify the input data for the day.
+    INPUT
+    probe - which probe to get data for rbspa or rbspb
+    date - date to get data for
+    psd_save_dir - where are wave power data files stored
+    mag_save_dir - where are magnetic field power data files stored
+    OUTPUT
+    psd_filepath, psd_mtime - sheath corrected L4 wave power file and its modification time
+    mag_filepath, mag_mtime - L3 magnetometer file and its modification time
+    Raises NoDataError if there isn't data for the day.
+    """
+
+    # Check if a no data file for density exists    
+    if lookup_file(psd_save_dir, probe, 'nodata', date) is not None:
+        raise NoDataError(f'File for {date} and {probe} does not exist')
+    
+    # Get sheath corrected e field psd file
+    psd_filepath = lookup_file(psd_save_dir, probe, 'l4-sheath-corrected-e', date)
+    if psd_filepath is None:
+        raise NoDataError(f'No sheath corrected file for {date} and {probe}.')
+    
+    # Get b-field mag (for gyrofrequency) file
+    mag_filepath = lookup_file(mag_save_dir, probe, 'l3-mag-4sec-gei', date)
+    if mag_filepath is None:
+        raise NoDataError(f'No magnetometer file for {date} and {probe}.')
+
+    return (psd_filepath, os.path.getmtime(psd_filepath),
+            mag_filepath, os.path.getmtime(mag_filepath))
+
 def read_process_rbsp_data(probe:str, date:datetime,
                            psd_save_dir:str,
-                           mag_save_dir:str) -> 'np.ndarray x 10':
+                           mag_save_dir:str,
+                           cache_max_bytes:int=2*1024**3,
+                           cache_dir:str=None,
+                           start_time:datetime=None,
+                           end_time:datetime=None,
+                           smooth_size:int=default_smooth_size,
+                           cache_day:bool=True) -> 'np.ndarray x 10':
     """ Function to read and return smoothed b-field and wave power data
-    from EMFISIS instruments. Also returns associated time and location of spacecraft
+    from EMFISIS instruments. Also returns associated time and location of spacecraft.
+    Decoded and smoothed data for each day is cached in memory and optionally
+    on disk, keyed by probe, date and file modification times. If a time
+    window is given and the day isn't in a cache, only the records in the
+    window are read when both caches are off or cache_day is False.
     INPUT
     probe - which probe to get data for rbspa or rbspb
     date - date to get data for
     psd_save_dir - where are wave power data files stored
     mag_save_dir - where are magnetic field power data files stored
+    cache_max_bytes - largest size of the in memory cache, 0 turns it off
+    cache_dir - directory for the on disk cache, None turns it off
+    start_time, end_time - time window that is needed, datetime or datetime64,
+                           None for whole day
+    smooth_size - number of records to smooth power over
+    cache_day - False if no other event needs this day, so a cache miss only
+                reads the window and doesn't add the day to the caches
     OUTPUT
-    ut_time - times of measurements
+    ut_time - times of measurements, datetime64
     freq - frequency bins of psd
-    b_power - magnetic field power measurements
-    e_power - electric field power measurments
+    b_power - magnetic field power measurements, (time x freq)
+    e_power - electric field power measurments, (time x freq)
     density - electron density measurements
     ut_time_b_mag - times associated with magnetic field measurements
     b_mag - magnetic field measurements
     l, mlt, mlat - locations of instruments
+    Cached arrays are shared between calls so shouldn't be modified in place.
     """ 
     
-    # Check if a no data file for density exists    
-    if os.path.exists(psd_save_dir + f'nodata-{date}-{probe}'):
-        raise Exception(f'File for {date} and {probe} does not exist')
-    
-    else: 
-        # Get sheath corrected e field psd data
-        e_corrected_filebase = ('rbsp-' + probe[-1].lower()
-                                + '_wna-survey-sheath-corrected-e_emfisis-L4_'
-                                + str(date.year) + str(date.month).zfill(2) 
-                                + str(date.day).zfill(2))
+    # Files for day, raises error if there aren't any
+    (psd_filepath, psd_mtime,
+     mag_filepath, mag_mtime) = rbsp_day_fingerprint(probe, date, psd_save_dir,
+                                                     mag_save_dir)
+
+    # Files are identified by probe, date and when they were last changed,
+    #...smoothed data also depends on the smoothing size
+    cache_key = make_cache_key('time-major', probe, str(date),
+                               psd_filepath, psd_mtime,
+                               mag_filepath, mag_mtime, smooth_size)
 
-        # All of the density files
-        psd_files = os.listdir(psd_save_dir)
+    # Check memory and then disk for already decoded data
+    day_dict = memory_cache_get('rbsp-day', cache_key)
 
-        # Find just the density file we need
-        psd_filename = [f for f in psd_files if e_corrected_filebase in f][0]
+    if day_dict is None and cache_dir is not None:
+        day_dict = disk_cache_load(cache_dir, cache_key)
 
-        # Read in psd data
-        (ut_time, freq,
-         b_power, e_power,
-         density, l, mlt, mlat) = read_rbsp_sheath_corrected_psd(psd_save_dir + psd_filename)
+        if day_dict is not None and cache_max_bytes > 0:
+            memory_cache_put('rbsp-day', cache_key, day_dict, cache_max_bytes)
 
-        if len(density) < 1:
-            raise Exception(f'Not enough density data for {date} and {probe}.')
+    # If the day won't be used again there is no reason to read all of it
+    window_only = (start_time is not None and end_time is not None
+                   and (not cache_day or (cache_max_bytes <= 0 and cache_dir is None)))
+
+    if day_dict is None and window_only:
+        day_dict = _read_process_rbsp_day(psd_filepath, mag_filepath,
+                                          start_time, end_time, smooth_size)
+
+    elif day_dict is None:
+        day_dict = _read_process_rbsp_day(psd_filepath, mag_filepath,
+                                          smooth_size=smooth_size)
+
+        if cache_max_bytes > 0:
+            memory_cache_put('rbsp-day', cache_key, day_dict, cache_max_bytes)
+
+        if cache_dir is not None:
+            disk_cache_save(cache_dir, cache_key, day_dict)
+
+    if len(day_dict['density']) < 1:
+        raise Exception(f'Not enough density data for {date} and {probe}.')
     
-    # Read in b-field mag (for gyrofrequency) files
-    mag_files = os.listdir(mag_save_dir)
+    return (day_dict['ut_time'], day_dict['freq'],
+            day_dict['b_power'], day_dict['e_power'], day_dict['density'],
+            day_dict['ut_time_b_mag'], day_dict['b_mag'],
+            day_dict['l'], day_dict['mlt'], day_dict['mlat'])
+
+def _read_process_rbsp_day(psd_filepath:str, mag_filepath:str,
+                           start_time:datetime=None,
+                           end_time:datetime=None,
+                           smooth_size:int=default_smooth_size) -> dict:
+    """ Function to decode and smooth a single day of EMFISIS data.
+    INPUT
+    psd_filepath - sheath corrected L4 wave power file
+    mag_filepath - L3 magnetometer file
+    start_time, end_time - only read records in this window, None for whole day
+    smooth_size - number of records to smooth power over
+    OUTPUT
+    day_dict - dictionary with the same arrays read_process_rbsp_data returns
+    """
+
+    if start_time is None or end_time is None:
+        psd_records = (0, None)
+        mag_records = (0, None)
+        keep = slice(None)
+
+    else:
+        start_rec, end_rec, n_records = find_cdf_records(psd_filepath,
+                                                         start_time, end_time)
+
+        # Read a few extra records either side so smoothing
+        #...is the same as for the whole day
+        halo = smooth_size//2 + 1
+        psd_records = (max(start_rec - halo, 0), min(end_rec + halo, n_records))
+        keep = slice(start_rec - psd_records[0], end_rec - psd_records[0])
 
-    # This is the file we want
-    mag_filebase = ('rbsp-' + probe[-1].lower() 
-                    + '_magnetometer_4sec-gei_emfisis-L3_'
-                    + str(date.year) + str(date.month).zfill(2) 
-                    + str(date.day).zfill(2))
+        mag_records = find_cdf_records(mag_filepath, start_time, end_time)[0:2]
 
-    # Get the specific filename
-    mag_filename = [f for f in mag_files if mag_filebase in f][0]
+    # Read in psd data
+    (ut_time, freq,
+     b_power, e_power,
+     density, l, mlt, mlat) = read_rbsp_sheath_corrected_psd(psd_filepath,
+                                                             *psd_records)
 
-    # Smooth power over 6 min
-    b_power = uniform_filter1d(b_power, size=6, axis=1)
-    e_power = uniform_filter1d(e_power, size=6, axis=1)
-    #power = savgol_filter(power, window_length=7, polyorder=3, axis=1)
+    # Smooth power, 6 records is 6 min
+    if len(density) > 0:
+        b_power = uniform_filter1d(b_power, size=smooth_size, axis=0)
+        e_power = uniform_filter1d(e_power, size=smooth_size, axis=0)
+        #power = savgol_filter(power, window_length=7, polyorder=3, axis=0)
 
     # Read in the B-b_field data
     (ut_time_b_mag,
-     b_mag) = read_rbsp_emfisis_b_field(mag_save_dir + mag_filename)
-    
-    return ut_time, freq, b_power, e_power, density, ut_time_b_mag, b_mag, l, mlt, mlat
\ No newline at end of file
+     b_mag) = read_rbsp_emfisis_b_field(mag_filepath, *mag_records)
+
+    return {'ut_time' : ut_time[keep], 'freq' : freq,
+            'b_power' : b_power[keep], 'e_power' : e_power[keep],
+            'density' : density[keep], 'ut_time_b_mag' : ut_time_b_mag,
+            'b_mag' : b_mag, 'l' : l[keep], 'mlt' : mlt[keep], 'mlat' : mlat[keep]}
+
+def read_process_rbsp_event(probe:str, dates:list,
+                            psd_save_dir:str, mag_save_dir:str,
+                            start_time:datetime, end_time:datetime,
+                            cache_max_bytes:int=2*1024**3,
+                            cache_dir:str=None,
+                            smooth_size:int=default_smooth_size,
+                            shared_dates:set=None) -> 'dict, dict':
+    """ Function to read the EMFISIS data for an event that may span
+    several days. Each day is cut down to the event times first and the
+    days are then joined with a single copy.
+    INPUT
+    probe - which probe to get data for rbspa or rbspb
+    dates - dates in the event
+    psd_save_dir - where are wave power data files stored
+    mag_save_dir - where are magnetic field power data files stored
+    start_time, end_time - only keep data between these times, inclusive
+    cache_max_bytes - largest size of the in memory cache, 0 turns it off
+    cache_dir - directory for the on disk cache, None turns it off
+    smooth_size - number of records to smooth power over
+    shared_dates - dates other events also need, only these are added to
+                   the caches and others only read the event window.
+                   None to treat every date as shared.
+    OUTPUT
+    event_dict - dictionary with ut_time (datetime64), freq, b_power, e_power, density,
+                 ut_time_b_mag, b_mag, l, mlt and mlat for the event.
+                 None if no day could be read.
+    missing - dictionary of date -> error for each day that couldn't be read
+    """
+
+    psd_keys = ['ut_time', 'b_power', 'e_power', 'density', 'l', 'mlt', 'mlat']
+
+    start_time = np.datetime64(start_time, 'us')
+    end_time = np.datetime64(end_time, 'us')
+    b_keys = ['ut_time_b_mag', 'b_mag']
+
+    day_dicts = []
+    missing = {}
+
+    for date in dates:
+
+        try:
+            (ut_time, freq,
+             b_power, e_power, density,
+             ut_time_b_mag, b_mag,
+             l, mlt, mlat) = read_process_rbsp_data(probe, date,
+                                                    psd_save_dir, mag_save_dir,
+                                                    cache_max_bytes, cache_dir,
+                                                    start_time, end_time,
+                                                    smooth_size,
+                                                    shared_dates is None
+                                                    or date in shared_dates)
+        except Exception as e:
+            missing[date] = e
+            continue
+
+        # Only keep data within event times
+        psd_selector = (ut_time >= start_time) & (ut_time <= end_time)
+        b_field_selector = (ut_time_b_mag >= start_time) & (ut_time_b_mag <= end_time)
+
+        day_dict = {'freq' : freq,
+                    'ut_time' : ut_time[psd_selector],
+                    'b_power' : b_power[psd_selector],
+                    'e_power' : e_power[psd_selector],
+                    'density' : density[psd_selector],
+                    'l' : l[psd_selector],
+                    'mlt' : mlt[psd_selector],
+                    'mlat' : mlat[psd_selector],
+                    'ut_time_b_mag' : ut_time_b_mag[b_field_selector],
+                    'b_mag' : b_mag[b_field_selector]}
+
+        day_dicts.append(day_dict)
+
+    if len(day_dicts) == 0:
+        return None, missing
+
+    # Join all the days at once, frequencies are from the first day
+    event_dict = {'freq' : day_dicts[0]['freq']}
+    for key in psd_keys + b_keys:
+        if len(day_dicts) == 1:
+            event_dict[key] = day_dicts[0][key]
+        else:
+            event_dict[key] = np.concatenate([d[key] for d in day_dicts], axis=0)
+
+    return event_dict, missing
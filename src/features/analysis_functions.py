@@ -10,12 +10,12 @@ from matplotlib import cm
 from matplotlib import pyplot as plt
 from matplotlib import colors as mcolors
 from matplotlib import ticker
+import multiprocessing
 import numpy as np
 import pickle
 from scipy.stats import pearsonr
 import scipy.stats as stats
 import statsmodels.graphics.gofplots as sm
-from sklearn.utils import resample
 
 def log_log_transformation(distribution:np.ndarray) -> 'np.ndarray, float':
 
@@ -58,88 +58,228 @@ def mean_of_distribution_transform(distribution:np.ndarray) -> 'float, float, fl
 
     return value, error_low, error_high
 
+def _bin_index(x:np.ndarray, bin_edges:np.ndarray) -> np.ndarray:
+    """Which bin each value is in, bins include their left edge.
+    Values outside of all bins are -1."""
+
+    n_bins = len(bin_edges) - 1
+    spacing = np.diff(bin_edges[:n_bins])
+
+    # Evenly spaced bins, only the last can be a different size,
+    #...can be found by division instead of a search
+    if n_bins > 1 and np.all(np.isfinite(spacing)) and np.all(spacing == spacing[0]) and spacing[0] > 0:
+        with np.errstate(invalid='ignore'):
+            guess = np.floor((x - bin_edges[0])/spacing[0])
+        guess = np.clip(np.nan_to_num(guess), 0, n_bins - 1).astype(np.intp)
+
+        # Correct for rounding
+        bin_i = guess - (x < bin_edges[guess]) + (x >= bin_edges[guess + 1])
+    else:
+        bin_i = np.searchsorted(bin_edges, x, side='right') - 1
+
+    bin_i[(bin_i < 0) | (bin_i >= n_bins) | ~(x == x)] = -1
+
+    return bin_i
+
+def _segment_median(values:np.ndarray, start:np.ndarray,
+                    n:np.ndarray) -> np.ndarray:
+    """Median of sorted segments values[..., start:start+n] along the
+    last axis, nan if n is 0."""
+
+    length = values.shape[-1]
+
+    if length == 0:
+        return np.full(values.shape[:-1] + (len(start),), np.nan)
+
+    lo = np.clip(start + (n - 1)//2, 0, length - 1)
+    hi = np.clip(start + n//2, 0, length - 1)
+
+    return np.where(n > 0, (values[..., lo] + values[..., hi])/2, np.nan)
+
+def _segment_sum(values:np.ndarray, start:np.ndarray,
+                 count:np.ndarray) -> np.ndarray:
+    """Sum of contiguous segments values[..., start:start+count] along
+    the last axis, segments must cover all of values in order."""
+
+    sums = np.zeros(values.shape[:-1] + (len(count),))
+    filled = np.flatnonzero(count > 0)
+    if len(filled) > 0:
+        sums[..., filled] = np.add.reduceat(values, start[filled], axis=-1)
+
+    return sums
+
+def _grouped_peak(values:np.ndarray, start:np.ndarray,
+                  count:np.ndarray) -> 'np.ndarray, np.ndarray, np.ndarray':
+    """mean_of_distribution_transform for every bin at once. values must be
+    grouped by bin along the last axis and sorted within each bin with nan last."""
+
+    length = values.shape[-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        # Log transform, then shift each bin above zero by its smallest
+        #...value and log transform again
+        log_values = np.log10(values)
+        if length > 0:
+            scale1 = np.abs(log_values[..., np.minimum(start, length - 1)]) + 1
+        else:
+            scale1 = np.full(values.shape[:-1] + (len(count),), np.nan)
+        transformed = np.log10(log_values + np.repeat(scale1, count, axis=-1))
+
+        # Normal fit is the mean and standard deviation
+        mean = _segment_sum(transformed, start, count)/count
+        residual = transformed - np.repeat(mean, count, axis=-1)
+        std = np.sqrt(_segment_sum(residual**2, start, count)/count)
+
+        # Back to original distribution
+        def detransformed(value):
+            return 10**(10**(value) - scale1)
+
+        error = std/np.sqrt(count)
+
+        return detransformed(mean), detransformed(mean - error), detransformed(mean + error)
+
+def _group_by_bin(x:np.ndarray, bin_edges:np.ndarray) -> 'np.ndarray, np.ndarray, np.ndarray':
+    """Indices of values in bins grouped by bin, and where each bin
+    starts and how many values it has once grouped."""
+
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    n_bins = len(bin_edges) - 1
+
+    bin_i = _bin_index(np.asarray(x), bin_edges)
+    in_bins = np.flatnonzero(bin_i >= 0)
+    bin_i = bin_i[in_bins]
+
+    count = np.bincount(bin_i, minlength=n_bins)
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+
+    # Small integers use a linear time sort
+    small_dtype = np.int16 if n_bins < 2**15 else np.int32
+    order = in_bins[np.argsort(bin_i.astype(small_dtype), kind='stable')]
+
+    return order, start, count
+
+def _sort_in_bins(values:np.ndarray, start:np.ndarray,
+                  count:np.ndarray) -> np.ndarray:
+    """Sort values grouped by bin within each bin, nan is put at the end."""
+
+    for n in np.flatnonzero(count > 1):
+        values[start[n]:start[n] + count[n]].sort()
+
+    return values
+
+def bin_statistics(x:np.ndarray, columns:dict, bin_edges:np.ndarray) -> dict:
+    """Function to get statistics of many columns in bins of x in a single
+    pass. x is binned once, each column is sorted once within the bins and
+    the statistics for every bin are then found with grouped reductions.
+    Nan values are ignored, like np.nanmedian, except for the geometric
+    and peak statistics which are nan if there is a nan in the bin, like
+    stats.gmean.
+    INPUT
+    x - value to bin by, e.g. delay
+    columns - dictionary of arrays to get statistics of, same length as x
+    bin_edges - edges of the bins, bins include their left edge,
+                use np.inf as the last edge for an open ended last bin
+    OUTPUT
+    stats_dict - dictionary with a dictionary for each column of
+                 count - number of values in each bin
+                 finite_count - number of values that aren't nan
+                 median, q1, q3 - median and median of the values below
+                                  and above it
+                 mean, std - mean and standard deviation
+                 gmean, gstd - geometric mean and standard deviation
+                 peak - same as mean_of_distribution_transform
+                 and <method>_low, <method>_high for each method - error
+                 bounds of the median (q1, q3), mean (+- std), gmean (/* gstd)
+                 and peak (standard error), so every method is used the same way
+    """
+
+    # Bin once for all columns
+    order, start, count = _group_by_bin(x, bin_edges)
+
+    stats_dict = {}
+
+    for name, values in columns.items():
+
+        values = _sort_in_bins(np.asarray(values, dtype=float)[order],
+                               start, count)
+
+        finite = ~np.isnan(values)
+        finite_count = _segment_sum(finite, start, count).astype(int)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+
+            # Median and median of values on either side of it
+            median = _segment_median(values, start, finite_count)
+            repeat_median = np.repeat(median, count)
+            n_below = _segment_sum(values < repeat_median, start, count).astype(int)
+            n_above = _segment_sum(values > repeat_median, start, count).astype(int)
+            q1 = _segment_median(values, start, n_below)
+            q3 = _segment_median(values, start + finite_count - n_above, n_above)
+
+            # Mean and standard deviation of finite values
+            finite_values = np.where(finite, values, 0)
+            mean = _segment_sum(finite_values, start, count)/finite_count
+            residual = np.where(finite, values - np.repeat(mean, count), 0)
+            std = np.sqrt(_segment_sum(residual**2, start, count)/finite_count)
+
+            # Geometric mean and standard deviation of all values
+            log_values = np.log(values)
+            log_mean = _segment_sum(log_values, start, count)/count
+            log_residual = log_values - np.repeat(log_mean, count)
+            gstd = np.exp(np.sqrt(_segment_sum(log_residual**2, start, count)
+                                  /(count - 1)))
+            gmean = np.exp(log_mean)
+            gstd[count < 2] = np.nan
+
+            # Most likely value from log-log transform of each bin
+            peak, peak_low, peak_high = _grouped_peak(values, start, count)
+
+            stats_dict[name] = {'count' : count,
+                                'finite_count' : finite_count,
+                                'median' : median,
+                                'q1' : q1,
+                                'q3' : q3,
+                                'mean' : mean,
+                                'std' : std,
+                                'gmean' : gmean,
+                                'gstd' : gstd,
+                                'peak' : peak,
+                                'median_low' : q1,
+                                'median_high' : q3,
+                                'mean_low' : mean - std,
+                                'mean_high' : mean + std,
+                                'gmean_low' : gmean/gstd,
+                                'gmean_high' : gmean*gstd,
+                                'peak_low' : peak_low,
+                                'peak_high' : peak_high}
+
+    return stats_dict
+
 def average_bins(delay:np.ndarray, chorus:np.ndarray, method:str='peak',
                  bin_size:int=10, cutoff:float=10**-7):
     """Function to take large arrays of delays and chorus integration
-    and get averages over delay bins.
+    and get averages over delay bins. The last bin includes all
+    delays after it. Uses bin_statistics, see it for details.
+    method can be median (with quartiles), mean (+- std),
+    gmean (/* gstd) or peak (with standard error).
     """
     
     # Average altitudes up to 5 hour after
     delay_bins = np.arange(0, 5*60*60, bin_size*60)
-    chorus_bins = np.zeros(len(delay_bins))
-    chorus_bins_q1 = np.zeros(len(delay_bins))
-    chorus_bins_q3 = np.zeros(len(delay_bins))
+    bin_edges = np.append(delay_bins, np.inf)
 
-    statistics = np.zeros(len(delay_bins))
+    bin_dict = bin_statistics(delay, {'chorus' : chorus}, bin_edges)['chorus']
 
-    def avg_func(data, method='median'):
+    # If no data for bin make undefined
+    few = bin_dict['count'] < 2
+    chorus_bins = np.where(few, np.nan, bin_dict[method])
+    chorus_bins_q1 = np.where(few, np.nan, bin_dict[method + '_low'])
+    chorus_bins_q3 = np.where(few, np.nan, bin_dict[method + '_high'])
 
-        if method=='median':
-            return np.nanmedian(data)
-        if method=='mean':
-            return np.nanmean(data)
-        if method=='gmean':
-            return stats.gmean(data)
-        if method=='peak':
-            value, error_low, error_high = mean_of_distribution_transform(data)
-            return value, error_low, error_high
+    # How much data in bin
+    statistics = np.where(few, 0, bin_dict['finite_count']).astype(float)
 
-    # Loop through each bin and average
-    for n, delay_bin in enumerate(delay_bins):
-
-        # For last bin average all the rest
-        if n == len(delay_bins)-1:
-            chorus_bin = chorus[delay >= delay_bin]
-
-        else:
-            chorus_bin = chorus[(delay >= delay_bin) 
-                                & (delay < delay_bin + bin_size*60)]
-            
-        # Remove data that wouldn't be considered chorus waves
-        #cutoff = 10**-8.5
-        #cutoff = 10**-7
-        #chorus_bin = chorus_bin[chorus_bin > cutoff]
-        # Remove the lowest half of data
-        #chorus_bin = chorus_bin[chorus_bin > np.nanmedian(chorus_bin)]
-        
-        # If no data for bin make undefined
-        if len(chorus_bin) < 2:
-            chorus_bins[n] = np.nan
-            chorus_bins_q1[n] = np.nan
-            chorus_bins_q3[n] = np.nan
-            continue
-        
-        # How much data in bin
-        statistics[n] = len(chorus_bin[np.isfinite(chorus_bin)])
-        
-        # Set values where statistics indicate less than 3 events to nan
-        min_stat = ((bin_size*60)/6) * 0
-        if statistics[n] < min_stat:
-            chorus_bins[n] = np.nan
-            chorus_bins_q1[n] = np.nan
-            chorus_bins_q3[n] = np.nan
-            continue
-
-        chorus_bins[n], chorus_bins_q1[n], chorus_bins_q3[n]  = avg_func(chorus_bin, method=method)
-
-        if method=='median':
-            # Get 1st (25%) quartile
-            chorus_bins_q1[n] = np.nanmedian(chorus_bin[chorus_bin 
-                                                        < np.nanmedian(chorus_bin)])
-            # Get 3rd (75%) quartile
-            chorus_bins_q3[n] = np.nanmedian(chorus_bin[chorus_bin 
-                                                        > np.nanmedian(chorus_bin)])
-
-        if method=='mean':
-            # Get standard deviation
-            chorus_bins_q1[n] = chorus_bins[n] - np.nanstd(chorus_bin)
-            chorus_bins_q3[n] = chorus_bins[n] + np.nanstd(chorus_bin)
-   
-        if method=='gmean':
-            # Get geometric mean
-            chorus_bins_q1[n] = chorus_bins[n]/stats.gstd(chorus_bin)
-            chorus_bins_q3[n] = chorus_bins[n]*stats.gstd(chorus_bin)
-            
     return delay_bins, chorus_bins, chorus_bins_q1, chorus_bins_q3, statistics
 
 def create_chorus_selector(chorus:np.ndarray, lbc:np.ndarray, ubc:np.ndarray,
@@ -222,38 +362,219 @@ def create_plotting_data(delay:np.ndarray, chorus:np.ndarray,
     
     return return_dict
 
-def bootstrap_slope_error(x:np.ndarray, y:np.ndarray, n_samples:int) -> float:
+def _bootstrap_slopes(x:np.ndarray, y:np.ndarray, seed:np.random.SeedSequence,
+                      n_samples:int, max_elements:int) -> np.ndarray:
+    """Slopes of n_samples resamplings of x and y, drawn max_elements
+    indices at a time."""
+
+    rng = np.random.default_rng(seed)
+    n = len(x)
+    rows = max(1, max_elements//max(n, 1))
+
+    slopes = np.zeros(n_samples)
+
+    for start in range(0, n_samples, rows):
+        stop = min(start + rows, n_samples)
+
+        # Indices for each resampling, with replacement
+        index = rng.integers(0, n, size=(stop - start, n))
+        sample_x = x[index]
+        sample_y = y[index]
+
+        # Least squares slope from the sums of each resampling
+        sample_x = sample_x - sample_x.mean(axis=1, keepdims=True)
+        sample_y = sample_y - sample_y.mean(axis=1, keepdims=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slopes[start:stop] = (np.sum(sample_x*sample_y, axis=1)
+                                  /np.sum(sample_x*sample_x, axis=1))
+
+    return slopes
+
+def _bootstrap_slopes_unpack(args:tuple) -> np.ndarray:
+    """_bootstrap_slopes with a single argument for pool.map"""
+    return _bootstrap_slopes(*args)
+
+def bootstrap_slope_error(x:np.ndarray, y:np.ndarray, n_samples:int,
+                          seed:int=None, max_elements:int=2**22,
+                          num_workers:int=1) -> float:
     """ Function to calculate the error in a slope
     estimated via a linear regression using the bootstrap method. 
     Resample data many times and find the slope each time.
     Standard deviations in these slopes will be the error.
-    Requires sklearn.utils.resample
+    Resamplings are drawn as blocks of indices and the slopes of a whole
+    block are found at once from the regression sums.
     INPUT
     x - independent variable
     y - dependent variable
     n_samples -  number of resamplings to perform
+    seed - seed for the random numbers, same seed gives the same result
+           for any num_workers
+    max_elements - most resampled values to hold in memory at once per worker
+    num_workers - number of processes to split resamplings over
     OUTPUT
     std - standard deviation in the slope
     """
-    
-    # Array to store slopes in
-    sampled_slopes = np.zeros(n_samples)
 
-    for i in range(n_samples):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
 
-        # Resample data
-        new_x, new_y = resample(x, y, #n_samples=int(len(y)/2),
-                                replace=True)
+    # Split resamplings into blocks, each with its own random numbers
+    #...so the result doesn't depend on how they are run
+    rows = max(1, max_elements//max(len(x), 1))
+    blocks = [(start, min(start + rows, n_samples))
+              for start in range(0, n_samples, rows)]
+    seeds = np.random.SeedSequence(seed).spawn(len(blocks))
+    tasks = [(x, y, block_seed, stop - start, max_elements)
+             for (start, stop), block_seed in zip(blocks, seeds)]
 
-        # Get slope
-        slope, intercept, r_value, p_value, std_err = stats.linregress(new_x, new_y)
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.get_context('spawn').Pool(processes=num_workers) as pool:
+            sampled_slopes = pool.map(_bootstrap_slopes_unpack, tasks)
+    else:
+        sampled_slopes = [_bootstrap_slopes_unpack(task) for task in tasks]
+
+    sampled_slopes = np.concatenate(sampled_slopes) if sampled_slopes else np.zeros(0)
 
-        # Write to array
-        sampled_slopes[i] = slope
-        
     # # Get the confidence interval of the distribution
     # confidence = 0.95
     # low, high = np.sort(sampled_slopes)[[int(len(sampled_slopes)*1-confidence),
     #                                      int(len(sampled_slopes)*confidence)]]
         
-    return np.std(sampled_slopes)
\ No newline at end of file
+    return np.std(sampled_slopes)
+
+def _replicate_statistic(values:np.ndarray, start:np.ndarray, count:np.ndarray,
+                         statistic:str) -> np.ndarray:
+    """Statistic of each bin for each row of values, values must be
+    grouped by bin along the last axis and sorted within each bin."""
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if statistic == 'median':
+            return _segment_median(values, start, count)
+        if statistic == 'mean':
+            return _segment_sum(values, start, count)/count
+        if statistic == 'gmean':
+            return np.exp(_segment_sum(np.log(values), start, count)/count)
+        if statistic == 'peak':
+            return _grouped_peak(values, start, count)[0]
+
+    raise ValueError(f'Unknown statistic {statistic}.')
+
+def bootstrap_bins(x:np.ndarray, values:np.ndarray, bin_edges:np.ndarray,
+                   statistic:str='median', n_samples:int=1000,
+                   confidence:float=0.95, seed=None,
+                   max_elements:int=2**22) -> dict:
+    """Function to get bootstrap confidence intervals of a statistic in
+    bins of x. Values are resampled with replacement within each bin.
+    Values are sorted within bins once, then each resampling is a row of
+    indices into them. Sorting a row of indices also sorts the values
+    within every bin, so the statistic of every bin of many resamplings
+    is found at once.
+    INPUT
+    x - value to bin by, e.g. delay
+    values - values to get statistic of, nan values are ignored
+    bin_edges - edges of the bins, bins include their left edge,
+                use np.inf as the last edge for an open ended last bin
+    statistic - median, mean, gmean or peak
+    n_samples - number of resamplings to perform
+    confidence - fraction of resamplings within the confidence interval
+    seed - seed for the random numbers
+    max_elements - most resampled values to hold in memory at once
+    OUTPUT
+    bootstrap_dict - dictionary with bin_edges, count (finite values in
+                     each bin), value (statistic of the data), low and high
+                     (confidence interval) and std (standard deviation of
+                     the resampled statistic). Bins with less than 2
+                     values are nan.
+    """
+
+    x = np.asarray(x)
+    values = np.asarray(values, dtype=float)
+    bin_edges = np.asarray(bin_edges, dtype=float)
+
+    # Only resample finite values
+    finite = np.isfinite(values)
+    x, values = x[finite], values[finite]
+
+    # Group and sort within bins once
+    order, start, count = _group_by_bin(x, bin_edges)
+    values = _sort_in_bins(values[order], start, count)
+    length = len(values)
+
+    value = _replicate_statistic(values, start, count, statistic)
+
+    # Position of each grouped value and the start and size of its bin
+    #...smaller integers are faster to sort
+    index_dtype = np.int32 if length < 2**31 else np.int64
+    start_repeat = np.repeat(start, count).astype(index_dtype)
+    count_repeat = np.repeat(count, count)
+
+    rng = np.random.default_rng(seed)
+    rows = max(1, max_elements//max(length, 1))
+    replicates = np.zeros((n_samples, len(count)))
+
+    for first in range(0, n_samples, rows):
+        last = min(first + rows, n_samples)
+
+        # Random index within the bin of each position
+        index = start_repeat + (rng.random((last - first, length))
+                                *count_repeat).astype(index_dtype)
+
+        # Bins don't overlap so sorting whole rows sorts within bins
+        index.sort(axis=1)
+
+        replicates[first:last] = _replicate_statistic(values[index], start,
+                                                      count, statistic)
+
+    # Confidence interval from resampled statistics
+    with np.errstate(invalid='ignore'):
+        low, high = np.nanpercentile(replicates, [50*(1 - confidence),
+                                                  50*(1 + confidence)], axis=0)
+        std = np.nanstd(replicates, axis=0)
+
+    few = count < 2
+
+    return {'bin_edges' : bin_edges,
+            'count' : count,
+            'value' : np.where(few, np.nan, value),
+            'low' : np.where(few, np.nan, low),
+            'high' : np.where(few, np.nan, high),
+            'std' : np.where(few, np.nan, std)}
+
+def _bootstrap_bins_unpack(args:tuple) -> dict:
+    """bootstrap_bins with a single argument for pool.map"""
+    x, values, bin_edges, kwargs = args
+    return bootstrap_bins(x, values, bin_edges, **kwargs)
+
+def bootstrap_bins_sectors(sectors:dict, bin_edges:np.ndarray,
+                           statistic:str='median', n_samples:int=1000,
+                           confidence:float=0.95, seed:int=None,
+                           max_elements:int=2**22, num_workers:int=1) -> dict:
+    """Function to run bootstrap_bins for many sectors, e.g. each band,
+    MLT sector and L shell, optionally split over processes.
+    INPUT
+    sectors - dictionary of sector name -> (x, values)
+    bin_edges, statistic, n_samples, confidence, max_elements - same as
+                                                                bootstrap_bins
+    seed - seed for the random numbers, each sector gets its own so the
+           result doesn't depend on num_workers
+    num_workers - number of processes to split sectors over
+    OUTPUT
+    sector_dict - dictionary of sector name -> result of bootstrap_bins
+    """
+
+    names = list(sectors)
+    seeds = np.random.SeedSequence(seed).spawn(len(names))
+
+    tasks = [(sectors[name][0], sectors[name][1], bin_edges,
+              {'statistic' : statistic, 'n_samples' : n_samples,
+               'confidence' : confidence, 'seed' : sector_seed,
+               'max_elements' : max_elements})
+             for name, sector_seed in zip(names, seeds)]
+
+    if num_workers > 1 and len(tasks) > 1:
+        with multiprocessing.get_context('spawn').Pool(processes=num_workers) as pool:
+            results = pool.map(_bootstrap_bins_unpack, tasks)
+    else:
+        results = [_bootstrap_bins_unpack(task) for task in tasks]
+
+    return dict(zip(names, results))
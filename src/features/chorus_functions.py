@@ -0,0 +1,312 @@
+""" Functions to filter and integrate chorus wave power from EMFISIS spectra.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+
+# Fill value used in the EMFISIS L4 spectra for bad or removed data
+fill_value = -1e31
+
+# Electron gyrofrequency in Hz per nT of magnetic field
+fce_per_nt = 28
+
+# Lower and upper edge of each chorus band as fractions of fce
+default_band_fractions = {'lbc' : (0.1, 0.5),
+                          'ubc' : (0.5, 1.0)}
+
+
+def masked_simpson(y:np.ndarray, x:np.ndarray,
+                   mask:np.ndarray) -> 'np.ndarray, np.ndarray':
+    """Function to integrate every row of a (time x freq) grid with
+    Simpson's rule, only using the points selected by a per row mask.
+    This reproduces scipy.integrate.simpson (scipy >= 1.11) applied to
+    y[i, mask[i, :]] and x[mask[i, :]] for each row i.
+    INPUT
+    y - values to integrate, shape (time x freq)
+    x - frequencies of each column, shape (freq)
+    mask - boolean array of points to use in integration, shape (time x freq)
+    OUTPUT
+    result - integrated value for each row, shape (time)
+    n_points - how many points went into each integration, shape (time)
+    """
+
+    n_rows, n_cols = y.shape
+    n_points = np.sum(mask, axis=1)
+
+    result = np.zeros(n_rows)
+
+    if n_cols < 2:
+        return result, n_points
+
+    # Move selected points to the start of each row, keeping order
+    order = np.argsort(~mask, axis=1, kind='stable')
+    y_c = np.take_along_axis(y, order, axis=1)
+    x_c = x[order]
+
+    # Spacing between consecutive selected points
+    h = np.diff(x_c, axis=1).astype(float)
+
+    # Simpson's rule is done on the first m points, where m is odd
+    m = np.where(n_points % 2 == 0, n_points - 1, n_points)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        if n_cols >= 3:
+            # Irregularly spaced Simpson's rule for every pair of intervals
+            h0 = h[:, :-1]
+            h1 = h[:, 1:]
+            h_sum = h0 + h1
+            h_prod = h0 * h1
+            parabola = h_sum/6 * (y_c[:, :-2] * (2 - h1/h0)
+                                  + y_c[:, 1:-1] * h_sum**2/h_prod
+                                  + y_c[:, 2:] * (2 - h0/h1))
+
+            # Only use pairs that start on an even point and stay within m
+            start = np.arange(n_cols - 2)[np.newaxis, :]
+            use_pair = (start % 2 == 0) & (start + 2 <= m[:, np.newaxis] - 1)
+            result = np.sum(np.where(use_pair, parabola, 0), axis=1)
+
+            # Correct last interval when there are an even number of points
+            # following Cartwright, the same as scipy
+            correct = (n_points % 2 == 0) & (n_points >= 4)
+            last = np.clip(n_points - 1, 2, n_cols - 1)[:, np.newaxis]
+            y1 = np.take_along_axis(y_c, last, axis=1)[:, 0]
+            y2 = np.take_along_axis(y_c, last - 1, axis=1)[:, 0]
+            y3 = np.take_along_axis(y_c, last - 2, axis=1)[:, 0]
+            hm1 = np.take_along_axis(h, last - 1, axis=1)[:, 0]
+            hm2 = np.take_along_axis(h, last - 2, axis=1)[:, 0]
+
+            alpha = (2*hm1**2 + 3*hm2*hm1)/(6*(hm1 + hm2))
+            beta = (hm1**2 + 3*hm2*hm1)/(6*hm2)
+            eta = hm1**3/(6*hm2*(hm2 + hm1))
+            correction = alpha*y1 + beta*y2 - eta*y3
+            result = result + np.where(correct, correction, 0)
+
+        # Two points is just the trapezoid rule
+        trapezoid = 0.5 * h[:, 0] * (y_c[:, 0] + y_c[:, 1])
+        result = np.where(n_points == 2, trapezoid, result)
+
+    return result, n_points
+
+def low_density_mask(density:np.ndarray, l:np.ndarray,
+                     max_density:float=50) -> np.ndarray:
+    """Function to find timesteps where the electron density is low
+    enough to be outside the plasmasphere, based on Li et al. 2010.
+    INPUT
+    density - electron density in cm^-3 for each timestep
+    l - L shell for each timestep
+    max_density - density is never required to be lower than this
+    OUTPUT
+    mask - True where density is lower than the smaller of
+           10(6.6/L)^4 or max_density
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        small_den = 10*(6.6/np.asarray(l))**4
+
+    small_den = np.where(small_den > max_density, max_density, small_den)
+
+    # Written this way so nan values are kept, the same as before
+    return ~(np.asarray(density) > small_den)
+
+def interpolate_b_magnitude(time:np.ndarray, b_time:np.ndarray,
+                            b_mag:np.ndarray) -> np.ndarray:
+    """Function to linearly interpolate the magnetic field magnitude to
+    new times. Times outside the magnetic field data are extrapolated
+    from the first or last two points.
+    INPUT
+    time - times to get magnetic field at, datetime or datetime64
+    b_time - times of magnetic field measurements
+    b_mag - magnetic field magnitude measurements
+    OUTPUT
+    b_interp - magnetic field magnitude at each time
+    """
+
+    b_time = np.asarray(b_time, dtype='datetime64[us]')
+    time = np.asarray(time, dtype='datetime64[us]')
+    b_mag = np.asarray(b_mag, dtype=float)
+
+    if len(b_time) == 0:
+        return np.full(len(time), np.nan)
+
+    # Make sure magnetic field is in time order
+    if np.any(np.diff(b_time) < np.timedelta64(0)):
+        order = np.argsort(b_time, kind='stable')
+        b_time = b_time[order]
+        b_mag = b_mag[order]
+
+    # Seconds from the first measurement
+    x = (time - b_time[0]) / np.timedelta64(1, 's')
+    xp = (b_time - b_time[0]) / np.timedelta64(1, 's')
+
+    b_interp = np.interp(x, xp, b_mag)
+
+    # Extend the first and last slopes outside the data
+    if len(xp) > 1:
+        below = x < xp[0]
+        above = x > xp[-1]
+        b_interp[below] = (b_mag[0] + (x[below] - xp[0])
+                           * (b_mag[1] - b_mag[0])/(xp[1] - xp[0]))
+        b_interp[above] = (b_mag[-1] + (x[above] - xp[-1])
+                           * (b_mag[-1] - b_mag[-2])/(xp[-1] - xp[-2]))
+
+    return b_interp
+
+def integrate_chorus_bands(freq:np.ndarray, b_power:np.ndarray,
+                           e_power:np.ndarray, fce:np.ndarray,
+                           threshold:float=10**-7,
+                           band_fractions:dict=default_band_fractions) -> dict:
+    """Function to filter a whole event of chorus data to lower and upper
+    band chorus and integrate over each band in one pass.
+    INPUT
+    freq - frequency bins of psd
+    b_power - magnetic field power, shape (time x freq)
+    e_power - electric field power, shape (time x freq)
+    fce - electron gyrofrequency for each timestep, shape (time)
+    threshold = 10**-7 - magnetic psd threshold in nT^2/Hz from Hartley et al. 2019,
+                         None to not apply a threshold, see apply_chorus_threshold
+    band_fractions - dictionary of band -> (lower, upper) edge as fractions of fce
+    OUTPUT
+    band_dict - dictionary with integrated psd (b_lbc, e_lbc, b_ubc, e_ubc),
+                max psd (b_lbc_max, ...), whether the band passed the
+                threshold (lbc_chorus, ubc_chorus) and the magnetic max the
+                threshold is applied to (b_lbc_band_max, ...). Values are nan
+                where the band didn't pass the threshold or has no good data.
+    """
+
+    fce = np.asarray(fce, dtype=float)
+
+    # Band edges in Hz
+    band_edges = {band : (fce*low, fce*high)
+                  for band, (low, high) in band_fractions.items()}
+
+    # Which points are good data
+    b_good = b_power != fill_value
+    e_good = e_power != fill_value
+
+    band_dict = {}
+
+    for band, (low_freq, high_freq) in band_edges.items():
+
+        # Select the frequencies within band for each timestep
+        in_band = ((freq[np.newaxis, :] > low_freq[:, np.newaxis])
+                   & (freq[np.newaxis, :] < high_freq[:, np.newaxis]))
+
+        # Max of band including fill values, used for threshold
+        band_max = np.max(np.where(in_band, b_power, -np.inf), axis=1)
+
+        # Max of band for only good values
+        b_max = np.max(np.where(in_band & b_good, b_power, -np.inf), axis=1)
+        e_max = np.max(np.where(in_band & e_good, e_power, -np.inf), axis=1)
+
+        # Integrate over band frequencies
+        b_integrated, b_n = masked_simpson(b_power, freq, in_band & b_good)
+        e_integrated, e_n = masked_simpson(e_power, freq, in_band & e_good)
+
+        # Only keep if there is good data for both fields
+        valid = (np.sum(in_band, axis=1) > 0) & (b_n > 0) & (e_n > 0)
+
+        # and max magnetic chorus is > threshold
+        if threshold is None:
+            chorus = valid
+        else:
+            chorus = valid & (band_max >= threshold)
+
+        band_dict['b_' + band] = np.where(chorus, b_integrated, np.nan)
+        band_dict['e_' + band] = np.where(chorus, e_integrated, np.nan)
+        band_dict['b_' + band + '_max'] = np.where(chorus, b_max, np.nan)
+        band_dict['e_' + band + '_max'] = np.where(chorus, e_max, np.nan)
+        band_dict[band + '_chorus'] = chorus
+        band_dict['b_' + band + '_band_max'] = np.where(valid, band_max, np.nan)
+
+    return band_dict
+
+def apply_chorus_threshold(band_dict:dict, threshold:float,
+                           bands:tuple=tuple(default_band_fractions)) -> dict:
+    """Function to apply a threshold to band data after it has been
+    integrated, so one integration can be used for many thresholds.
+    The result is the same as integrate_chorus_bands with the threshold
+    as long as it is larger than the threshold band_dict was made with.
+    INPUT
+    band_dict - dictionary from integrate_chorus_bands or columns read
+                from chorus-delay-data.h5, needs b_lbc_band_max, ...
+    threshold - magnetic psd threshold in nT^2/Hz
+    bands - which bands to apply threshold to
+    OUTPUT
+    threshold_dict - copy of band_dict with values set to nan where the
+                     band didn't pass the threshold
+    """
+
+    threshold_dict = dict(band_dict)
+
+    for band in bands:
+
+        band_max = np.asarray(band_dict['b_' + band + '_band_max'])
+
+        # nan band max is never chorus
+        with np.errstate(invalid='ignore'):
+            chorus = band_max >= threshold
+
+        for key in ['b_' + band, 'e_' + band,
+                    'b_' + band + '_max', 'e_' + band + '_max']:
+            if key in band_dict:
+                threshold_dict[key] = np.where(chorus, band_dict[key], np.nan)
+
+        if band + '_chorus' in band_dict:
+            threshold_dict[band + '_chorus'] = chorus & np.asarray(band_dict[band + '_chorus'])
+
+    return threshold_dict
+
+def chorus_threshold_sweep(delay:np.ndarray, band_max:np.ndarray,
+                           thresholds:np.ndarray, bin_edges:np.ndarray) -> dict:
+    """Function to get how often chorus is seen in each delay bin for
+    many thresholds at once. Data is sorted once and each threshold is
+    then a binary search within each bin.
+    INPUT
+    delay - delay from start of quiet period for each timestep
+    band_max - magnetic max the threshold is applied to, e.g. b_lbc_band_max,
+               nan where there isn't good data
+    thresholds - magnetic psd thresholds in nT^2/Hz
+    bin_edges - edges of delay bins, bins include their left edge
+    OUTPUT
+    sweep_dict - dictionary with thresholds, bin_edges, counts (timesteps
+                 in each bin), chorus_counts (threshold x bin) and
+                 occurrence (chorus_counts/counts, nan for empty bins)
+    """
+
+    delay = np.asarray(delay, dtype=float)
+    band_max = np.asarray(band_max, dtype=float)
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=float))
+    bin_edges = np.asarray(bin_edges, dtype=float)
+    n_bins = len(bin_edges) - 1
+
+    # Which bin each timestep is in
+    bin_i = np.searchsorted(bin_edges, delay, side='right') - 1
+    in_bins = (bin_i >= 0) & (bin_i < n_bins)
+    bin_i = bin_i[in_bins]
+    band_max = band_max[in_bins]
+
+    counts = np.bincount(bin_i, minlength=n_bins)
+    n_valid = np.bincount(bin_i[np.isfinite(band_max)], minlength=n_bins)
+
+    # Sort by bin and then by band max, nan is put at the end of each bin
+    band_max = band_max[np.lexsort((band_max, bin_i))]
+    bin_starts = np.concatenate(([0], np.cumsum(counts)))
+
+    chorus_counts = np.zeros((len(thresholds), n_bins), dtype=int)
+
+    for n in range(n_bins):
+        values = band_max[bin_starts[n]:bin_starts[n] + n_valid[n]]
+        chorus_counts[:, n] = n_valid[n] - np.searchsorted(values, thresholds, side='left')
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        occurrence = np.where(counts > 0, chorus_counts/counts, np.nan)
+
+    return {'thresholds' : thresholds,
+            'bin_edges' : bin_edges,
+            'counts' : counts,
+            'chorus_counts' : chorus_counts,
+            'occurrence' : occurrence}
@@ -8,8 +8,26 @@ science@rileytroyer.com
 # Libraries
 from datetime import datetime
 import h5py
+import json
 import logging
+import os
 import numpy as np
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+# Function to read column h5 files
+from src.data.h5_functions import read_columns_from_h5, read_index_from_h5
+
+# Function to apply a different chorus threshold
+from src.features.chorus_functions import apply_chorus_threshold
+
+# Functions for the statistics cube
+from src.features.cube_functions import default_cube_edges, default_hist_edges
+from src.features.cube_functions import update_stats_cube
 
 
 # Initiate logging
@@ -38,30 +56,60 @@ if psd_type == 'integrated':
 if psd_type == 'max':
     extension = '_max'
 
-# Initialize lists to store data in
-mlt, l, mlat = [], [], []
-delay = []
-ubc_b, lbc_b = [], []
-ubc_e, lbc_e = [], []
-
-# Loop through each group (key) in h5 file and combine all data
-for n, group in enumerate(data_file):
-
-    # Read in data for a single event
-    event_data = data_file[group]
-
-    # Extend lists
-    mlt.extend(data_file[group]['mlt'])
-    l.extend(data_file[group]['l'])
-    mlat.extend(data_file[group]['mlat'])
-    delay.extend(data_file[group]['delay'])
-    ubc_b.extend(data_file[group]['b_ubc' + extension])
-    lbc_b.extend(data_file[group]['b_lbc' + extension])
-    ubc_e.extend(data_file[group]['e_ubc' + extension])
-    lbc_e.extend(data_file[group]['e_lbc' + extension])
-
-    if n%100 == 0:
-        logging.info(f'Finished with {n} of {len(data_file)} events.')
+# Threshold to apply to the data, None uses the one it was compiled with
+#...needs to be larger than that one
+threshold = None
+
+if data_file.attrs.get('layout') == 'columnar':
+
+    # Data is already stored as whole columns
+    column_dict = read_columns_from_h5(data_file, ['mlt', 'l', 'mlat', 'delay',
+                                                   'b_ubc' + extension, 'b_lbc' + extension,
+                                                   'e_ubc' + extension, 'e_lbc' + extension]
+                                       + (['b_ubc_band_max', 'b_lbc_band_max']
+                                          if threshold is not None else []))
+    if threshold is not None:
+        column_dict = apply_chorus_threshold(column_dict, threshold)
+
+    # Event and probe of the rows, used to update the statistics cube
+    index_dict = read_index_from_h5(data_file)
+    unit_keys = [f'{e}/{p}' for e, p in zip(index_dict['event'], index_dict['probe'])]
+    unit_counts = index_dict['count']
+
+    mlt, l, mlat = column_dict['mlt'], column_dict['l'], column_dict['mlat']
+    delay = column_dict['delay']
+    ubc_b, lbc_b = column_dict['b_ubc' + extension], column_dict['b_lbc' + extension]
+    ubc_e, lbc_e = column_dict['e_ubc' + extension], column_dict['e_lbc' + extension]
+
+else:
+    # Older files have a group for each event
+    # Initialize lists to store data in
+    mlt, l, mlat = [], [], []
+    delay = []
+    ubc_b, lbc_b = [], []
+    ubc_e, lbc_e = [], []
+    unit_keys, unit_counts = [], []
+
+    # Loop through each group (key) in h5 file and combine all data
+    for n, group in enumerate(data_file):
+
+        # Read in data for a single event
+        event_data = data_file[group]
+
+        # Extend lists
+        mlt.extend(data_file[group]['mlt'])
+        l.extend(data_file[group]['l'])
+        mlat.extend(data_file[group]['mlat'])
+        delay.extend(data_file[group]['delay'])
+        ubc_b.extend(data_file[group]['b_ubc' + extension])
+        lbc_b.extend(data_file[group]['b_lbc' + extension])
+        ubc_e.extend(data_file[group]['e_ubc' + extension])
+        lbc_e.extend(data_file[group]['e_lbc' + extension])
+        unit_keys.append(group)
+        unit_counts.append(len(data_file[group]['delay']))
+
+        if n%100 == 0:
+            logging.info(f'Finished with {n} of {len(data_file)} events.')
 
 # Convert to arrays and change nan to 0
 ubc_b = np.nan_to_num(ubc_b)
@@ -118,4 +166,28 @@ with h5py.File(f'data/processed/analysis-data-{psd_type}.h5', 'w') as h5f:
 
     h5f.attrs['Units'] = units
 
-logging.info(f'Finished. Data stored at: data/processed/analysis-data-{psd_type}.h5')
\ No newline at end of file
+logging.info(f'Finished. Data stored at: data/processed/analysis-data-{psd_type}.h5')
+
+# Update the statistics cube with any new events
+#...the cube is made again if the compiler settings changed
+cube_filepath = f'data/processed/analysis-cube-{psd_type}.h5'
+manifest_filepath = 'data/processed/chorus-delay-data.h5.manifest.json'
+if os.path.exists(manifest_filepath):
+    with open(manifest_filepath, 'r') as handle:
+        data_config_hash = json.load(handle)['config_hash']
+else:
+    data_config_hash = None
+
+cube_config = {'psd_type' : psd_type,
+               'data_config_hash' : data_config_hash,
+               'threshold' : threshold,
+               'columns' : ['ubc_b', 'lbc_b', 'chorus_b', 'ubc_e', 'lbc_e', 'chorus_e'],
+               'edges' : {axis : list(e) for axis, e in default_cube_edges.items()},
+               'hist_edges' : list(default_hist_edges)}
+
+cube, n_new = update_stats_cube(cube_filepath, cube_config, unit_keys, unit_counts,
+                                delay, mlt, l, mlat,
+                                {'ubc_b' : ubc_b, 'lbc_b' : lbc_b, 'chorus_b' : chorus_b,
+                                 'ubc_e' : ubc_e, 'lbc_e' : lbc_e, 'chorus_e' : chorus_e})
+
+logging.info(f'Added {n_new} events to statistics cube at: {cube_filepath}')
\ No newline at end of file
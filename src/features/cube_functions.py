@@ -0,0 +1,333 @@
+""" Functions to keep a cube of chorus statistics binned over delay, MLT,
+L and |MLAT|. Each cell stores counts, sums, sums of logs and a histogram
+of log values, so the statistics of any sector and delay binning can be
+found by adding cells instead of going through every measurement again.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import h5py
+import numpy as np
+import os
+
+# Functions to hash the settings and write the file
+from src.data.cache_functions import atomic_write
+from src.data.manifest_functions import config_hash
+
+# Cell edges, cells include their left edge. Delay is in seconds and
+#...the last delay cell includes everything after 5 hours like average_bins
+default_cube_edges = {'delay' : np.append(np.arange(0, 5*60*60, 5*60), np.inf),
+                      'mlt' : np.arange(0, 25, 1.0),
+                      'l' : np.append(np.arange(0, 8.5, 0.5), np.inf),
+                      'mlat' : np.append(np.arange(0, 22, 2.0), np.inf)}
+
+# Edges of histogram of log10 of values, values outside are put in the end bins
+default_hist_edges = np.arange(-14, 4.5, 0.5)
+
+# Sums kept for each cell
+cube_sums = ['sum', 'sum_sq', 'sum_log', 'sum_log_sq']
+
+
+def new_stats_cube(columns:list, edges:dict=default_cube_edges,
+                   hist_edges:np.ndarray=default_hist_edges) -> dict:
+    """Function to create an empty statistics cube.
+    INPUT
+    columns - names of value columns to keep statistics for
+    edges - dictionary of cell edges for delay, mlt, l and mlat (absolute value)
+    hist_edges - edges of histogram of log10 of values
+    OUTPUT
+    cube - dictionary with edges, hist_edges, units (keys of the data
+           already added) and a dictionary of arrays for each column
+    """
+
+    shape = tuple(len(edges[axis]) - 1 for axis in ['delay', 'mlt', 'l', 'mlat'])
+    n_hist = len(hist_edges) - 1
+
+    cube = {'edges' : {axis : np.asarray(e, dtype=float) for axis, e in edges.items()},
+            'hist_edges' : np.asarray(hist_edges, dtype=float),
+            'units' : [],
+            'columns' : {}}
+
+    for name in columns:
+        cube['columns'][name] = {'count' : np.zeros(shape, dtype=np.uint32),
+                                 'hist' : np.zeros(shape + (n_hist,), dtype=np.uint32)}
+        for sum_name in cube_sums:
+            cube['columns'][name][sum_name] = np.zeros(shape)
+
+    return cube
+
+def _cell_index(values:np.ndarray, edges:np.ndarray) -> np.ndarray:
+    """Which cell each value is in, -1 if it is outside all cells."""
+
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[(index >= len(edges) - 1) | ~np.isfinite(values)] = -1
+
+    return index
+
+def add_to_stats_cube(cube:dict, delay:np.ndarray, mlt:np.ndarray,
+                      l:np.ndarray, mlat:np.ndarray, values:dict):
+    """Function to add measurements to a statistics cube. Only values that
+    are finite and larger than zero are added, the same as
+    create_chorus_selector.
+    INPUT
+    cube - statistics cube from new_stats_cube
+    delay, mlt, l, mlat - location of each measurement
+    values - dictionary of value arrays, one for each column in cube
+    OUTPUT
+    Changes cube.
+    """
+
+    edges = cube['edges']
+    shape = next(iter(cube['columns'].values()))['count'].shape
+    n_cells = int(np.prod(shape))
+    hist_edges = cube['hist_edges']
+    n_hist = len(hist_edges) - 1
+
+    # Cell of each measurement, found once for all columns
+    index = [_cell_index(np.asarray(delay, dtype=float), edges['delay']),
+             _cell_index(np.asarray(mlt, dtype=float), edges['mlt']),
+             _cell_index(np.asarray(l, dtype=float), edges['l']),
+             _cell_index(np.abs(np.asarray(mlat, dtype=float)), edges['mlat'])]
+    in_cube = np.all([i >= 0 for i in index], axis=0)
+    cell = np.ravel_multi_index([i[in_cube] for i in index], shape)
+
+    for name, column in cube['columns'].items():
+
+        column_values = np.asarray(values[name], dtype=float)[in_cube]
+
+        # Only chorus measurements
+        good = np.isfinite(column_values) & (column_values > 0)
+        good_cell = cell[good]
+        good_values = column_values[good]
+        log_values = np.log10(good_values)
+
+        column['count'] += np.bincount(good_cell, minlength=n_cells).reshape(shape).astype(np.uint32)
+
+        for sum_name, weights in [('sum', good_values),
+                                  ('sum_sq', good_values**2),
+                                  ('sum_log', log_values),
+                                  ('sum_log_sq', log_values**2)]:
+            column[sum_name] += np.bincount(good_cell, weights=weights,
+                                            minlength=n_cells).reshape(shape)
+
+        # Histogram of log values
+        hist_i = np.clip(np.searchsorted(hist_edges, log_values, side='right') - 1,
+                         0, n_hist - 1)
+        column['hist'] += np.bincount(good_cell*n_hist + hist_i,
+                                      minlength=n_cells*n_hist).reshape(shape + (n_hist,)).astype(np.uint32)
+
+def save_stats_cube(cube:dict, cube_filepath:str, config:dict):
+    """Function to write a statistics cube to an h5 file, see atomic_write.
+    INPUT
+    cube - statistics cube
+    cube_filepath - where to save cube
+    config - settings the cube was made with, used to check if it can be updated
+    OUTPUT
+    Writes h5 file.
+    """
+
+    with atomic_write(cube_filepath, 'w+b') as handle, h5py.File(handle, 'w') as h5f:
+
+        h5f.attrs['config_hash'] = config_hash(config)
+
+        edges_group = h5f.create_group('edges')
+        for axis, edges in cube['edges'].items():
+            edges_group.create_dataset(axis, data=edges)
+        h5f.create_dataset('hist_edges', data=cube['hist_edges'])
+        h5f.create_dataset('units', data=np.array(cube['units'], dtype='S64'))
+
+        for name, column in cube['columns'].items():
+            group = h5f.create_group(name)
+            for key, data in column.items():
+                group.create_dataset(key, data=data, compression='gzip',
+                                     compression_opts=4, shuffle=True)
+
+def load_stats_cube(cube_filepath:str, config:dict=None) -> dict:
+    """Function to read a statistics cube from an h5 file.
+    INPUT
+    cube_filepath - where cube is saved
+    config - settings for the cube, if given the cube is only returned
+             if it was made with the same settings
+    OUTPUT
+    cube - statistics cube, None if there isn't one or the settings differ
+    """
+
+    if not os.path.exists(cube_filepath):
+        return None
+
+    with h5py.File(cube_filepath, 'r') as h5f:
+
+        if config is not None and h5f.attrs.get('config_hash') != config_hash(config):
+            return None
+
+        cube = {'edges' : {axis : h5f['edges'][axis][:] for axis in h5f['edges']},
+                'hist_edges' : h5f['hist_edges'][:],
+                'units' : list(h5f['units'][:].astype(str)),
+                'columns' : {}}
+
+        for name, group in h5f.items():
+            if isinstance(group, h5py.Group) and name != 'edges':
+                cube['columns'][name] = {key : group[key][:] for key in group}
+
+    return cube
+
+def update_stats_cube(cube_filepath:str, config:dict, unit_keys:list,
+                      unit_counts:np.ndarray, delay:np.ndarray, mlt:np.ndarray,
+                      l:np.ndarray, mlat:np.ndarray, values:dict) -> 'dict, int':
+    """Function to add the measurements of new units (event and probe) to
+    the saved statistics cube. If the settings changed, or units in the cube
+    are no longer in the data, the cube is made again from all the data.
+    INPUT
+    cube_filepath - where cube is saved
+    config - settings for the cube, must have edges, hist_edges and columns
+    unit_keys - key of each unit in the data, in the order of the rows
+    unit_counts - number of rows for each unit
+    delay, mlt, l, mlat, values - all the data, same as add_to_stats_cube
+    OUTPUT
+    cube - updated statistics cube
+    n_new - number of units added, all of them if the cube was made again
+    """
+
+    cube = load_stats_cube(cube_filepath, config)
+
+    # Start over if data was removed
+    if cube is not None and not set(cube['units']) <= set(unit_keys):
+        cube = None
+
+    if cube is None:
+        cube = new_stats_cube(config['columns'], config['edges'],
+                              config['hist_edges'])
+
+    # Rows of units that aren't in cube yet
+    old_units = set(cube['units'])
+    new_unit = np.array([key not in old_units for key in unit_keys], dtype=bool)
+    rows = np.repeat(new_unit, np.asarray(unit_counts, dtype=np.int64))
+
+    if np.any(new_unit):
+        add_to_stats_cube(cube, np.asarray(delay)[rows], np.asarray(mlt)[rows],
+                          np.asarray(l)[rows], np.asarray(mlat)[rows],
+                          {name : np.asarray(values[name])[rows]
+                           for name in cube['columns']})
+        cube['units'].extend(key for key, new in zip(unit_keys, new_unit) if new)
+        save_stats_cube(cube, cube_filepath, config)
+
+    return cube, int(np.sum(new_unit))
+
+def _range_cells(edges:np.ndarray, value_range:tuple) -> np.ndarray:
+    """Cells that are entirely within a range, a range with low > high
+    wraps around, e.g. (22, 2) MLT."""
+
+    if value_range is None:
+        return np.arange(len(edges) - 1)
+
+    low, high = value_range
+    left, right = edges[:-1], edges[1:]
+
+    if low <= high:
+        return np.flatnonzero((left >= low) & (right <= high))
+
+    return np.flatnonzero((left >= low) | (right <= high))
+
+def _hist_quantile(hist:np.ndarray, hist_edges:np.ndarray,
+                   quantile:float) -> np.ndarray:
+    """Quantile from histograms of log10 values along the last axis,
+    interpolating linearly within the histogram bin."""
+
+    cumulative = np.cumsum(hist, axis=-1)
+    total = cumulative[..., -1:]
+    target = quantile*total
+
+    # First bin where the cumulative count reaches the target
+    hist_i = np.minimum(np.sum(cumulative < target, axis=-1), hist.shape[-1] - 1)
+    before = np.take_along_axis(cumulative, hist_i[..., None], axis=-1) - \
+             np.take_along_axis(hist, hist_i[..., None], axis=-1)
+    in_bin = np.take_along_axis(hist, hist_i[..., None], axis=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.clip((target - before)/in_bin, 0, 1)[..., 0]
+        log_value = hist_edges[hist_i] + fraction*np.diff(hist_edges)[hist_i]
+
+    return np.where(total[..., 0] > 0, 10**log_value, np.nan)
+
+def query_stats_cube(cube:dict, mlt_range:tuple=None, l_range:tuple=None,
+                     mlat_range:tuple=None, delay_edges:np.ndarray=None) -> dict:
+    """Function to get statistics in delay bins for a sector by adding up
+    cells. Cells are used if they are entirely within the ranges, so
+    ranges should line up with cell edges.
+    INPUT
+    cube - statistics cube
+    mlt_range - (low, high) MLT, low > high wraps around midnight
+    l_range - (low, high) L shell
+    mlat_range - (low, high) absolute value of MLAT
+    delay_edges - edges of delay bins, each must be a cube delay edge,
+                  None to use the cube cells
+    OUTPUT
+    stats_dict - dictionary with delay_edges and a dictionary for each
+                 column with count, mean, std, gmean, gstd, median, q1 and q3
+                 (from the histogram) and <method>_low, <method>_high for
+                 median, mean and gmean like bin_statistics
+    """
+
+    edges = cube['edges']
+
+    if delay_edges is None:
+        delay_edges = edges['delay']
+    delay_edges = np.asarray(delay_edges, dtype=float)
+
+    if not np.all(np.isin(delay_edges, edges['delay'])):
+        raise ValueError('Delay edges must be edges of the cube cells.')
+
+    # Which cells are in sector and which delay bin each delay cell goes to
+    mlt_i = _range_cells(edges['mlt'], mlt_range)
+    l_i = _range_cells(edges['l'], l_range)
+    mlat_i = _range_cells(edges['mlat'], mlat_range)
+    first = np.searchsorted(edges['delay'], delay_edges[0])
+    last = np.searchsorted(edges['delay'], delay_edges[-1])
+    starts = np.searchsorted(edges['delay'], delay_edges[:-1]) - first
+
+    def sector_sum(data:np.ndarray) -> np.ndarray:
+        data = data[first:last][:, mlt_i][:, :, l_i][:, :, :, mlat_i]
+        data = data.sum(axis=(1, 2, 3), dtype=np.float64)
+        if data.shape[0] == 0:
+            return np.zeros((0,) + data.shape[1:])
+        return np.add.reduceat(data, starts, axis=0)
+
+    stats_dict = {'delay_edges' : delay_edges}
+
+    for name, column in cube['columns'].items():
+
+        count = sector_sum(column['count'])
+        sums = {sum_name : sector_sum(column[sum_name]) for sum_name in cube_sums}
+        hist = sector_sum(column['hist'])
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums['sum']/count
+            std = np.sqrt(np.maximum(sums['sum_sq']/count - mean**2, 0))
+            log_mean = sums['sum_log']/count
+            log_var = (sums['sum_log_sq'] - count*log_mean**2)/(count - 1)
+            gmean = 10**log_mean
+            gstd = 10**np.sqrt(np.maximum(log_var, 0))
+            gstd[count < 2] = np.nan
+
+        median = _hist_quantile(hist, cube['hist_edges'], 0.5)
+        q1 = _hist_quantile(hist, cube['hist_edges'], 0.25)
+        q3 = _hist_quantile(hist, cube['hist_edges'], 0.75)
+
+        stats_dict[name] = {'count' : count.astype(np.int64),
+                            'mean' : mean,
+                            'std' : std,
+                            'gmean' : gmean,
+                            'gstd' : gstd,
+                            'median' : median,
+                            'q1' : q1,
+                            'q3' : q3,
+                            'median_low' : q1,
+                            'median_high' : q3,
+                            'mean_low' : mean - std,
+                            'mean_high' : mean + std,
+                            'gmean_low' : gmean/gstd,
+                            'gmean_high' : gmean*gstd}
+
+    return stats_dict
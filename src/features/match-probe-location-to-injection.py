@@ -12,10 +12,18 @@ from dateutil import parser
 import h5py
 import logging
 import numpy as np
-import os
 import pandas as pd
-import pickle
-import pytz
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[2]
+sys.path.append(str(path_root))
+
+# Functions to read and match ephemeris
+from src.data.magephem_functions import magephem_columns, match_periods_to_ephemeris
+from src.data.magephem_functions import quiet_time_location_filepath, write_quiet_time_location
+from src.data.magephem_functions import read_magephem_store, update_magephem_store
 
 
 
@@ -48,121 +56,73 @@ quiet_times = pd.read_csv('data/interim/sme-injections-quiet-times.txt', delimit
                           names=['Quiet Start', 'Quiet End', 'Injection Start',
                                  'Injection Length', 'Quiet Length'])
 
-# Get a list of RBSP magnetic ephemerides
-# Get a list of all files in directory
+# Directory with RBSP magnetic ephemerides
 footpoint_dir = 'data/raw/rbsp-magephem/'
-footpoint_files = os.listdir(footpoint_dir)
 
-# I like to filter to only the file types I want 
-#...in case there are others
-footpoint_files = [f for f in footpoint_files if f.endswith('.h5')]
+# Start and end of every quiet period
+start_times = [parser.isoparse(t) for t in quiet_times['Quiet Start']]
+end_times = [parser.isoparse(t) for t in quiet_times['Quiet End']]
+starts = np.array([t.replace(tzinfo=None) for t in start_times], dtype='datetime64[ns]')
+ends = np.array([t.replace(tzinfo=None) for t in end_times], dtype='datetime64[ns]')
 
-# Dictionary to store locations in
-rbsp_matched_quiet_times = {}
+# Add any new files to the ephemeris store
+store_status = update_magephem_store(footpoint_dir)
+logging.info(f'Ephemeris store updated: {store_status}.')
 
-start_i = 0
-# Loop through each quiet and get RBSP probe positions
-for df_index in quiet_times.index:
+# Ephemeris and sample indices within each period for each probe
+ephemerides = {}
+probe_period_indices = {}
 
-    if df_index%100 == 0:
-        logging.info(f'Getting satellite location for {df_index} of {len(quiet_times.index)} periods.')
+for probe in ['rbspa', 'rbspb']:
+
+    # Read all the times needed for this probe once
+    logging.info(f'Reading ephemeris for {probe}.')
+    ephemeris = read_magephem_store(probe, starts.min(), ends.max())
     
-    # Figure out which files we will need to read in
-    # May need more than one if quiet period is in 2 UTC days
-    start_time = parser.isoparse(quiet_times.loc[df_index, 'Quiet Start'])
-    end_time = parser.isoparse(quiet_times.loc[df_index, 'Quiet End'])
+    mlt = ephemeris['mlt']
+    mlat = ephemeris['mlat']
+    l = ephemeris['l']
+
+    # When probe was in desired location
+    selected = (((mlt < end_mlt) | (mlt > start_mlt))
+                & (np.abs(mlat) < large_mlat)
+                & (l > small_l)
+                & (l != bad_values))
+
+    # Only get times during each quiet period
+    ephemerides[probe] = ephemeris
+    probe_period_indices[probe] = match_periods_to_ephemeris(ephemeris['time'], selected,
+                                                             starts, ends)
+
+# Samples within each quiet period for each probe,
+#...periods with the same start are replaced by the later one
+rbsp_matched_quiet_times = {}
 
-    file_dates = pd.date_range(start_time.date(), end_time.date(),
-                               freq='d').strftime('%Y%m%d').tolist()
+for df_index, start_time in enumerate(start_times):
 
-    # Select the magnetic ephemerides files
-    rbsp_filenames = [f for f in footpoint_files if any(d in f for d in file_dates)]
-    
-    if len(rbsp_filenames) == 0:
-        continue
-    
-    # Set dictionary
-    rbsp_matched_quiet_times[start_time] = {'rbspa' : {},
-                                               'rbspb' : {}}
-
-    for probe in ['rbspa', 'rbspb']:
-        
-        # Lists to store location in
-        mlat = []
-        l = []
-        mlt = []
-        isotime = []
-        footpoint = []
-        rgeo = []
-        
-        for rbsp_filename in [f for f in rbsp_filenames if probe in f]:
-            
-            # Read in the file
-            file = h5py.File(footpoint_dir + rbsp_filename, 'r')
-
-            # Get times and add to date to produce a datetime
-            isotime.extend(list(file['IsoTime']))
-
-            # Read data into arrays
-            mlat.extend(list(file['CDMAG_MLAT']))
-            l.extend(list(file['L'][:, -1]))
-            mlt.extend(list(file['CDMAG_MLT']))
-            
-            # Add footprint data too
-            footpoint.extend(list(file['Pfn_geod_LatLon']))
-            
-            # Add geographic location vector
-            rgeo.extend(np.array(file['Rgeo']))
-            
-        # Convert time to datetime and array
-        # Need an extra function to account for some 
-        # seconds being 60
-        def parse_func(t):
-            if t[-3:-1] == b'60':
-                t = t[0:-3] + b'59Z'
-            return parser.isoparse(t)
-        
-        isotime = np.array([parse_func(t) for t in isotime])
-        mlat = np.array(mlat)
-        l = np.array(l)
-        mlt = np.array(mlt)
-        footpoint = np.array(footpoint)
-        rgeo = np.array(rgeo)
-        
-        # Only get times during the quiet period
-        # And when probe was in desired location
-        selected_i = np.argwhere((isotime > start_time.replace(tzinfo=pytz.UTC)) 
-                                 & (isotime < end_time.replace(tzinfo=pytz.UTC))
-                                 & ((mlt < end_mlt) | (mlt > start_mlt))
-                                 & (np.abs(mlat) < large_mlat)
-                                 & (l > small_l)
-                                 & (l != bad_values))
-        
-        # Skip if no times that fit
-        if len(selected_i) == 0:
-            del rbsp_matched_quiet_times[start_time][probe]
-            continue
-        
-        # Otherwise write to dictionary
-        rbsp_matched_quiet_times[start_time][probe] = {'Time' : isotime[selected_i],
-                                                          'MLT' : mlt[selected_i],
-                                                          'L' : l[selected_i],
-                                                          'MLat' : mlat[selected_i],
-                                                          'Footpoint' : footpoint[selected_i],
-                                                          'Rgeo' : rgeo[selected_i]}
-
-# Loop through dictionary and remove entries with out any data
-keys = list(rbsp_matched_quiet_times.keys())
-for key in keys:
-    
-    if rbsp_matched_quiet_times[key] == {}:
-        del rbsp_matched_quiet_times[key]
+    rbsp_matched_quiet_times[start_time] = {probe : probe_period_indices[probe][df_index]
+                                            for probe in ['rbspa', 'rbspb']
+                                            if len(probe_period_indices[probe][df_index]) > 0}
 
-# Write the dictionary with conjunction times to a pickle file
+# Write the locations for each period and probe, skipping those without any data
 #...if we need it again we don't have to calculate it all out
-with open('data/interim/rbsp-quiet-time-location.pickle',
-                  'wb') as handle:
-    pickle.dump(rbsp_matched_quiet_times, handle, protocol=pickle.HIGHEST_PROTOCOL)
+with h5py.File(quiet_time_location_filepath, 'w') as h5_file:
+
+    for df_index, (start_time, probe_indices) in enumerate(rbsp_matched_quiet_times.items()):
+
+        if df_index%100 == 0:
+            logging.info(f'Writing satellite location for {df_index} of'
+                         f' {len(rbsp_matched_quiet_times)} periods.')
+
+        for probe, selected_i in probe_indices.items():
+            location_dict = {c : ephemerides[probe][c][selected_i]
+                             for c in magephem_columns}
+            write_quiet_time_location(h5_file, start_time, probe, location_dict)
 
-logging.info('All finished. Wrote to file: data/interim/rbsp-quiet-time-location.pickle')
+    h5_file.attrs['about'] = ('Van Allen Probe locations during each quiet period. '
+                              'Each location is a row in the column datasets. '
+                              'The index group gives the event (start of quiet period), '
+                              'probe, offset and count of the rows for each event '
+                              'and probe. Time is nanoseconds since 1970-01-01 UTC.')
 
+logging.info(f'All finished. Wrote to file: {quiet_time_location_filepath}')
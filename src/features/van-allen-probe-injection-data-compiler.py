@@ -6,14 +6,14 @@ science@rileytroyer.com
 
 ####################### Initialize Program #######################
 # Libraries
+from collections import Counter
 from datetime import datetime
 import h5py
 import logging
+import multiprocessing
 import numpy as np
+import os
 from pathlib import Path
-import pickle
-from scipy.integrate import simpson
-from scipy.interpolate import interp1d
 import sys
 
 # Add root to path
@@ -21,7 +21,17 @@ path_root = Path(__file__).parents[2]
 sys.path.append(str(path_root))
 
 # Function to read in PFISR data
-from src.data.van_allen_probe_functions import read_process_rbsp_data
+from src.data.cache_functions import disk_cache_load, disk_cache_save, make_cache_key
+from src.data.h5_functions import append_columns_to_h5, truncate_columns_in_h5
+from src.data.magephem_functions import iter_quiet_time_locations, quiet_time_location_filepath
+from src.data.manifest_functions import load_run_manifest, new_run_manifest
+from src.data.manifest_functions import save_run_manifest, unit_key
+from src.data.van_allen_probe_functions import default_smooth_size, rbsp_day_fingerprint
+from src.data.van_allen_probe_functions import NoDataError
+from src.data.van_allen_probe_functions import read_process_rbsp_event
+from src.features.chorus_functions import default_band_fractions, fce_per_nt
+from src.features.chorus_functions import integrate_chorus_bands
+from src.features.chorus_functions import interpolate_b_magnitude, low_density_mask
 
 
 # Initiate logging
@@ -31,393 +41,379 @@ logging.basicConfig(filename = f'logs/van-allen-probe-injection-data-compiler-{d
                     level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
 
+# Columns written for each event and probe
+chorus_delay_columns = ['b_ubc', 'e_ubc', 'b_ubc_max', 'e_ubc_max',
+                        'b_lbc', 'e_lbc', 'b_lbc_max', 'e_lbc_max',
+                        'b_ubc_band_max', 'b_lbc_band_max',
+                        'delay', 'mlt', 'l', 'mlat', 'probe', 'ut']
+
 ####################### End Initializing #######################
 
 
 ####################### Local Functions #######################
-def save_dict_to_h5(event:str, dic:dict, path:str, h5_file:h5py.File):
-    """Convert dictionary into h5py file.
+def compile_event_probe(unit:tuple) -> 'datetime, str, dict':
+    """Function to compile the chorus data for a single probe during
+    a single quiet time event. This is run by the worker processes.
+    If a stage cache directory is set, results are cached keyed by the
+    input files and every parameter that changes the result.
     INPUT
-    event - isotime of event that dictionary has data for.
-    dic - dictionary of data for event
-    path - base directory within h5 file, usually us '/'.
-    h5_file - the h5 file to write data to.
+    unit - tuple of (event, probe, times, shared_dates, config) where times are
+           the probe datetime64 times during the quiet period, shared_dates
+           are the dates other units also need and config is a dictionary of
+           directories and processing parameters
     OUTPUT
-    Writes to h5 file. Otherwise raises error.
+    event, probe - same as input
+    chorus_delay_dict - dictionary of arrays for the event and probe,
+                        None if there isn't any data to use.
     """
-    
-    # Create new group within file for event
-    group_path = path + event + '/'
-    
-    # Loop through each key in dictionary
-    for key, item in dic.items():
-        
-        # Key type of dictionary item to make sure it is writable to h5
-        if isinstance(item, (np.ndarray, np.int64, np.float64, str, bytes)):
-            h5_file[group_path + key] = item
-        
-        else:
-            raise ValueError('Cannot save %s type'%type(item))
-
-def filter_write_to_dict(i, threshold = 10**-7):
-    """Function to filter chorus data by psd threshold,
-    LBC/UBC.
+
+    event, probe, times, shared_dates, config = unit
+
+    stage_cache_dir = config['stage_cache_dir']
+
+    if stage_cache_dir is None:
+        return event, probe, compile_chorus_event(event, probe, times,
+                                                  shared_dates, config)[0]
+
+    # Check if this has already been done with the same inputs and parameters
+    stage_key = chorus_stage_key(event, probe, times, config)
+    chorus_delay_dict = disk_cache_load(stage_cache_dir, stage_key)
+
+    if chorus_delay_dict is None:
+        chorus_delay_dict, missing = compile_chorus_event(event, probe, times,
+                                                          shared_dates, config)
+
+        # Only save if every day was read or has no data, an error reading
+        #...a file may not happen next time and isn't in the stage key
+        cacheable = all(isinstance(e, NoDataError) for e in missing.values())
+
+        # Also save when there isn't any data, so it isn't read again
+        if cacheable and chorus_delay_dict is None:
+            disk_cache_save(stage_cache_dir, stage_key, {'no_data' : np.array(True)})
+        elif cacheable:
+            disk_cache_save(stage_cache_dir, stage_key, chorus_delay_dict)
+
+    elif 'no_data' in chorus_delay_dict:
+        chorus_delay_dict = None
+
+    return event, probe, chorus_delay_dict
+
+def chorus_stage_key(event:datetime, probe:str, times:np.ndarray,
+                     config:dict) -> str:
+    """Function to get the stage cache key for an event and probe.
     INPUT
-    i
-        type: integer
-        about: loop location
-    threshold = 10**-7
-        type: integer
-        about: magnetic psd threshold in nT^2/Hz from Hartley et al. 2019
+    event, probe, times, config - same as compile_event_probe
     OUTPUT
-    none, it just write to dictionary that is already created.
+    stage_key - changes if any input file or processing parameter changes
     """
-    
-    # Set probe
-    chorus_delay_dict['probe'].append(probe)
-    
-    # Set time
-    time = ut_time[i]
-    chorus_delay_dict['ut'].append(time)
-    
-    # Add location data to dictionary
-    chorus_delay_dict['mlt'].append(mlt[i])
-    chorus_delay_dict['l'].append(l[i])
-    chorus_delay_dict['mlat'].append(mlat[i])
-    
-    # Determine delay in seconds
-    chorus_delay_dict['delay'].append((time - event).total_seconds())
 
-    # Convert time to float
-    int_time = time.timestamp()
+    # Input files for each day, or why there aren't any
+    fingerprints = []
+    for date in np.unique(times.astype('datetime64[D]')).astype(datetime):
+        try:
+            fingerprints.append(rbsp_day_fingerprint(probe, date,
+                                                     config['psd_save_dir'],
+                                                     config['mag_save_dir']))
+        except Exception as e:
+            fingerprints.append(str(e))
 
-    # Get chorus frequencies
-    # Calculate 0.1, 0.5 and 1 gyrofrequency
-    fce = b_mag_func(int_time)*28
-    fce_half = fce/2
-    fce_tenth = fce/10
+    return make_cache_key('chorus-bands', 'band-max', 'read-errors-not-cached',
+                          event, probe, str(times.min()), str(times.max()), fingerprints,
+                          config['smooth_size'], config['band_fractions'],
+                          config['threshold'])
 
-    # Slice by time and select just lower band chorus waves
-    lbc_freq = freq[(freq > fce_tenth) & (freq < fce_half)]
-    b_lbc_psd = b_power[(freq > fce_tenth) & (freq < fce_half), i]
-    e_lbc_psd = e_power[(freq > fce_tenth) & (freq < fce_half), i]
+def compile_chorus_event(event:datetime, probe:str, times:np.ndarray,
+                         shared_dates:set, config:dict) -> 'dict, dict':
+    """Function that does the work for compile_event_probe, see it for details.
+    Also returns the dictionary of date -> error for days that couldn't be read."""
 
-    try:
-        # Only continue if max magnetic chorus is > threshold
-        if np.max(b_lbc_psd) >= threshold:
-
-            # Integrate psd over LBC frequencies
-            integrated_b_lbc_psd = simpson(y=b_lbc_psd[b_lbc_psd != -1e31],
-                                           x=lbc_freq[b_lbc_psd != -1e31])
-            integrated_e_lbc_psd = simpson(y=e_lbc_psd[e_lbc_psd != -1e31],
-                                           x=lbc_freq[e_lbc_psd != -1e31])
-
-            # Get max value
-            chorus_delay_dict['b_lbc_max'].append(np.max(b_lbc_psd[b_lbc_psd 
-                                                                   != -1e31]))
-            chorus_delay_dict['e_lbc_max'].append(np.max(e_lbc_psd[e_lbc_psd 
-                                                                   != -1e31]))
-
-        else:
-            integrated_b_lbc_psd = np.nan
-            chorus_delay_dict['b_lbc_max'].append(np.nan)
-            integrated_e_lbc_psd = np.nan
-            chorus_delay_dict['e_lbc_max'].append(np.nan)
-
-    except:
-        integrated_b_lbc_psd = np.nan
-        chorus_delay_dict['b_lbc_max'].append(np.nan)
-        integrated_e_lbc_psd = np.nan
-        chorus_delay_dict['e_lbc_max'].append(np.nan)
-
-
-    # Add to list
-    chorus_delay_dict['b_lbc'].append(integrated_b_lbc_psd)
-    chorus_delay_dict['e_lbc'].append(integrated_e_lbc_psd)
-
-    # Slice by time and select just upper band chorus waves
-    ubc_freq = freq[(freq > fce_half) & (freq < fce)]
-    b_ubc_psd = b_power[(freq > fce_half) & (freq < fce), i]
-    e_ubc_psd = e_power[(freq > fce_half) & (freq < fce), i]
+    # Get the unique dates in event
+    dates = np.unique(times.astype('datetime64[D]')).astype(datetime)
+    
+    if dates[0] > datetime(2019, 7, 16).date():
+        logging.warning(f'Date {dates[0]} after 2019-07-16.')
+        return None, {}
+
+    # Data after this date isn't used
+    for date in dates[dates > datetime(2019, 7, 16).date()]:
+        logging.warning(f'Date {date} after 2019-07-16.')
+    dates = dates[dates <= datetime(2019, 7, 16).date()]
+
+    # Only data within these times is needed
+    start_time = times.min().astype('datetime64[us]').astype(datetime)
+    end_time = times.max().astype('datetime64[us]').astype(datetime)
+
+    # Read in data files for all days of event
+    event_dict, missing = read_process_rbsp_event(probe, dates,
+                                                  config['psd_save_dir'],
+                                                  config['mag_save_dir'],
+                                                  start_time, end_time,
+                                                  config['cache_max_bytes'],
+                                                  config['cache_dir'],
+                                                  config['smooth_size'],
+                                                  shared_dates)
+
+    for date, e in missing.items():
+        logging.warning(f'Unable to read in rbsp data for {probe} and {date}.'
+                        f' Returned error {e}.')
+
+    # Check if there is any data for event
+    if event_dict is None:
+        logging.warning(f'No data for entire event {event} for {probe}.')
+        return None, missing
+
+    ut_time = event_dict['ut_time']
+    freq = event_dict['freq']
+    b_power = event_dict['b_power']
+    e_power = event_dict['e_power']
+    density = event_dict['density']
+    ut_time_b_mag = event_dict['ut_time_b_mag']
+    b_mag = event_dict['b_mag']
+    l = event_dict['l']
+    mlt = event_dict['mlt']
+    mlat = event_dict['mlat']
+    
+    # If there isn't enough data, skip
+    if len(ut_time_b_mag) < 1:
+        logging.warning(f'Not enough b_mag data for {probe} and {event}.')
+        return None, missing
+    
+    # If there isn't enough density data, skip
+    if len(density) < 1:
+        logging.warning(f'Not enough density data for {probe} and {event}.')
+        return None, missing
+    
+    # Timesteps where density is low enough to be considered
+    chorus_i = np.flatnonzero(low_density_mask(density, l))
+
+    # Calculate gyrofrequency for each selected time
+    #...from linearly interpolated b_field
+    fce = interpolate_b_magnitude(ut_time[chorus_i], ut_time_b_mag,
+                                  b_mag)*fce_per_nt
+
+    # Filter data based on threshold and frequency
+    #...all selected times at once
+    band_dict = integrate_chorus_bands(freq, b_power[chorus_i],
+                                       e_power[chorus_i], fce,
+                                       threshold=config['threshold'],
+                                       band_fractions=config['band_fractions'])
+
+    # Store as compact arrays to send back to the writer
+    chorus_delay_dict = {key : band_dict[key] for key in
+                         ['b_ubc', 'e_ubc', 'b_ubc_max', 'e_ubc_max',
+                          'b_lbc', 'e_lbc', 'b_lbc_max', 'e_lbc_max',
+                          'b_ubc_band_max', 'b_lbc_band_max']}
+    chorus_time = np.asarray(ut_time[chorus_i]).astype('datetime64[us]')
+    chorus_delay_dict['delay'] = ((chorus_time - np.datetime64(event, 'us'))
+                                  /np.timedelta64(1, 's'))
+    chorus_delay_dict['mlt'] = mlt[chorus_i]
+    chorus_delay_dict['l'] = l[chorus_i]
+    chorus_delay_dict['mlat'] = mlat[chorus_i]
+    chorus_delay_dict['probe'] = np.array([probe]*len(chorus_i)).astype('S5')
+
+    # Change time to iso format string
+    chorus_delay_dict['ut'] = np.char.add(np.datetime_as_string(chorus_time, unit='us'),
+                                          'Z').astype('S27')
+
+    return chorus_delay_dict, missing
+
+def compile_event_probe_checked(unit:tuple) -> 'datetime, str, dict, str':
+    """Function to run compile_event_probe and catch any error, so a single
+    bad unit doesn't stop the whole run.
+    INPUT
+    unit - same as compile_event_probe
+    OUTPUT
+    event, probe, chorus_delay_dict - same as compile_event_probe
+    error - description of error, None if there wasn't one
+    """
 
     try:
-        # Only continue if max chorus is > threshold
-        if np.max(b_ubc_psd) >= threshold:
-
-            # Integrate psd over UBC frequencies
-            integrated_b_ubc_psd = simpson(y=b_ubc_psd[b_ubc_psd != -1e31],
-                                           x=ubc_freq[b_ubc_psd != -1e31])
-            integrated_e_ubc_psd = simpson(y=e_ubc_psd[e_ubc_psd != -1e31],
-                                           x=ubc_freq[e_ubc_psd != -1e31])
-
-            # Get max value
-            chorus_delay_dict['b_ubc_max'].append(np.max(b_ubc_psd[b_ubc_psd 
-                                                                   != -1e31]))
-            chorus_delay_dict['e_ubc_max'].append(np.max(e_ubc_psd[e_ubc_psd 
-                                                                   != -1e31]))
-
-        else:
-            integrated_b_ubc_psd = np.nan
-            chorus_delay_dict['b_ubc_max'].append(np.nan)
-            integrated_e_ubc_psd = np.nan
-            chorus_delay_dict['e_ubc_max'].append(np.nan)
-
-    except:
-        integrated_b_ubc_psd = np.nan
-        chorus_delay_dict['b_ubc_max'].append(np.nan)
-        integrated_e_ubc_psd = np.nan
-        chorus_delay_dict['e_ubc_max'].append(np.nan)
-
-    # Add to list
-    chorus_delay_dict['b_ubc'].append(integrated_b_ubc_psd)
-    chorus_delay_dict['e_ubc'].append(integrated_e_ubc_psd)
+        return compile_event_probe(unit) + (None,)
+    except Exception as e:
+        return unit[0], unit[1], None, repr(e)
 ####################### End of Local Functions #######################
 
 
 ####################### START OF PROGRAM #######################
 
-mag_save_dir = 'data/raw/mag-waveform/'
-psd_save_dir = 'data/raw/l4-mag/'
-
-# Threshold, more than this is chorus
-threshold = 10**-7 # from Hartley et al. 2019
-
-# Create dictionary to store data
-chorus_delay_dict = {'delay' : [],
-                     'b_ubc' : [],
-                     'e_ubc' : [],
-                     'b_ubc_max' : [],
-                     'e_ubc_max' : [],
-                     'b_lbc' : [],
-                     'e_lbc' : [],
-                     'b_lbc_max' : [],
-                     'e_lbc_max' : [],
-                     'mlt' : [],
-                     'l' : [],
-                     'mlat' : [],
-                     'probe' : [],
-                     'ut':[]}
-
-# Create H5 file to store data in
-h5_data_filename = 'data/processed/chorus-delay-data.h5'
-
-# Read in the pickle file
-with open('data/interim/rbsp-quiet-time-location.pickle',
-          'rb') as handle:
-    passby_dict = pickle.load(handle)
-
-# Loop  through each quiet time event
-
-logging.info(f'Starting program. {len(passby_dict.keys())} events to process.')
-
-offset = 0
-offset_end = 45
-for i, event in enumerate(list(passby_dict.keys())[0:]):
-    
-    logging.info(f'Starting event {event}.')
-    
-    i = i + offset
-    
-    # Loop through each probe in event
-    for probe in passby_dict[event].keys():
-        
-        #logging.info(f'Starting probe {probe}.')
-        
-        # Get the unique dates in event
-        dates = np.unique([d[0].date() for d in
-                           passby_dict[event][probe]['Time']])
-        
-        if dates[0] > datetime(2019, 7, 16).date():
-            logging.warning(f'Date {date} after 2019-07-16.')
-            continue
-            
-        for j, date in enumerate(dates):
-            
-            if date > datetime(2019, 7, 16).date():
-                logging.warning(f'Date {date} after 2019-07-16.')
+if __name__ == '__main__':
+
+    mag_save_dir = 'data/raw/mag-waveform/'
+    psd_save_dir = 'data/raw/l4-mag/'
+
+    # Threshold, more than this is chorus
+    #...None keeps every band with good data, the threshold can then be
+    #...applied or swept later from b_lbc_band_max and b_ubc_band_max
+    threshold = 10**-7 # from Hartley et al. 2019
+
+    # Number of records to smooth power over and chorus band edges as fractions of fce
+    smooth_size = default_smooth_size
+    band_fractions = default_band_fractions
+
+    # Number of worker processes, 1 runs everything in this process
+    num_workers = multiprocessing.cpu_count()
+
+    # Cache of decoded days, memory is per worker and disk is shared
+    #...only days needed by more than one event are cached, others only
+    #...read the records within the event
+    cache_max_bytes = 512*1024**2
+    cache_dir = None #'data/interim/rbsp-day-cache/'
+
+    # Cache of compiled events, when sweeping the threshold or band edges
+    #...turn this and the disk cache of decoded days on so only the stages
+    #...that depend on the changed parameter are done again
+    stage_cache_dir = None #'data/interim/chorus-stage-cache/'
+
+    config = {'psd_save_dir' : psd_save_dir,
+              'mag_save_dir' : mag_save_dir,
+              'threshold' : threshold,
+              'smooth_size' : smooth_size,
+              'band_fractions' : band_fractions,
+              'cache_max_bytes' : cache_max_bytes,
+              'cache_dir' : cache_dir,
+              'stage_cache_dir' : stage_cache_dir}
+
+    # Create H5 file to store data in
+    h5_data_filename = 'data/processed/chorus-delay-data.h5'
+
+    # Manifest of what has been written, used to resume the run
+    manifest_filename = h5_data_filename + '.manifest.json'
+
+    # Settings that change the output, a run is only resumed if these match
+    run_config = {'psd_save_dir' : psd_save_dir,
+                  'mag_save_dir' : mag_save_dir,
+                  'threshold' : threshold,
+                  'smooth_size' : smooth_size,
+                  'band_fractions' : band_fractions,
+                  'quiet_time_location_filepath' : quiet_time_location_filepath,
+                  'quiet_time_location_mtime' : os.path.getmtime(quiet_time_location_filepath),
+                  'columns' : chorus_delay_columns}
+
+    manifest = load_run_manifest(manifest_filename, run_config, h5_data_filename)
+
+    if manifest is not None and os.path.exists(h5_data_filename):
+        h5_mode = 'a'
+        logging.info(f'Resuming run. {len(manifest["completed"])} units already completed,'
+                     f' {len(manifest["failed"])} failed units will be tried again.')
+    else:
+        manifest = new_run_manifest(run_config, h5_data_filename)
+        h5_mode = 'w'
+        logging.info('Starting new run.')
+
+        # Keep the data from the previous run instead of overwriting it
+        if os.path.exists(h5_data_filename):
+            os.replace(h5_data_filename, h5_data_filename + '.bak')
+            logging.warning(f'Moved previous {h5_data_filename} to'
+                            f' {h5_data_filename}.bak.')
+
+    # Every (event, probe) pair is an independent unit of work
+    #...only the times are read from the quiet time location file
+    units = [(event, probe, location_dict['time'],
+              set(np.unique(location_dict['time'].astype('datetime64[D]')).astype(datetime)))
+             for event, probe, location_dict
+             in iter_quiet_time_locations(columns=['time'])
+             if unit_key(event.isoformat(), probe) not in manifest['completed']]
+
+    # Days needed by more than one unit are read whole and cached,
+    #...other days only read the records within the event. Each unit
+    #...only gets its own shared days to keep what is sent to workers small
+    day_counts = Counter((probe, date) for event, probe, times, dates in units
+                         for date in dates)
+    units = [(event, probe, times,
+              {date for date in dates if day_counts[(probe, date)] > 1}, config)
+             for event, probe, times, dates in units]
+
+    logging.info(f'Starting program. {len({u[0] for u in units})} events to process.')
+
+    logging.info(f'{len(units)} event and probe pairs to process'
+                 f' with {num_workers} workers.')
+
+    if num_workers > 1:
+        pool = multiprocessing.get_context('spawn').Pool(processes=num_workers)
+
+        # imap returns results in the same order as units
+        # neighbouring events often share a day, so send them to the
+        #...same worker in chunks to make use of its cache
+        results = pool.imap(compile_event_probe_checked, units, chunksize=4)
+    else:
+        pool = None
+        results = map(compile_event_probe_checked, units)
+
+    # This process is the only writer, it drains results in order
+    #...and appends each event and probe to the column datasets
+    current_event = None
+
+    with h5py.File(h5_data_filename, h5_mode) as h5_file:
+
+        # Remove anything written after the last time the manifest was saved
+        truncate_columns_in_h5(h5_file, manifest['index_rows'])
+        manifest['finished'] = False
+        save_run_manifest(manifest_filename, manifest)
+
+        for event, probe, chorus_delay_dict, error in results:
+
+            # Checkpoint after each event
+            if event != current_event:
+                if current_event is not None:
+                    h5_file.flush()
+                    save_run_manifest(manifest_filename, manifest)
+                    logging.info(f'Finished processing {current_event}.')
+                current_event = event
+
+            key = unit_key(event.isoformat(), probe)
+
+            if error is not None:
+                logging.warning(f'Unable to process {probe} for event {event}.'
+                                f' Returned error {error}.')
+                manifest['failed'][key] = error
                 continue
-                
-            if j==0:
-                # Read in data files
+
+            if chorus_delay_dict is not None:
                 try:
-                    (ut_time, freq,
-                     b_power, e_power, density,
-                     ut_time_b_mag, b_mag,
-                     l, mlt, mlat) = read_process_rbsp_data(probe, date, psd_save_dir, mag_save_dir)
+                    append_columns_to_h5(h5_file, chorus_delay_dict,
+                                         event.isoformat() + 'Z', probe)
                 except Exception as e:
-                    logging.warning(f'Unable to read in rbsp data for {probe} and {date}.'
+                    logging.warning(f'Unable to write {probe} for event {event} into h5 file.'
                                     f' Returned error {e}.')
-                    ut_time = [np.nan]
-                    continue
-                
-            else:
-                try:
-                    # Read in data files
-                    (ut_time_tmp, freq_tmp,
-                     b_power_tmp, e_power_tmp, density_tmp,
-                     ut_time_b_mag_tmp, b_mag_tmp,
-                     l_tmp, mlt_tmp, mlat_tmp) = read_process_rbsp_data(probe, date, psd_save_dir, mag_save_dir)
-                    
-                    # Check if density is nan, if so skip
-                    if np.nan in ut_time_tmp:
-                        logging.warning(f'NaN in time for {probe} and {date}.')
-                        continue
-                except Exception as e:
-                    logging.warning(f'Unable to read in rbsp data for {probe} and {date}.'
-                                    f' Returned errror {e}.')
-                    ut_time_tmp = [np.nan]
+                    # Remove anything that was partly written
+                    truncate_columns_in_h5(h5_file, manifest['index_rows'])
+                    manifest['failed'][key] = repr(e)
                     continue
-                    
-                # If no density with first date don't append
-                if np.nan in ut_time:
-                    
-                    logging.warning(f'NaN in density for date prior to {date} for {probe}.')
-                    
-                    # Append to first data
-                    ut_time = ut_time_tmp
-                    b_power = b_power_tmp
-                    e_power = e_power_tmp
-                    ut_time_b_mag = ut_time_b_mag_tmp
-                    b_mag = b_mag_tmp
-                    density = density_tmp
-                    l = l_tmp
-                    mlt = mlt_tmp
-                    mlat = mlat_tmp
-                
-                else:
-                    # Append to first data
-                    ut_time = np.concatenate((ut_time, ut_time_tmp), axis=0)
-                    b_power = np.concatenate((b_power, b_power_tmp), axis=1)
-                    e_power = np.concatenate((e_power, e_power_tmp), axis=1)
-                    ut_time_b_mag = np.concatenate((ut_time_b_mag, ut_time_b_mag_tmp),
-                                                     axis=0)
-                    b_mag = np.concatenate((b_mag, b_mag_tmp), axis=0)
-                    density = np.concatenate((density, density_tmp), axis=0)
-                    
-                    l = np.concatenate((l, l_tmp), axis=0)
-                    mlt = np.concatenate((mlt, mlt_tmp), axis=0)
-                    mlat = np.concatenate((mlat, mlat_tmp), axis=0)
-                    
-        # Check if there is any data for event
-        if np.nan in ut_time:
-            logging.warning(f'No data for entire event {event} for {probe}.')
-            del ut_time
-            
-            # Not entirely sure this is needed, but I don't think it hurts
-            try:
-                del b_power, e_power, b_mag, ut_time_b_mag, density, l, mlt, mlat
-            except:
-                logging.warning('No psd variables to delete')
-            continue
-                
-        # Select only data within desired times
-        start_time = sorted(passby_dict[event][probe]['Time'])[0][0].replace(tzinfo=None)
-        end_time = sorted(passby_dict[event][probe]['Time'])[-1][0].replace(tzinfo=None)
-        
-        # Select data between specified times for data in psd file
-        psd_selector = (ut_time >= start_time) & (ut_time <= end_time)
-        b_power = b_power[:, psd_selector]
-        e_power = e_power[:, psd_selector]
-        density = density[psd_selector]
-        l = l[psd_selector]
-        mlt = mlt[psd_selector]
-        mlat = mlat[psd_selector]
-        ut_time = ut_time[psd_selector]
-        
-        # Select data between specified times for B-field magnitude file
-        b_field_selector = (ut_time_b_mag >= start_time) & (ut_time_b_mag <= end_time)
-        b_mag = b_mag[b_field_selector]
-        ut_time_b_mag = ut_time_b_mag[b_field_selector]
-        
-        # If there isn't enough data, skip
-        if len(ut_time_b_mag) < 1:
-            
-            logging.warning(f'Not enough b_mag data for {probe} and {event}.')
-            
-            del ut_time, b_power, e_power, b_mag, ut_time_b_mag, density, l, mlt, mlat
-            continue
-        
-        # If there isn't enough density data, skip
-        if len(density) < 1:
-            
-            logging.warning(f'Not enough density data for {probe} and {event}.')
-            
-            del ut_time, b_power, e_power, b_mag, ut_time_b_mag, density, l, mlt, mlat
-            continue
-        
-        # Convert b_field and density times into floats
-        int_time_b_mag = np.array([t.timestamp() for t in ut_time_b_mag])
-        
-        # Create a linearly interpolated model of b_field
-        # Time needs to be in float format
-        b_mag_func = interp1d(int_time_b_mag, b_mag,
-                                fill_value='extrapolate')
-        
-        for k, time in enumerate(ut_time):
-            
-            # Check if density is low enough
-            # Based on Li et al. 2010
-            den_check = density[k]
-            l_check = l[k]
-            
-            # Smaller of 10(6.6/L)**4 or 50 cm^-3
-            small_den = 10*(6.6/l_check)**4
-            if small_den > 50:
-                small_den = 50
-            
-            # If density isn't low enough skip
-            if den_check > small_den:
-                #logging.warning(f'Density too large for {probe} and {event}.')
-                continue
-            
-            # Filter data based on threshold and frequency
-            filter_write_to_dict(k, threshold = 10**-7)
-            
-        # Clear variables
-        del ut_time, b_power, e_power, b_mag, ut_time_b_mag, density, l, mlt, mlat
-        
-        #logging.info(f'Finished processing {event} for {probe}')
-        
-    # Write dictionary to h5 file
-    
-    # First change time to iso format string
-    chorus_delay_dict['ut'] = np.array([t.isoformat() + 'Z' for t in 
-                                        chorus_delay_dict['ut']]).astype('S27')
-    
-    # Turn dictionary items into arrays
-    for key, item in chorus_delay_dict.items():
-        chorus_delay_dict[key] = np.array(item)
-        
-    # Convert probe to bytes type
-    chorus_delay_dict['probe'] = chorus_delay_dict['probe'].astype('S5')
-    
-    with h5py.File(h5_data_filename, 'a') as h5_file:
-        try:
-            save_dict_to_h5(event.isoformat() + 'Z', chorus_delay_dict, '/', h5_file)
-        except Exception as e:
-            logging.warning(f'Unable to write event for {date} into h5 file.'
-                            f' Returned error {e}.')
-        
-    # Clear data dictionary
-    for key in chorus_delay_dict:
-        chorus_delay_dict[key] = []
-    
-    logging.info(f'Finished processing {event}.')
 
-# Lastly add information to h5 file
-with h5py.File(h5_data_filename, 'a') as h5_file:
-    h5_file.attrs['about'] = ('Magnetic and electric chorus data from RBSP EMFISIS. '
-                              'Organized by event -> individual measurements. '
-                              'Times are in ut datasets and stored in an '
-                              'ISO format byte string. '
-                              'To convert times to datetime run: '
-                              'datetime.datetime.fromisoformat(ISOTIME.decode("utf-8")')
+                manifest['index_rows'] += 1
+
+            manifest['completed'][key] = 'no data' if chorus_delay_dict is None else 'written'
+            manifest['failed'].pop(key, None)
+
+        if current_event is not None:
+            logging.info(f'Finished processing {current_event}.')
+
+        # Lastly add information to h5 file
+        h5_file.attrs['about'] = ('Magnetic and electric chorus data from RBSP EMFISIS. '
+                                  'Each measurement is a row in the column datasets. '
+                                  'The index group gives the event, probe, offset '
+                                  'and count of the rows for each event and probe. '
+                                  'Times are in the ut dataset and stored in an '
+                                  'ISO format byte string. '
+                                  'To convert times to datetime run: '
+                                  'datetime.datetime.fromisoformat(ISOTIME.decode("utf-8")')
+
+        h5_file.flush()
+        manifest['finished'] = len(manifest['failed']) == 0
+        save_run_manifest(manifest_filename, manifest)
+
+    if len(manifest['failed']) > 0:
+        logging.warning(f'{len(manifest["failed"])} units failed, run again to retry them.')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
 
-# # Write the dictionary with conjunction times to a pickle file
-# #...if we need it again we don't have to calculate it all out
-# with open('data/processed/chorus-delay-data.pickle',
-#                   'wb') as handle:
-#     pickle.dump(chorus_delay_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # # Write the dictionary with conjunction times to a pickle file
+    # #...if we need it again we don't have to calculate it all out
+    # with open('data/processed/chorus-delay-data.pickle',
+    #                   'wb') as handle:
+    #     pickle.dump(chorus_delay_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
-logging.info(f'All finished. H5 file saved at: {h5_data_filename}')
\ No newline at end of file
+    logging.info(f'All finished. H5 file saved at: {h5_data_filename}')
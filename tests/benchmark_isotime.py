@@ -0,0 +1,36 @@
+""" Script to compare the speed of isotime_to_datetime64 with the
+original dateutil parser. Run from the root directory with:
+python tests/benchmark_isotime.py
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+from pathlib import Path
+import sys
+import time
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.magephem_functions import isotime_to_datetime64
+from tests.isotime_baseline import baseline_isotime_to_datetime64, random_isotimes
+
+# About one MagEphem file per day at one minute resolution for 140 days
+n_times = 200000
+isotime = random_isotimes(n_times, leap_every=400)
+
+start = time.perf_counter()
+baseline = baseline_isotime_to_datetime64(isotime)
+baseline_seconds = time.perf_counter() - start
+
+start = time.perf_counter()
+fast = isotime_to_datetime64(isotime)
+fast_seconds = time.perf_counter() - start
+
+print(f'{n_times} times, same result: {np.array_equal(baseline, fast)}')
+print(f'dateutil parser: {baseline_seconds:.3f} s')
+print(f'isotime_to_datetime64: {fast_seconds:.3f} s ({baseline_seconds/fast_seconds:.0f}x faster)')
@@ -0,0 +1,39 @@
+""" Original per string IsoTime parser, used to check and benchmark
+isotime_to_datetime64.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from dateutil import parser
+import numpy as np
+
+
+def baseline_isotime_to_datetime64(isotime:np.ndarray) -> np.ndarray:
+    """Original version of isotime_to_datetime64, runs dateutil on
+    each string."""
+
+    def parse_func(t):
+        if t[-3:-1] == b'60':
+            t = t[0:-3] + b'59Z'
+        return parser.isoparse(t).replace(tzinfo=None)
+
+    return np.array([parse_func(t) for t in isotime], dtype='datetime64[ns]')
+
+def random_isotimes(n:int, seed:int=0, leap_every:int=400) -> np.ndarray:
+    """Array of IsoTime strings like in the MagEphem files, with some
+    leap seconds."""
+
+    rng = np.random.default_rng(seed)
+
+    seconds = rng.integers(0, 7*365*86400, n)
+    times = np.datetime64('2012-09-01T00:00:00', 's') + seconds.astype('timedelta64[s]')
+    isotime = np.char.add(np.datetime_as_string(times).astype('S19'), b'Z')
+
+    # Leap seconds at the end of a day
+    leap = np.arange(0, n, leap_every)
+    days = np.datetime_as_string(times[leap].astype('datetime64[D]')).astype('S10')
+    isotime[leap] = np.char.add(days, b'T23:59:60Z')
+
+    return isotime
@@ -0,0 +1,156 @@
+""" Regression tests for the binned statistics and bootstrap slope error,
+compares the array versions against the original loops.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+from pathlib import Path
+import pytest
+import scipy.stats as stats
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.features.analysis_functions import _bootstrap_slopes, average_bins
+from src.features.analysis_functions import bootstrap_slope_error
+from src.features.analysis_functions import mean_of_distribution_transform
+
+
+def baseline_average_bins(delay, chorus, method='peak', bin_size=10):
+    """Original loop version of average_bins."""
+
+    # Average altitudes up to 5 hour after
+    delay_bins = np.arange(0, 5*60*60, bin_size*60)
+    chorus_bins = np.zeros(len(delay_bins))
+    chorus_bins_q1 = np.zeros(len(delay_bins))
+    chorus_bins_q3 = np.zeros(len(delay_bins))
+
+    statistics = np.zeros(len(delay_bins))
+
+    # Loop through each bin and average
+    for n, delay_bin in enumerate(delay_bins):
+
+        # For last bin average all the rest
+        if n == len(delay_bins)-1:
+            chorus_bin = chorus[delay >= delay_bin]
+
+        else:
+            chorus_bin = chorus[(delay >= delay_bin)
+                                & (delay < delay_bin + bin_size*60)]
+
+        # If no data for bin make undefined
+        if len(chorus_bin) < 2:
+            chorus_bins[n] = np.nan
+            chorus_bins_q1[n] = np.nan
+            chorus_bins_q3[n] = np.nan
+            continue
+
+        # How much data in bin
+        statistics[n] = len(chorus_bin[np.isfinite(chorus_bin)])
+
+        if method=='peak':
+            (chorus_bins[n], chorus_bins_q1[n],
+             chorus_bins_q3[n]) = mean_of_distribution_transform(chorus_bin)
+
+        if method=='median':
+            chorus_bins[n] = np.nanmedian(chorus_bin)
+            # Get 1st (25%) quartile
+            chorus_bins_q1[n] = np.nanmedian(chorus_bin[chorus_bin
+                                                        < np.nanmedian(chorus_bin)])
+            # Get 3rd (75%) quartile
+            chorus_bins_q3[n] = np.nanmedian(chorus_bin[chorus_bin
+                                                        > np.nanmedian(chorus_bin)])
+
+        if method=='mean':
+            # Get standard deviation
+            chorus_bins[n] = np.nanmean(chorus_bin)
+            chorus_bins_q1[n] = chorus_bins[n] - np.nanstd(chorus_bin)
+            chorus_bins_q3[n] = chorus_bins[n] + np.nanstd(chorus_bin)
+
+        if method=='gmean':
+            # Get geometric mean
+            chorus_bins[n] = stats.gmean(chorus_bin)
+            chorus_bins_q1[n] = chorus_bins[n]/stats.gstd(chorus_bin)
+            chorus_bins_q3[n] = chorus_bins[n]*stats.gstd(chorus_bin)
+
+    return delay_bins, chorus_bins, chorus_bins_q1, chorus_bins_q3, statistics
+
+def random_chorus(seed:int, n:int=5000) -> 'np.ndarray, np.ndarray':
+    """Delays up to past the last bin, with empty and single value bins."""
+
+    rng = np.random.default_rng(seed)
+
+    delay = rng.uniform(-300, 6*60*60, n)
+    chorus = 10**rng.normal(-6, 1.5, n)
+
+    # Empty bin and a bin with a single value
+    chorus = chorus[(delay < 3000) | (delay >= 3600)]
+    delay = delay[(delay < 3000) | (delay >= 3600)]
+    delay[0] = 3100
+
+    return delay, chorus
+
+@pytest.mark.parametrize('method', ['peak', 'median', 'mean', 'gmean'])
+@pytest.mark.parametrize('seed', range(3))
+def test_average_bins(method, seed):
+    delay, chorus = random_chorus(seed)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = baseline_average_bins(delay, chorus, method=method)
+    result = average_bins(delay, chorus, method=method)
+
+    for value, expected_value in zip(result, expected):
+        np.testing.assert_allclose(value, expected_value, rtol=1e-8, equal_nan=True)
+
+@pytest.mark.parametrize('bin_size', [5, 15, 60])
+def test_average_bins_sizes(bin_size):
+    delay, chorus = random_chorus(10)
+
+    expected = baseline_average_bins(delay, chorus, method='median', bin_size=bin_size)
+    result = average_bins(delay, chorus, method='median', bin_size=bin_size)
+
+    for value, expected_value in zip(result, expected):
+        np.testing.assert_allclose(value, expected_value, rtol=1e-12, equal_nan=True)
+
+def test_bootstrap_slopes_match_linregress():
+    rng = np.random.default_rng(0)
+    x = rng.uniform(0, 10, 50)
+    y = 2*x + rng.normal(0, 3, 50)
+    seed = np.random.SeedSequence(1)
+
+    slopes = _bootstrap_slopes(x, y, seed, 100, max_elements=2**22)
+
+    # Same resamplings drawn the same way, one block
+    index = np.random.default_rng(seed).integers(0, len(x), size=(100, len(x)))
+    expected = [stats.linregress(x[i], y[i]).slope for i in index]
+
+    np.testing.assert_allclose(slopes, expected, rtol=1e-10)
+
+def test_bootstrap_slope_error_close_to_loop():
+    rng = np.random.default_rng(2)
+    x = rng.uniform(0, 10, 200)
+    y = 2*x + rng.normal(0, 3, 200)
+
+    # Original loop with its own random resamplings
+    expected = np.std([stats.linregress(x[i], y[i]).slope for i
+                       in rng.integers(0, len(x), size=(2000, len(x)))])
+
+    assert bootstrap_slope_error(x, y, 2000, seed=3) == pytest.approx(expected, rel=0.1)
+
+def test_bootstrap_slope_error_seeded():
+    rng = np.random.default_rng(4)
+    x = rng.uniform(0, 10, 100)
+    y = x + rng.normal(0, 1, 100)
+
+    # Small blocks so there are many
+    error = bootstrap_slope_error(x, y, 300, seed=5, max_elements=1000)
+
+    assert bootstrap_slope_error(x, y, 300, seed=5, max_elements=1000) == error
+    assert bootstrap_slope_error(x, y, 300, seed=5, max_elements=1000,
+                                 num_workers=2) == error
+    assert bootstrap_slope_error(x, y, 300, seed=6, max_elements=1000) != error
@@ -0,0 +1,53 @@
+""" Tests for writing files without leaving partial ones.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import h5py
+import os
+from pathlib import Path
+import pytest
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.cache_functions import atomic_write
+
+
+def test_replaces_file(tmp_path):
+    filepath = str(tmp_path / 'file.json')
+
+    with atomic_write(filepath, 'w') as handle:
+        handle.write('old')
+    with atomic_write(filepath, 'w') as handle:
+        handle.write('new')
+
+    assert open(filepath).read() == 'new'
+    assert os.listdir(tmp_path) == ['file.json']
+
+def test_error_keeps_old_file(tmp_path):
+    filepath = str(tmp_path / 'file.json')
+
+    with atomic_write(filepath, 'w') as handle:
+        handle.write('old')
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(filepath, 'w') as handle:
+            handle.write('partial')
+            raise RuntimeError
+
+    assert open(filepath).read() == 'old'
+    assert os.listdir(tmp_path) == ['file.json']
+
+def test_h5_file(tmp_path):
+    filepath = str(tmp_path / 'file.h5')
+
+    with atomic_write(filepath, 'w+b') as handle, h5py.File(handle, 'w') as h5f:
+        h5f.create_dataset('x', data=[1, 2, 3])
+
+    with h5py.File(filepath, 'r') as h5f:
+        assert list(h5f['x'][:]) == [1, 2, 3]
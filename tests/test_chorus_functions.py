@@ -0,0 +1,135 @@
+""" Regression tests for integrating chorus bands, compares the array
+version against the original per-time loop and scipy simpson.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+from pathlib import Path
+import pytest
+from scipy.integrate import simpson
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.features.chorus_functions import fill_value, integrate_chorus_bands
+from src.features.chorus_functions import masked_simpson
+
+band_keys = ['b_lbc', 'e_lbc', 'b_lbc_max', 'e_lbc_max',
+             'b_ubc', 'e_ubc', 'b_ubc_max', 'e_ubc_max']
+
+
+def baseline_filter_band(freq, b_psd, e_psd, low, high, threshold=10**-7):
+    """Original filter_write_to_dict for one timestep and band."""
+
+    band_freq = freq[(freq > low) & (freq < high)]
+    b_band_psd = b_psd[(freq > low) & (freq < high)]
+    e_band_psd = e_psd[(freq > low) & (freq < high)]
+
+    try:
+        # Only continue if max magnetic chorus is > threshold
+        if np.max(b_band_psd) >= threshold:
+
+            # Integrate psd over band frequencies
+            integrated_b = simpson(y=b_band_psd[b_band_psd != -1e31],
+                                   x=band_freq[b_band_psd != -1e31])
+            integrated_e = simpson(y=e_band_psd[e_band_psd != -1e31],
+                                   x=band_freq[e_band_psd != -1e31])
+
+            # Get max value
+            b_max = np.max(b_band_psd[b_band_psd != -1e31])
+            e_max = np.max(e_band_psd[e_band_psd != -1e31])
+
+        else:
+            integrated_b, integrated_e, b_max, e_max = [np.nan]*4
+
+    except:
+        integrated_b, integrated_e, b_max, e_max = [np.nan]*4
+
+    return integrated_b, integrated_e, b_max, e_max
+
+def baseline_integrate_chorus_bands(freq, b_power, e_power, fce, threshold=10**-7):
+    """Loop over every timestep like the original compiler."""
+
+    band_dict = {key : np.zeros(len(fce)) for key in band_keys}
+
+    for i in range(len(fce)):
+        for band, (low, high) in [('lbc', (fce[i]/10, fce[i]/2)),
+                                  ('ubc', (fce[i]/2, fce[i]))]:
+            (band_dict['b_' + band][i], band_dict['e_' + band][i],
+             band_dict['b_' + band + '_max'][i],
+             band_dict['e_' + band + '_max'][i]) = baseline_filter_band(freq, b_power[i],
+                                                                       e_power[i], low,
+                                                                       high, threshold)
+
+    return band_dict
+
+def random_spectra(seed:int, n_times:int=300) -> 'np.ndarray x 4':
+    """Log spaced frequencies like EMFISIS with lognormal power, fill
+    values and gyrofrequencies that put few or no bins in a band."""
+
+    rng = np.random.default_rng(seed)
+
+    freq = np.geomspace(2, 1e4, 65)
+    b_power = 10**rng.normal(-8, 1.5, (n_times, len(freq)))
+    e_power = 10**rng.normal(-10, 1.5, (n_times, len(freq)))
+
+    # Some fill values, some rows all fill
+    b_power[rng.random(b_power.shape) < 0.1] = fill_value
+    e_power[rng.random(e_power.shape) < 0.1] = fill_value
+    b_power[rng.integers(0, n_times, 5)] = fill_value
+    e_power[rng.integers(0, n_times, 5)] = fill_value
+
+    # Magnetic field from very small to large
+    fce = 10**rng.uniform(0, 3, n_times)*28
+
+    return freq, b_power, e_power, fce
+
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_loop(seed):
+    freq, b_power, e_power, fce = random_spectra(seed)
+
+    expected = baseline_integrate_chorus_bands(freq, b_power, e_power, fce)
+    band_dict = integrate_chorus_bands(freq, b_power, e_power, fce)
+
+    for key in band_keys:
+        np.testing.assert_allclose(band_dict[key], expected[key], rtol=1e-10,
+                                   atol=0, equal_nan=True, err_msg=key)
+
+    for band in ['lbc', 'ubc']:
+        np.testing.assert_array_equal(band_dict[band + '_chorus'],
+                                      np.isfinite(expected['b_' + band]))
+
+def test_threshold():
+    freq, b_power, e_power, fce = random_spectra(0)
+
+    for threshold in [10**-9, 10**-6]:
+        expected = baseline_integrate_chorus_bands(freq, b_power, e_power, fce,
+                                                   threshold)
+        band_dict = integrate_chorus_bands(freq, b_power, e_power, fce,
+                                           threshold=threshold)
+        for key in band_keys:
+            np.testing.assert_allclose(band_dict[key], expected[key], rtol=1e-10,
+                                       equal_nan=True, err_msg=key)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_masked_simpson(seed):
+    rng = np.random.default_rng(seed)
+
+    # Irregular spacing and every number of points from 0 to all
+    x = np.cumsum(rng.uniform(0.1, 2, 12))
+    y = rng.normal(0, 1, (200, len(x)))
+    mask = rng.random(y.shape) < rng.uniform(0, 1, (200, 1))
+
+    result, n_points = masked_simpson(y, x, mask)
+
+    np.testing.assert_array_equal(n_points, mask.sum(axis=1))
+    for i in range(len(y)):
+        if n_points[i] == 0:
+            continue
+        np.testing.assert_allclose(result[i], simpson(y=y[i, mask[i]], x=x[mask[i]]),
+                                   rtol=1e-10, atol=1e-12)
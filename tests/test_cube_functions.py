@@ -0,0 +1,167 @@
+""" Regression tests for the statistics cube, compares sector statistics
+from the cube with binning the measurements directly.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+from pathlib import Path
+import pytest
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.features.cube_functions import add_to_stats_cube, default_cube_edges
+from src.features.cube_functions import default_hist_edges, load_stats_cube
+from src.features.cube_functions import new_stats_cube, query_stats_cube
+from src.features.cube_functions import update_stats_cube
+
+delay_edges = np.append(np.arange(0, 5*60*60, 30*60), np.inf)
+
+
+def random_measurements(seed:int, n:int=20000) -> dict:
+    """Measurements spread over the cube with some that are outside it,
+    not finite or not larger than zero."""
+
+    rng = np.random.default_rng(seed)
+
+    data = {'delay' : rng.uniform(-600, 6*60*60, n),
+            'mlt' : rng.uniform(0, 24, n),
+            'l' : rng.uniform(2, 9, n),
+            'mlat' : rng.uniform(-25, 25, n),
+            'chorus' : 10**rng.normal(-6, 1.5, n),
+            'lbc' : 10**rng.normal(-7, 1, n)}
+
+    data['mlt'][rng.integers(0, n, 50)] = np.nan
+    data['chorus'][rng.integers(0, n, 200)] = np.nan
+    data['chorus'][rng.integers(0, n, 200)] = 0
+    data['lbc'][rng.integers(0, n, 200)] = -1e31
+
+    return data
+
+def make_cube(data:dict) -> dict:
+    cube = new_stats_cube(['chorus', 'lbc'])
+    add_to_stats_cube(cube, data['delay'], data['mlt'], data['l'], data['mlat'],
+                      {'chorus' : data['chorus'], 'lbc' : data['lbc']})
+    return cube
+
+def direct_statistics(data:dict, name:str, mlt_range:tuple, l_range:tuple,
+                      mlat_range:tuple) -> dict:
+    """Statistics in each delay bin by selecting the measurements directly."""
+
+    values = data[name]
+    mlt = data['mlt']
+    abs_mlat = np.abs(data['mlat'])
+
+    with np.errstate(invalid='ignore'):
+        if mlt_range[0] <= mlt_range[1]:
+            in_mlt = (mlt >= mlt_range[0]) & (mlt < mlt_range[1])
+        else:
+            in_mlt = ((mlt >= mlt_range[0]) & (mlt < 24)) | (mlt < mlt_range[1])
+
+        selector = (in_mlt & (data['l'] >= l_range[0]) & (data['l'] < l_range[1])
+                    & (abs_mlat >= mlat_range[0]) & (abs_mlat < mlat_range[1])
+                    & np.isfinite(values) & (values > 0))
+
+    stats_dict = {key : [] for key in ['count', 'mean', 'std', 'gmean', 'gstd', 'median']}
+
+    for low, high in zip(delay_edges[:-1], delay_edges[1:]):
+        bin_values = values[selector & (data['delay'] >= low) & (data['delay'] < high)]
+        log_values = np.log10(bin_values)
+
+        stats_dict['count'].append(len(bin_values))
+        stats_dict['mean'].append(np.mean(bin_values))
+        stats_dict['std'].append(np.std(bin_values))
+        stats_dict['gmean'].append(10**np.mean(log_values))
+        stats_dict['gstd'].append(10**np.std(log_values, ddof=1))
+        stats_dict['median'].append(np.median(bin_values))
+
+    return {key : np.array(value) for key, value in stats_dict.items()}
+
+@pytest.mark.parametrize('mlt_range, l_range, mlat_range',
+                         [((22, 2), (4, 6), (0, 10)),
+                          ((18, 6), (6.5, 8), (10, 20)),
+                          ((3, 9), (2, 8), (0, 20))])
+def test_query_matches_direct(mlt_range, l_range, mlat_range):
+    data = random_measurements(0)
+    cube = make_cube(data)
+
+    stats_dict = query_stats_cube(cube, mlt_range, l_range, mlat_range, delay_edges)
+
+    np.testing.assert_array_equal(stats_dict['delay_edges'], delay_edges)
+
+    for name in ['chorus', 'lbc']:
+        expected = direct_statistics(data, name, mlt_range, l_range, mlat_range)
+        column = stats_dict[name]
+
+        assert np.all(expected['count'] > 10)
+        np.testing.assert_array_equal(column['count'], expected['count'])
+        for key in ['mean', 'std', 'gmean', 'gstd']:
+            np.testing.assert_allclose(column[key], expected[key], rtol=1e-8,
+                                       err_msg=f'{name} {key}')
+
+        # Median is from the histogram, so only within a histogram bin
+        bin_width = np.diff(default_hist_edges)[0]
+        assert np.all(np.abs(np.log10(column['median'])
+                             - np.log10(expected['median'])) <= bin_width)
+
+def test_wrap_around_is_both_sides():
+    data = random_measurements(1)
+    cube = make_cube(data)
+
+    wrapped = query_stats_cube(cube, (22, 2))['chorus']['count']
+    evening = query_stats_cube(cube, (22, 24))['chorus']['count']
+    morning = query_stats_cube(cube, (0, 2))['chorus']['count']
+
+    np.testing.assert_array_equal(wrapped, evening + morning)
+    assert np.sum(morning) > 0 and np.sum(evening) > 0
+
+def test_whole_cube_counts():
+    data = random_measurements(2)
+    cube = make_cube(data)
+
+    with np.errstate(invalid='ignore'):
+        in_cube = (np.isfinite(data['mlt']) & (data['delay'] >= 0)
+                   & np.isfinite(data['chorus']) & (data['chorus'] > 0))
+
+    assert np.sum(query_stats_cube(cube)['chorus']['count']) == np.sum(in_cube)
+
+def test_delay_edges_must_be_cube_edges():
+    cube = new_stats_cube(['chorus'])
+
+    with pytest.raises(ValueError):
+        query_stats_cube(cube, delay_edges=[0, 100, 600])
+
+def test_update_adds_only_new_units(tmp_path):
+    data = random_measurements(3, n=3000)
+    cube_filepath = str(tmp_path / 'cube.h5')
+    config = {'edges' : default_cube_edges, 'hist_edges' : default_hist_edges,
+              'columns' : ['chorus', 'lbc']}
+    values = {'chorus' : data['chorus'], 'lbc' : data['lbc']}
+
+    def update(n_units:int) -> 'dict, int':
+        counts = np.full(n_units, 1000)
+        rows = slice(0, 1000*n_units)
+        return update_stats_cube(cube_filepath, config, [f'unit-{i}' for i in range(n_units)],
+                                 counts, data['delay'][rows], data['mlt'][rows],
+                                 data['l'][rows], data['mlat'][rows],
+                                 {name : value[rows] for name, value in values.items()})
+
+    assert update(2)[1] == 2
+    cube, n_new = update(3)
+    assert n_new == 1
+
+    expected = make_cube(data)
+    saved = load_stats_cube(cube_filepath, config)
+    assert saved['units'] == ['unit-0', 'unit-1', 'unit-2']
+    for name in ['chorus', 'lbc']:
+        for key, array in expected['columns'][name].items():
+            np.testing.assert_allclose(saved['columns'][name][key], array,
+                                       rtol=1e-12, err_msg=f'{name} {key}')
+
+    # Different settings make the cube again
+    assert load_stats_cube(cube_filepath, dict(config, columns=['chorus'])) is None
@@ -0,0 +1,230 @@
+""" Tests for the download engine against a local stand-in http server.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from pathlib import Path
+import pytest
+import requests
+import socket
+import sys
+import threading
+import time
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data import download_functions
+from src.data.download_functions import download_file, download_files
+from src.data.download_functions import get_url_links, is_client_error
+
+# File served by the stand-in server
+content = bytes(range(256))*64
+
+listing = (b'<html><body><a href="../">Parent</a>'
+           b'<a href="a.cdf">a.cdf</a><a href=\'b.cdf\'>b.cdf</a></body></html>')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves content with or without range support, a listing, a missing
+    file and a file that fails a few times before working."""
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status:int, body:bytes, headers:dict={}):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests[path] += 1
+        self.server.ranges.append(self.headers.get('Range'))
+
+        if path == '/file.cdf':
+            range_header = self.headers.get('Range')
+            if range_header is None:
+                return self.send_body(200, content)
+
+            start = int(range_header[len('bytes='):-1])
+            if start >= len(content):
+                return self.send_body(416, b'', {'Content-Range' : f'bytes */{len(content)}'})
+
+            return self.send_body(206, content[start:],
+                                  {'Content-Range' : f'bytes {start}-{len(content)-1}/{len(content)}'})
+
+        if path == '/no-range.cdf':
+            return self.send_body(200, content)
+
+        if path == '/flaky.cdf':
+            if self.server.requests[path] <= 2:
+                return self.send_body(503, b'')
+            return self.send_body(200, content)
+
+        if path == '/dir/':
+            return self.send_body(200, listing, {'Content-Type' : 'text/html'})
+
+        return self.send_body(404, b'')
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    httpd.requests = Counter()
+    httpd.ranges = []
+    httpd.url = f'http://127.0.0.1:{httpd.server_address[1]}'
+
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval' : 0.05},
+                              daemon=True)
+    thread.start()
+
+    # Listings cached by other tests
+    download_functions._listings.clear()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_download(server, tmp_path):
+    filepath = str(tmp_path / 'file.cdf')
+
+    assert download_file(server.url + '/file.cdf', filepath) == filepath
+    assert open(filepath, 'rb').read() == content
+    assert not os.path.exists(filepath + '.part')
+
+def test_resume_part_file(server, tmp_path):
+    filepath = str(tmp_path / 'file.cdf')
+    with open(filepath + '.part', 'wb') as handle:
+        handle.write(content[:1000])
+
+    download_file(server.url + '/file.cdf', filepath)
+
+    assert server.ranges == ['bytes=1000-']
+    assert open(filepath, 'rb').read() == content
+    assert not os.path.exists(filepath + '.part')
+
+def test_server_ignores_range(server, tmp_path):
+    filepath = str(tmp_path / 'file.cdf')
+    with open(filepath + '.part', 'wb') as handle:
+        handle.write(b'x'*1000)
+
+    download_file(server.url + '/no-range.cdf', filepath)
+
+    assert server.ranges == ['bytes=1000-']
+    assert open(filepath, 'rb').read() == content
+
+def test_complete_part_file(server, tmp_path):
+    filepath = str(tmp_path / 'file.cdf')
+    with open(filepath + '.part', 'wb') as handle:
+        handle.write(content)
+
+    download_file(server.url + '/file.cdf', filepath)
+
+    assert server.requests['/file.cdf'] == 1
+    assert open(filepath, 'rb').read() == content
+
+def test_part_file_larger_than_remote(server, tmp_path):
+    # File on server was replaced with a smaller one
+    filepath = str(tmp_path / 'file.cdf')
+    with open(filepath + '.part', 'wb') as handle:
+        handle.write(b'x'*(len(content) + 100))
+
+    download_file(server.url + '/file.cdf', filepath)
+
+    assert server.ranges == [f'bytes={len(content) + 100}-', None]
+    assert open(filepath, 'rb').read() == content
+
+def test_missing_file_not_retried(server, tmp_path):
+    url = server.url + '/missing.cdf'
+
+    failed = download_files([(url, str(tmp_path / 'missing.cdf'))],
+                            retries=3, backoff=0.01)
+
+    assert is_client_error(failed[url])
+    assert failed[url].response.status_code == 404
+    assert server.requests['/missing.cdf'] == 1
+    assert not os.path.exists(tmp_path / 'missing.cdf')
+
+def test_server_error_retried(server, tmp_path):
+    filepath = str(tmp_path / 'flaky.cdf')
+
+    start = time.monotonic()
+    failed = download_files([(server.url + '/flaky.cdf', filepath)],
+                            retries=3, backoff=0.1)
+
+    # Waits 0.1 then 0.2 seconds before the retries
+    assert time.monotonic() - start >= 0.3
+    assert failed == {}
+    assert server.requests['/flaky.cdf'] == 3
+    assert open(filepath, 'rb').read() == content
+
+def test_server_error_gives_up(server, tmp_path):
+    url = server.url + '/flaky.cdf'
+
+    failed = download_files([(url, str(tmp_path / 'flaky.cdf'))],
+                            retries=1, backoff=0.01)
+
+    assert isinstance(failed[url], requests.HTTPError)
+    assert not is_client_error(failed[url])
+    assert server.requests['/flaky.cdf'] == 2
+
+def test_duplicate_jobs_downloaded_once(server, tmp_path):
+    job = (server.url + '/file.cdf', str(tmp_path / 'file.cdf'))
+
+    assert download_files([job]*5, max_concurrency=4) == {}
+    assert server.requests['/file.cdf'] == 1
+
+    # Files that already exist are skipped
+    assert download_files([job]) == {}
+    assert server.requests['/file.cdf'] == 1
+
+def test_listing_memory_cache(server):
+    url = server.url + '/dir/'
+
+    links = get_url_links(url, cache_dir='')
+    assert links == ['../', 'a.cdf', 'b.cdf']
+    assert get_url_links(url, cache_dir='') == links
+    assert server.requests['/dir/'] == 1
+
+    # Expired listings are fetched again
+    get_url_links(url, cache_dir='', ttl=0)
+    assert server.requests['/dir/'] == 2
+
+def test_listing_disk_cache(server, tmp_path):
+    url = server.url + '/dir/'
+    cache_dir = str(tmp_path / 'listings')
+
+    links = get_url_links(url, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    # Like a new run, only the disk cache is left
+    download_functions._listings.clear()
+    assert get_url_links(url, cache_dir=cache_dir) == links
+    assert server.requests['/dir/'] == 1
+
+    download_functions._listings.clear()
+    get_url_links(url, cache_dir=cache_dir, ttl=0)
+    assert server.requests['/dir/'] == 2
+
+def test_listing_timeout(tmp_path):
+    # Server that accepts the connection but never answers
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    url = f'http://127.0.0.1:{listener.getsockname()[1]}/stalled/'
+
+    try:
+        with pytest.raises(requests.Timeout):
+            get_url_links(url, cache_dir='', timeout=0.2)
+    finally:
+        listener.close()
@@ -0,0 +1,44 @@
+""" Tests for appending event and probe rows to column datasets.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import h5py
+import numpy as np
+from pathlib import Path
+import pytest
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.h5_functions import append_columns_to_h5, read_index_from_h5
+
+
+def test_append_rows(tmp_path):
+    with h5py.File(tmp_path / 'data.h5', 'w') as h5f:
+        append_columns_to_h5(h5f, {'a' : np.arange(3), 'b' : np.ones(3)},
+                             '2015-03-01T00:00:00', 'rbspa')
+        append_columns_to_h5(h5f, {'a' : np.arange(2), 'b' : np.ones(2)},
+                             '2015-03-02T00:00:00', 'rbspb')
+
+        assert list(h5f['a'][:]) == [0, 1, 2, 0, 1]
+        assert list(read_index_from_h5(h5f)['offset']) == [0, 3]
+
+@pytest.mark.parametrize('columns', [{'a' : np.arange(2), 'b' : np.ones(2), 'c' : np.ones(2)},
+                                     {'a' : np.arange(2)},
+                                     {'a' : np.arange(2), 'c' : np.ones(2)}])
+def test_different_columns_raise(tmp_path, columns):
+    with h5py.File(tmp_path / 'data.h5', 'w') as h5f:
+        append_columns_to_h5(h5f, {'a' : np.arange(3), 'b' : np.ones(3)},
+                             '2015-03-01T00:00:00', 'rbspa')
+
+        with pytest.raises(ValueError):
+            append_columns_to_h5(h5f, columns, '2015-03-02T00:00:00', 'rbspb')
+
+        # Nothing was written
+        assert set(h5f) == {'a', 'b', 'index'}
+        assert h5f['a'].shape[0] == 3
@@ -0,0 +1,73 @@
+""" Tests that isotime_to_datetime64 gives the same times as the
+original dateutil parser.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import numpy as np
+from pathlib import Path
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.magephem_functions import isotime_to_datetime64
+from tests.isotime_baseline import baseline_isotime_to_datetime64, random_isotimes
+
+
+def test_random_times_with_leap_seconds():
+    isotime = random_isotimes(5000, seed=1, leap_every=50)
+
+    np.testing.assert_array_equal(isotime_to_datetime64(isotime),
+                                  baseline_isotime_to_datetime64(isotime))
+
+def test_leap_second():
+    isotime = np.array([b'2012-06-30T23:59:60Z', b'2016-12-31T23:59:60Z'])
+
+    time = isotime_to_datetime64(isotime)
+
+    np.testing.assert_array_equal(time, baseline_isotime_to_datetime64(isotime))
+    assert time[0] == np.datetime64('2012-06-30T23:59:59', 'ns')
+
+def test_without_z():
+    isotime = np.array([b'2013-01-02T03:04:05', b'2013-01-02T03:04:06'])
+
+    np.testing.assert_array_equal(isotime_to_datetime64(isotime),
+                                  baseline_isotime_to_datetime64(isotime))
+
+    # The original parser can't read leap seconds without a Z
+    assert (isotime_to_datetime64(np.array([b'2012-06-30T23:59:60']))[0]
+            == np.datetime64('2012-06-30T23:59:59', 'ns'))
+
+def test_null_padded_mixed_lengths():
+    isotime = np.array([b'2013-01-02T03:04:05Z', b'2013-01-02T03:04:05.25Z',
+                        b'2013-01-02T03:04:05', b'2012-06-30T23:59:60Z',
+                        b'2013-01-02T03:04:05.123456Z', b'2013-01-02T03:04:05.5'],
+                       dtype='S32')
+
+    np.testing.assert_array_equal(isotime_to_datetime64(isotime),
+                                  baseline_isotime_to_datetime64(isotime))
+
+def test_fractional_seconds():
+    isotime = np.array([b'2013-01-02T03:04:05.5Z', b'2013-01-02T03:04:05.250Z',
+                        b'2013-01-02T03:04:05.123456Z', b'2013-01-02T03:04:05.000001Z'])
+
+    np.testing.assert_array_equal(isotime_to_datetime64(isotime),
+                                  baseline_isotime_to_datetime64(isotime))
+
+    # Only the seconds are changed for a leap second, not the fraction.
+    #...The original parser changed fractions ending in 60 and couldn't
+    #...read a leap second with a fraction
+    time = isotime_to_datetime64(np.array([b'2012-06-30T23:59:60.250Z',
+                                           b'2013-01-02T03:04:05.160Z']))
+    assert time[0] == np.datetime64('2012-06-30T23:59:59.250', 'ns')
+    assert time[1] == np.datetime64('2013-01-02T03:04:05.160', 'ns')
+
+def test_empty():
+    time = isotime_to_datetime64(np.array([], dtype='S20'))
+
+    assert time.shape == (0,)
+    assert time.dtype == np.dtype('datetime64[ns]')
@@ -0,0 +1,111 @@
+""" Tests for resuming a run, the manifest and rolling back partly
+written units in the h5 file.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+import h5py
+import numpy as np
+from pathlib import Path
+import pytest
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.h5_functions import append_columns_to_h5, append_to_dataset
+from src.data.h5_functions import read_index_from_h5, truncate_columns_in_h5
+from src.data.manifest_functions import load_run_manifest, new_run_manifest
+from src.data.manifest_functions import save_run_manifest, unit_key
+
+config = {'threshold' : 1e-9, 'smooth_size' : 3}
+
+
+def unit_columns(seed:int, n_rows:int) -> dict:
+    rng = np.random.default_rng(seed)
+    return {'delay' : rng.random(n_rows), 'probe' : np.array([b'rbspa']*n_rows)}
+
+def read_all(h5_file:h5py.File) -> dict:
+    return {'index' : {key : value.copy() for key, value in read_index_from_h5(h5_file).items()},
+            'columns' : {name : h5_file[name][:] for name in ['delay', 'probe']}}
+
+def assert_same(data:dict, expected:dict):
+    for part in ['index', 'columns']:
+        assert data[part].keys() == expected[part].keys()
+        for key in expected[part]:
+            np.testing.assert_array_equal(data[part][key], expected[part][key])
+
+@pytest.fixture
+def saved_run(tmp_path):
+    """File with three units written and a manifest saved after them."""
+
+    h5_filepath = str(tmp_path / 'data.h5')
+    manifest_filepath = h5_filepath + '.manifest.json'
+    manifest = new_run_manifest(config, h5_filepath)
+
+    with h5py.File(h5_filepath, 'w') as h5_file:
+        for i, n_rows in enumerate([4, 0, 7]):
+            event = f'2015-03-0{i+1}T00:00:00Z'
+            append_columns_to_h5(h5_file, unit_columns(i, n_rows), event, 'rbspa')
+            manifest['completed'][unit_key(event, 'rbspa')] = n_rows
+            manifest['index_rows'] += 1
+        save_run_manifest(manifest_filepath, manifest)
+        saved = read_all(h5_file)
+
+    return h5_filepath, manifest_filepath, saved
+
+def test_truncate_partial_unit(saved_run):
+    h5_filepath, manifest_filepath, saved = saved_run
+
+    with h5py.File(h5_filepath, 'a') as h5_file:
+        # A full unit written after the manifest, then one stopped
+        #...before all its columns and the index were written
+        append_columns_to_h5(h5_file, unit_columns(10, 5), '2015-03-04T00:00:00Z', 'rbspa')
+        append_to_dataset(h5_file, 'delay', np.ones(3))
+
+        manifest = load_run_manifest(manifest_filepath, config, h5_filepath)
+        truncate_columns_in_h5(h5_file, manifest['index_rows'])
+
+        assert_same(read_all(h5_file), saved)
+
+        # Writing continues where the saved rows end
+        append_columns_to_h5(h5_file, unit_columns(11, 2), '2015-03-04T00:00:00Z', 'rbspa')
+        assert read_index_from_h5(h5_file)['offset'][-1] == 11
+        assert h5_file['delay'].shape[0] == 13
+
+def test_truncate_nothing_to_remove(saved_run):
+    h5_filepath, manifest_filepath, saved = saved_run
+
+    with h5py.File(h5_filepath, 'a') as h5_file:
+        truncate_columns_in_h5(h5_file, 3)
+        assert_same(read_all(h5_file), saved)
+
+def test_truncate_manifest_ahead_of_file(saved_run):
+    h5_filepath, manifest_filepath, saved = saved_run
+
+    with h5py.File(h5_filepath, 'a') as h5_file:
+        with pytest.raises(ValueError, match='manifest does not match'):
+            truncate_columns_in_h5(h5_file, 5)
+
+        # File isn't changed
+        assert_same(read_all(h5_file), saved)
+
+def test_load_manifest(saved_run):
+    h5_filepath, manifest_filepath, saved = saved_run
+
+    manifest = load_run_manifest(manifest_filepath, config, h5_filepath)
+    assert manifest['index_rows'] == 3
+    assert len(manifest['completed']) == 3
+
+def test_manifest_rejected(saved_run, caplog):
+    h5_filepath, manifest_filepath, saved = saved_run
+
+    assert load_run_manifest(manifest_filepath, dict(config, threshold=1e-8),
+                             h5_filepath) is None
+    assert "['threshold']" in caplog.text
+
+    assert load_run_manifest(manifest_filepath, config, h5_filepath + '.other') is None
+    assert load_run_manifest(manifest_filepath + '.missing', config, h5_filepath) is None
@@ -0,0 +1,153 @@
+""" Regression tests for finding SME quiet times, compares the array
+version against the original loop.
+
+@author Riley Troyer
+science@rileytroyer.com
+"""
+
+# Libraries
+from datetime import datetime, timedelta
+import numpy as np
+from pathlib import Path
+import pytest
+from scipy.ndimage import uniform_filter1d
+import sys
+
+# Add root to path
+path_root = Path(__file__).parents[1]
+sys.path.append(str(path_root))
+
+from src.data.sme_functions import sme_find_quiet_times, sme_find_quiet_times_stream
+
+
+def baseline_sme_find_quiet_times(sme, sme_dates, quiet_threshold=150,
+                                  high_threshold=250):
+    """Original loop version of sme_find_quiet_times."""
+
+    # Find where sme is below threshold
+    low_sme_i = np.argwhere(sme < quiet_threshold)[:, 0]
+
+    # Group by connected times
+    quiet_times_i = [[low_sme_i[0]]]
+
+    for i in range(1, len(low_sme_i)):
+        if low_sme_i[i-1]+1 == low_sme_i[i]:
+            quiet_times_i[-1].append(low_sme_i[i])
+
+        else:
+            quiet_times_i.append([low_sme_i[i]])
+
+    # Loop through each group and get start and stop times of quiet periods
+    quiet_times = []
+    prev_end = 0
+    for group in quiet_times_i:
+
+        # Remove if period is less than specified length
+        if len(group) < 10:
+            continue
+
+        # Remove if no higher SME prior to last period end
+        if np.max(sme[prev_end:group[-1]]) < high_threshold:
+            continue
+
+        # First get the index of the peak value in index
+        peak_index = np.argmax(sme[prev_end:group[-1]])
+
+        # Now get all index values that are less than threshold
+        non_active_times = np.argwhere(sme[prev_end:group[-1]] < high_threshold)
+
+        # Of these get the largest that is less than the peak index
+        try:
+            injection_start_index = sorted(non_active_times[non_active_times < peak_index])[-1]
+        except:
+            injection_start_index = prev_end
+        injection_start_time = sme_dates[prev_end:group[-1]][injection_start_index]
+
+        # Get the approximate injection length
+        injection_len = (sme_dates[group[0]] - injection_start_time).total_seconds()
+
+        # Get the length of a quiet period
+        quiet_period_len = (sme_dates[group[-1]] - sme_dates[group[0]]).total_seconds()
+
+        # Reset previous end point
+        prev_end = group[-1]
+
+        quiet_times.append([sme_dates[group[0]], sme_dates[group[-1]],
+                            injection_start_time, injection_len, quiet_period_len])
+
+    return quiet_times
+
+def make_dates(n:int) -> list:
+    """Minute resolution datetimes like the SME files."""
+    return [datetime(2015, 3, 1) + timedelta(minutes=i) for i in range(n)]
+
+def random_sme(seed:int, n_segments:int=40) -> np.ndarray:
+    """Smoothed SME made of quiet, moderate and active segments."""
+
+    rng = np.random.default_rng(seed)
+
+    segments = [rng.integers(20, 140, rng.integers(5, 40))]
+    for _ in range(n_segments):
+        low, high = [(20, 140), (150, 250), (250, 900)][rng.integers(0, 3)]
+        segments.append(rng.integers(low, high, rng.integers(1, 40)))
+
+    sme = uniform_filter1d(np.concatenate(segments), size=6)
+
+    # Make sure there is a quiet sample for the original loop
+    sme[-1] = 0
+
+    return sme
+
+def normalize(quiet_times:list) -> list:
+    """Times as datetime64[us] so both versions can be compared."""
+    return [[np.datetime64(row[0], 'us'), np.datetime64(row[1], 'us'),
+             np.datetime64(row[2], 'us'), float(row[3]), float(row[4])]
+            for row in quiet_times]
+
+def assert_same(sme:np.ndarray, dates:list):
+    expected = normalize(baseline_sme_find_quiet_times(sme, dates))
+    assert normalize(sme_find_quiet_times(sme, dates)) == expected
+    assert normalize(sme_find_quiet_times(sme, np.array(dates, dtype='datetime64[s]'))) == expected
+
+@pytest.mark.parametrize('seed', range(50))
+def test_random_series(seed):
+    sme = random_sme(seed)
+    assert_same(sme, make_dates(len(sme)))
+
+def test_no_onset_before_peak():
+    # Series starts active with the peak first, so there is no quiet
+    #...sample before the peak and the fallback start is used
+    sme = np.concatenate((np.arange(600, 250, -50), np.full(15, 100),
+                          [300, 500, 300], np.full(12, 100)))
+    dates = make_dates(len(sme))
+
+    assert_same(sme, dates)
+    assert sme_find_quiet_times(sme, dates)[0][2] == dates[0]
+
+def test_short_runs_ignored():
+    # Quiet runs shorter than min_length between active samples
+    sme = np.concatenate(([400], np.full(5, 100), [400], np.full(9, 100),
+                          [400], np.full(10, 100), [400], np.full(3, 100)))
+
+    assert_same(sme, make_dates(len(sme)))
+    assert len(sme_find_quiet_times(sme, make_dates(len(sme)))) == 1
+
+def test_peak_tie():
+    # Two equal peaks, the first one picks the injection start
+    sme = np.concatenate((np.full(12, 100), [200, 500, 200, 100, 200, 500, 200],
+                          np.full(12, 100)))
+    dates = make_dates(len(sme))
+
+    assert_same(sme, dates)
+    assert sme_find_quiet_times(sme, dates)[0][2] == dates[12]
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1000])
+def test_stream_matches_whole_series(chunk_size):
+    sme = np.concatenate([random_sme(seed) for seed in range(5)])
+    dates = np.array(make_dates(len(sme)), dtype='datetime64[s]')
+
+    expected = normalize(sme_find_quiet_times(sme, dates))
+    chunks = ((sme[i:i+chunk_size], dates[i:i+chunk_size])
+              for i in range(0, len(sme), chunk_size))
+
+    assert normalize(sme_find_quiet_times_stream(chunks)) == expected